@@ -1,23 +1,26 @@
 import gzip
-from itertools import groupby, chain
 import logging
-from operator import itemgetter
 import os
-from scipy.sparse import isspmatrix_coo, issparse
+import shutil
+from scipy.sparse import issparse
 import numpy as np
 import six
+from discoutils.misc import sniff_format
 
 __author__ = 'mmb28'
 
 
 def write_vectors_to_disk(matrix, row_index, column_index, vectors_path, features_path='', entries_path='',
-                          entry_filter=lambda x: True, gzipped=False):
+                          entry_filter=lambda x: True, gzipped=False, chunk_size=10000, n_jobs=1):
     """
     Converts a matrix and its associated row/column indices to a Byblo compatible entries/features/event files,
     possibly applying a tranformation function to each entry.
 
-    :param matrix: data matrix of size (n_entries, n_features) in scipy.sparse.coo format
-    :type matrix: scipy.sparse.coo_matrix
+    The matrix is written one chunk of rows at a time. Within a chunk, almost-zero values are removed and the
+    remaining values are converted to strings with numpy, so most of the work is done outside the interpreter.
+
+    :param matrix: data matrix of size (n_entries, n_features), sparse (in any format) or dense
+    :type matrix: scipy.sparse.spmatrix or np.ndarray
     :param row_index: a collection of DocumentFeature-s representing entry names. `row_index[N]` should return the
      feature whose vector is stored in row N of `matrix`
     :type row_index: discoutils.tokens.DocumentFeature
@@ -30,68 +33,189 @@ def write_vectors_to_disk(matrix, row_index, column_index, vectors_path, feature
     :type vectors_path: string of file-like. If it evaluates to True progress messages will be printed
     :param entry_filter: callable, called for each entry. Takes a single DocumentFeature parameter. Returns true
     if the entry has to be written and false if the entry has to be ignored. Defaults to True.
+    :param chunk_size: number of rows to process at a time
+    :param n_jobs: if more than 1, the rows are split into this many contiguous shards, which are formatted (and
+     compressed) in parallel and then concatenated into `vectors_path`. The output is the same, except that
+     when an entry occurs in several rows only the first row that is not empty is considered. Only works when
+     `vectors_path` is a file name. Use -1 for one shard per CPU.
     """
-    import numpy as np
+    from scipy.sparse import csr_matrix
 
     if not any([vectors_path, features_path, entries_path]):
         raise ValueError('At least one of vectors_path, features_path or entries_path required')
 
-    if not isspmatrix_coo(matrix):
-        logging.error('Expected a scipy.sparse.coo matrix, got %s', type(matrix))
+    if not (issparse(matrix) or isinstance(matrix, np.ndarray)):
+        logging.error('Expected a scipy.sparse matrix or a numpy array, got %s', type(matrix))
         raise ValueError('Wrong matrix type')
     if (len(row_index), len(column_index)) != matrix.shape:
         logging.error('Matrix shape is wrong, expected %dx%s, got %r', len(row_index), len(column_index), matrix.shape)
         raise ValueError('Matrix shape does not match row_index/column_index size')
-
-    accepted_entry_counts = {}
-    matrix_data = zip(matrix.row, matrix.col, matrix.data)
-    accepted_rows = []
+    # zeros stored in a sparse matrix are treated like any other value, but those in a dense matrix are not
+    matrix = csr_matrix(matrix)
+    column_index = np.array([str(x) for x in column_index], dtype=object)
 
     logging.info('Writing events to %s', vectors_path)
-    if isinstance(vectors_path, six.string_types):
-        if gzipped:
-            outfile = gzip.open(vectors_path, 'w')
-        else:
-            outfile = open(vectors_path, 'w')
-    elif hasattr(vectors_path, 'write'):
-        outfile = vectors_path
+    if n_jobs != 1 and isinstance(vectors_path, six.string_types):
+        num_entries, num_accepted, feature_sums = _write_events_sharded(matrix, row_index, column_index,
+                                                                        vectors_path, entries_path, entry_filter,
+                                                                        gzipped, chunk_size, n_jobs)
     else:
-        raise ValueError('vectors_path: expected str or file-like, got %s' % type(vectors_path))
-
-    for row_num, column_ids_and_values in groupby(matrix_data, itemgetter(0)):
-        entry = row_index[row_num]
-        if entry_filter(entry):
-            if entry not in accepted_entry_counts:  # guard against duplicated vectors
-                accepted_rows.append(row_num)
-                features_and_counts = [(column_index[feat], count) for _, feat, count in column_ids_and_values \
-                                       if not -0.0001 < count < 0.0001]  # remove almost zero feature counts
-                if not features_and_counts:
-                    continue
-                s = '%s\t%s\n' % (entry, '\t'.join(map(str, chain.from_iterable(features_and_counts))))
-                outfile.write(s.encode('utf8') if gzipped else s)
-                accepted_entry_counts[entry] = sum(x[1] for x in features_and_counts)
-            if row_num % 20000 == 0 and outfile:
-                logging.info('Processed %d vectors', row_num)
-
-    outfile.close()
-
-    if entries_path and accepted_entry_counts:
-        logging.info('Writing entries to %s', entries_path)
-        with open(entries_path, 'w') as outfile:
-            for entry, count in accepted_entry_counts.items():
-                outfile.write('%s\t%f\n' % (entry, count))
-
-    if features_path and accepted_rows:  # guard against empty files
+        if isinstance(vectors_path, six.string_types):
+            outfile = _open_for_writing(vectors_path, gzipped)
+            encode = False
+        elif hasattr(vectors_path, 'write'):
+            outfile = vectors_path
+            encode = gzipped
+        else:
+            raise ValueError('vectors_path: expected str or file-like, got %s' % type(vectors_path))
+        # the entries are written as we go, alongside the events
+        entries_file = open(entries_path, 'w') if entries_path else None
+        num_entries, num_accepted, feature_sums = _write_events(matrix, row_index, column_index, outfile,
+                                                                entries_file, entry_filter, encode, chunk_size)
+        outfile.close()
+        if entries_file is not None:
+            entries_file.close()
+
+    if entries_path and not num_entries:
+        # guard against empty files
+        os.unlink(entries_path)
+
+    if features_path and num_accepted:  # guard against empty files
         logging.info('Writing features to %s', features_path)
         with open(features_path, 'w') as outfile:
-            feature_sums = np.array(matrix.tocsr()[accepted_rows].sum(axis=0))[0, :]
-            for feature, count in zip(column_index, feature_sums):
+            for feature, count in zip(column_index, feature_sums.tolist()):
                 if -1e-5 < count < 1e-5:
                     logging.warning('Feature %s does not occur in vector set', feature)
                 else:
                     outfile.write('%s\t%f\n' % (feature, count))
 
 
+def _open_for_writing(path, gzipped):
+    if gzipped:
+        return gzip.open(path, 'wt', encoding='utf8')
+    return open(path, 'w', encoding='utf8', buffering=2 ** 20)
+
+
+def _write_events(matrix, row_index, column_index, outfile, entries_file, entry_filter, encode, chunk_size,
+                  row_offset=0, skip_rows=frozenset()):
+    """
+    Writes the rows of a CSR matrix to an open events file, and the sum of each row that was written to an open
+    entries file. See `write_vectors_to_disk`
+    :param entries_file: open file or None
+    :param row_offset: row number of the first row of `matrix`, as used in `skip_rows`
+    :param skip_rows: row numbers (offset) not to write
+    :return: tuple of (number of entries written, number of rows accepted by the filters, sums of the columns of
+     the accepted rows)
+    """
+    written = set()
+    num_accepted = 0
+    feature_sums = np.zeros(matrix.shape[1])
+    for start in range(0, matrix.shape[0], chunk_size):
+        stop = min(start + chunk_size, matrix.shape[0])
+        indptr = np.asarray(matrix.indptr[start:stop + 1] - matrix.indptr[start])
+        cells = slice(matrix.indptr[start], matrix.indptr[stop])
+        values = matrix.data[cells]
+        indices = matrix.indices[cells]
+        keep = (values <= -0.0001) | (values >= 0.0001)  # remove almost zero feature counts
+        row_ids = np.repeat(np.arange(stop - start), np.diff(indptr))
+        kept_sums = np.bincount(row_ids[keep], weights=values[keep], minlength=stop - start).tolist()
+        # number of kept cells before the start of each row
+        kept_indptr = np.concatenate([[0], np.cumsum(keep)])[indptr]
+        # alternating feature names and values of the kept cells. Numpy formats values exactly like str() does
+        kept_cells = [None] * (2 * keep.sum())
+        kept_cells[0::2] = column_index[indices[keep]].tolist()
+        kept_cells[1::2] = values[keep].astype(str).tolist()
+        indptr, kept_indptr = indptr.tolist(), kept_indptr.tolist()
+
+        accepted = np.zeros(stop - start, dtype=bool)
+        lines, entry_lines = [], []
+        for i, row_num in enumerate(range(start, stop)):
+            if indptr[i] == indptr[i + 1]:
+                continue  # nothing stored in this row
+            entry = row_index[row_num]
+            if not entry_filter(entry) or entry in written:  # guard against duplicated vectors
+                continue
+            if row_num + row_offset in skip_rows:
+                continue
+            accepted[i] = True
+            if kept_indptr[i] == kept_indptr[i + 1]:
+                continue
+            lines.append('%s\t%s\n' % (entry, '\t'.join(kept_cells[2 * kept_indptr[i]:2 * kept_indptr[i + 1]])))
+            entry_lines.append('%s\t%f\n' % (entry, kept_sums[i]))
+            written.add(entry)
+        if lines:
+            s = ''.join(lines)
+            outfile.write(s.encode('utf8') if encode else s)
+        if entries_file is not None and entry_lines:
+            entries_file.write(''.join(entry_lines))
+
+        # column marginals of the accepted rows, including their almost zero values
+        accepted_cells = accepted[row_ids]
+        num_accepted += int(accepted.sum())
+        feature_sums += np.bincount(indices[accepted_cells], weights=values[accepted_cells],
+                                    minlength=matrix.shape[1])
+        logging.info('Processed %d vectors', stop + row_offset)
+
+    return len(written), num_accepted, feature_sums
+
+
+def _write_events_shard(matrix, row_index, column_index, path, entries_path, entry_filter, gzipped, chunk_size,
+                        row_offset, skip_rows):
+    with _open_for_writing(path, gzipped) as outfile, open(entries_path, 'w') as entries_file:
+        return _write_events(matrix, row_index, column_index, outfile, entries_file, entry_filter, False,
+                             chunk_size, row_offset=row_offset, skip_rows=skip_rows)
+
+
+def _write_events_sharded(matrix, row_index, column_index, vectors_path, entries_path, entry_filter, gzipped,
+                          chunk_size, n_jobs):
+    from joblib import Parallel, delayed, cpu_count
+
+    n_shards = cpu_count() if n_jobs < 0 else n_jobs
+    row_index = [row_index[i] for i in range(matrix.shape[0])]
+    # shards cannot see each other's entries, so deal with duplicate entries up front: only the first non-empty
+    # row of each entry is written
+    first_rows, skip_rows = set(), set()
+    for row_num in np.flatnonzero(np.diff(matrix.indptr)).tolist():
+        if row_index[row_num] in first_rows:
+            skip_rows.add(row_num)
+        first_rows.add(row_index[row_num])
+
+    bounds = np.linspace(0, matrix.shape[0], n_shards + 1).astype(int).tolist()
+    paths = ['%s.part%d' % (vectors_path, i) for i in range(n_shards)]
+    entries_paths = ['%s.entries.part%d' % (vectors_path, i) for i in range(n_shards)]
+    logging.info('Writing %d rows in %d shards', matrix.shape[0], n_shards)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_write_events_shard)(matrix[a:b], row_index[a:b], column_index, path, entries_part, entry_filter,
+                                     gzipped, chunk_size, a, skip_rows & set(range(a, b)))
+        for a, b, path, entries_part in zip(bounds, bounds[1:], paths, entries_paths))
+    # gzip files can be concatenated without decompressing them
+    concatenate_files(paths, vectors_path)
+    if entries_path:
+        concatenate_files(entries_paths, entries_path)
+    else:
+        for path in entries_paths:
+            os.unlink(path)
+
+    num_entries, num_accepted, feature_sums = zip(*results)
+    return sum(num_entries), sum(num_accepted), np.sum(feature_sums, axis=0)
+
+
+def concatenate_files(parts, output_path, remove_parts=True):
+    """
+    Concatenates the contents of several files, byte for byte. Concatenated gzip files are a valid gzip file.
+    :param parts: list of file names
+    :param output_path: where to write the result
+    :param remove_parts: whether to delete the input files afterwards
+    """
+    with open(output_path, 'wb') as outfile:
+        for part in parts:
+            with open(part, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 2 ** 20)
+            if remove_parts:
+                os.unlink(part)
+    return output_path
+
+
 def write_vectors_to_hdf(matrix, row_index, column_index, events_path):
     import pandas as pd
 
@@ -124,29 +248,261 @@ def write_vectors_to_hdf(matrix, row_index, column_index, events_path):
     df.to_hdf(events_path, 'matrix', complevel=9, complib='zlib')
 
 
-def reformat_entries(filename, suffix, function, separator='\t'):
-    # todo unit test
+def read_vectors_from_hdf(events_path, row_filter=None, chunk_size=10000):
+    """
+    Reads a dense matrix written by `write_vectors_to_hdf`. The names of the rows are read first, and only the
+    rows that pass `row_filter` are then read from disk, a chunk at a time. This is much faster than reading the
+    entire data frame when only a small vocabulary is needed. Files that do not have the single-block layout
+    pandas uses for a float matrix are read with pandas instead.
+
+    :param events_path: file to read from
+    :param row_filter: callable, takes the name of a row and returns true if the row should be loaded. Defaults
+     to loading all rows
+    :param chunk_size: number of rows to read at a time
+    :return: tuple of (numpy array, list of row names, list of column names). Rows whose name could not be
+     stored (empty strings) are dropped
+    """
+    import tables
+
+    with tables.open_file(events_path, 'r') as h5:
+        group = h5.root.matrix
+        if getattr(group._v_attrs, 'nblocks', None) != 1 or \
+                not all(getattr(getattr(group, x).attrs, 'kind', None) == 'string' for x in ['axis0', 'axis1']):
+            logging.info('Unexpected layout in %s, reading it with pandas', events_path)
+            return _read_vectors_from_hdf_with_pandas(events_path, row_filter)
+
+        encoding = getattr(group._v_attrs, 'encoding', None) or 'utf8'
+        columns = [x.decode(encoding) for x in group.axis0.read()]
+        rows = [x.decode(encoding) for x in group.axis1.read()]
+        values = group.block0_values
+        # pandas may store the columns of a block in a different order to the frame's columns
+        items = [x.decode(encoding) for x in group.block0_items.read()]
+        col_order = None if items == columns else np.array([items.index(c) for c in columns])
+
+        selected = np.array([i for i, row in enumerate(rows) if row and (row_filter is None or row_filter(row))],
+                            dtype=np.int64)
+        blocks = []
+        for start in range(0, len(rows), chunk_size):
+            stop = min(start + chunk_size, len(rows))
+            wanted = selected[np.searchsorted(selected, start):np.searchsorted(selected, stop)]
+            if len(wanted) == stop - start:
+                blocks.append(values[start:stop])
+            elif len(wanted):
+                blocks.append(values[wanted.tolist(), :])
+        matrix = np.vstack(blocks) if blocks else np.zeros((0, len(columns)), dtype=values.dtype)
+        if col_order is not None:
+            matrix = matrix[:, col_order]
+        logging.info('Read %d out of %d rows from %s', len(selected), len(rows), events_path)
+        return matrix, [rows[i] for i in selected], columns
+
+
+def _read_vectors_from_hdf_with_pandas(events_path, row_filter):
+    import pandas as pd
+
+    df = pd.read_hdf(events_path, 'matrix')
+    # pytables doesn't like unicode values and replaces them with an empty string.
+    mask = [bool(x) and (row_filter is None or row_filter(x)) for x in df.index]
+    df = df[mask]
+    return df.values, list(df.index), list(df.columns)
+
+
+def write_sparse_vectors_to_hdf(matrix, row_index, column_index, events_path, chunk_size=100000):
+    """
+    Writes a matrix in CSR form to a compressed HDF file, without converting it to a dense matrix. This works
+    for any number of columns, unlike `write_vectors_to_hdf`. The file contains a `sparse` group holding the
+    `data`, `indices` and `indptr` arrays and the names of the rows and columns, packed into UTF-8 byte arrays.
+    Requires PyTables.
+
+    :param matrix: scipy.sparse matrix or a numpy array
+    :param row_index: list of row names, str(x) is called on each one
+    :param column_index: list of column names
+    :param events_path: file to write to. Will be overwritten if it exists
+    :param chunk_size: number of rows to write at a time
+    """
+    import tables
+    from scipy.sparse import csr_matrix
+    from discoutils.shm_utils import pack_strings
+
+    matrix = csr_matrix(matrix)
+    if (len(row_index), len(column_index)) != matrix.shape:
+        raise ValueError('Matrix shape does not match row_index/column_index size')
+    logging.info('Writing sparse vectors of shape %r with %d non-zeros to %s', matrix.shape, matrix.nnz, events_path)
+    filters = tables.Filters(complevel=9, complib='zlib')
+
+    def _add_array(group, name, array):
+        out = h5.create_earray(group, name, atom=tables.Atom.from_dtype(array.dtype), shape=(0,),
+                               filters=filters, expectedrows=max(len(array), 1))
+        if len(array):
+            out.append(array)
+        return out
+
+    if os.path.exists(events_path):
+        os.unlink(events_path)
+    with tables.open_file(events_path, 'w') as h5:
+        group = h5.create_group('/', 'sparse')
+        group._v_attrs.shape = matrix.shape
+        _add_array(group, 'indptr', matrix.indptr.astype(np.int64))
+        data = _add_array(group, 'data', matrix.data[:0])
+        indices = _add_array(group, 'indices', matrix.indices[:0].astype(np.int32))
+        for start in range(0, matrix.shape[0], chunk_size):
+            lo, hi = matrix.indptr[start], matrix.indptr[min(start + chunk_size, matrix.shape[0])]
+            if hi > lo:
+                data.append(matrix.data[lo:hi])
+                indices.append(matrix.indices[lo:hi].astype(np.int32))
+        for name, strings in [('rows', row_index), ('cols', column_index)]:
+            # names are stored as text, as in all other file formats
+            blob, offsets = pack_strings([str(x) for x in strings])
+            _add_array(group, name, blob)
+            _add_array(group, name + '_offsets', offsets)
+    return events_path
+
+
+def read_sparse_vectors_from_hdf(events_path, row_filter=None, chunk_size=100000):
+    """
+    Reads a file written by `write_sparse_vectors_to_hdf`.
+
+    :param events_path: file to read from
+    :param row_filter: callable, takes the name of a row and returns true if the row should be loaded. Only the
+     parts of the file that contain the selected rows are read from disk. Defaults to loading all rows
+    :param chunk_size: number of rows to read at a time when a row filter is used
+    :return: tuple of (CSR matrix, list of row names, list of column names)
+    """
+    import tables
+    from scipy.sparse import csr_matrix, vstack
+    from discoutils.shm_utils import unpack_strings
+
+    with tables.open_file(events_path, 'r') as h5:
+        group = h5.root.sparse
+        shape = tuple(group._v_attrs.shape)
+        rows = unpack_strings(group.rows.read(), group.rows_offsets.read())
+        columns = unpack_strings(group.cols.read(), group.cols_offsets.read())
+        indptr = group.indptr.read()
+        if row_filter is None:
+            matrix = csr_matrix((group.data.read(), group.indices.read(), indptr), shape=shape)
+            return matrix, rows, columns
+
+        selected = np.array([i for i, row in enumerate(rows) if row_filter(row)], dtype=np.int64)
+        blocks = []
+        for start in range(0, shape[0], chunk_size):
+            stop = min(start + chunk_size, shape[0])
+            wanted = selected[np.searchsorted(selected, start):np.searchsorted(selected, stop)]
+            if not len(wanted):
+                continue
+            lo, hi = indptr[start], indptr[stop]
+            block = csr_matrix((group.data.read(lo, hi), group.indices.read(lo, hi), indptr[start:stop + 1] - lo),
+                               shape=(stop - start, shape[1]))
+            blocks.append(block[wanted - start])
+        matrix = vstack(blocks, format='csr') if blocks else csr_matrix((0, shape[1]), dtype=group.data.dtype)
+        logging.info('Read %d out of %d rows from %s', len(selected), shape[0], events_path)
+        return matrix, [rows[i] for i in selected], columns
+
+
+_COMPRESSED_FORMATS = {'gzip', 'zstd', 'bz2', 'xz'}
+
+
+def open_text(path, mode='r', compression=None, fmt=None):
+    """
+    Opens a text file that may be compressed with gzip, bz2, xz or zstd. Requires the `zstandard` package for zstd.
+    :param mode: 'r' or 'w'
+    :param compression: None, 'gzip', 'bz2', 'xz' or 'zstd'. Ignored when reading, as the compression of the
+     file is detected from its first few bytes
+    :param fmt: when reading, the format of the file as returned by `misc.sniff_format`, if the caller already
+     knows it. Saves reading the first few bytes of the file again
+    """
+    import io
+
+    if mode == 'r':
+        fmt = fmt or sniff_format(path)
+        if fmt in {'npy', 'npz', 'hdf'}:
+            raise ValueError('%s is a binary %s file, not a text file' % (path, fmt))
+        compression = fmt if fmt in _COMPRESSED_FORMATS else None
+    if compression is None:
+        return open(path, mode, encoding='utf8', buffering=2 ** 20)
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', encoding='utf8')
+    if compression == 'bz2':
+        import bz2
+
+        return bz2.open(path, mode + 't', encoding='utf8')
+    if compression == 'xz':
+        import lzma
+
+        return lzma.open(path, mode + 't', encoding='utf8')
+    if compression == 'zstd':
+        import zstandard
+
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(stream, encoding='utf8')
+    raise ValueError('Unknown compression %r' % compression)
+
+
+def _reformat_lines(lines, function, separator):
+    out = []
+    for line in lines:
+        entry, sep, rest = line.partition(separator)
+        if not sep:
+            # some line may contain an entry but no features
+            continue
+        out.append(function(entry) + sep + rest)
+    return ''.join(out)
+
+
+def reformat_entries(filename, suffix, function, separator='\t', n_jobs=1, chunk_size=2 ** 24,
+                     compression='same'):
     """
-    Applies a function to the first column of a file
-    :param filename: File to apply transformation to.
+    Applies a function to the first column of a file. The file is processed in chunks of lines, which can be
+    converted in parallel. The output is written in the same order as the input.
+
+    :param filename: File to apply transformation to. May be compressed, see `open_text`
     :param suffix: suffix to append to the output file
-    :param function: Function to apply, takes and returns a single string.
+    :param function: Function to apply, takes and returns a single string. Must be picklable (e.g. a module-level
+     function such as `clean`) if `n_jobs` is not 1
     :param separator: The columns in the file are separated by this.
+    :param n_jobs: number of processes to convert the lines with
+    :param chunk_size: approximate number of characters to read at a time
+    :param compression: compression of the output file- None, 'gzip', 'bz2', 'xz', 'zstd' or 'same' as the input
+     file
+    :return: name of the output file
     """
+    import time
+    from joblib import Parallel, delayed
 
-    # shutil.copy(filename, filename + '.bak')
     outname = '{}{}'.format(filename, suffix)
-    with open(filename) as infile, open(outname, 'w') as outfile:
-        for line in infile:
-            fields = line.split(separator)
-            if len(fields) < 2:
-                # some line may contain an entry but no features
-                continue
-            fields[0] = function(fields[0])
-            outfile.write(separator.join(fields))
+    fmt = sniff_format(filename)
+    if compression == 'same':
+        compression = fmt if fmt in _COMPRESSED_FORMATS else None
+
+    def _chunks(infile):
+        while True:
+            lines = infile.readlines(chunk_size)
+            if not lines:
+                return
+            yield lines
+
+    start_time, num_lines, num_chars = time.time(), 0, 0
+    with open_text(filename, fmt=fmt) as infile, open_text(outname, 'w', compression) as outfile:
+        if n_jobs == 1:
+            converted = (_reformat_lines(lines, function, separator) for lines in _chunks(infile))
+        else:
+            converted = Parallel(n_jobs=n_jobs, return_as='generator')(
+                delayed(_reformat_lines)(lines, function, separator) for lines in _chunks(infile))
+        for text in converted:
+            outfile.write(text)
+            num_lines += text.count('\n')
+            num_chars += len(text)
+            elapsed = max(time.time() - start_time, 1e-6)
+            logging.info('Reformatted %d lines, %.0f lines/s, %.1f MB/s', num_lines, num_lines / elapsed,
+                         num_chars / elapsed / 2 ** 20)
     return outname
 
 
+# Julie's relations, and whether the two words need to be swapped to put the modifier first
+_JULIE_RELATIONS = {'amod-HEAD': False, 'amod-DEP': True, 'nn-HEAD': False, 'nn-DEP': True}
+
+
 def clean(entry):
     """
     CONVERT A FILE FROM JULIE'S FORMAT TO MINE
@@ -155,17 +511,86 @@ def clean(entry):
     :param entry:
     :return:
     """
-    import re
-
-    pattern = re.compile('(\S+):(\S+):(\S+)')
-    a, relation, b = pattern.match(entry).groups()
-    if relation == 'amod-HEAD':
-        return '{}_{}'.format(a, b)
-    elif relation == 'amod-DEP':
-        return '{}_{}'.format(b, a)
-    elif relation == 'nn-HEAD':
-        return '{}_{}'.format(a, b)
-    elif relation == 'nn-DEP':
-        return '{}_{}'.format(b, a)
-    else:
+    parts = entry.rsplit(':', 2)
+    if len(parts) != 3 or not all(parts) or parts[1] not in _JULIE_RELATIONS:
         raise ValueError('Can not convert entry %s' % entry)
+    a, relation, b = parts
+    if _JULIE_RELATIONS[relation]:
+        return '{}_{}'.format(b, a)
+    return '{}_{}'.format(a, b)
+
+
+def write_csr_arrays(matrix, prefix):
+    """
+    Stores a sparse matrix as three uncompressed .npy files, `prefix.data.npy`, `prefix.indices.npy` and
+    `prefix.indptr.npy`, and its shape in `prefix.shape.npy`. Unlike `scipy.sparse.save_npz`, these files can be
+    memory-mapped with `read_csr_arrays`, so matrices larger than the available RAM can be processed in blocks.
+    """
+    from scipy.sparse import csr_matrix
+
+    matrix = csr_matrix(matrix)
+    for name in ['data', 'indices', 'indptr']:
+        np.save('%s.%s.npy' % (prefix, name), getattr(matrix, name))
+    np.save('%s.shape.npy' % prefix, np.array(matrix.shape))
+    return prefix
+
+
+def read_csr_arrays(prefix, mmap_mode='r'):
+    """
+    Reads a matrix written by `write_csr_arrays`. By default the arrays are memory-mapped, not read into memory.
+    Slicing a block of rows out of the returned matrix only reads that block from disk.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    from scipy.sparse import csr_matrix
+
+    arrays = [np.load('%s.%s.npy' % (prefix, name), mmap_mode=mmap_mode) for name in ['data', 'indices', 'indptr']]
+    shape = tuple(np.load('%s.shape.npy' % prefix))
+    return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def open_npy_vectors(events_path, row_index, column_index, dtype=np.float64):
+    """
+    Creates an empty memory-mapped matrix of vectors in numpy's .npy format, to be filled in by the caller, e.g.
+    one block of rows at a time. The names of the rows and columns are written to `events_path.rows` and
+    `events_path.cols`, one per line.
+    :return: writable memory-mapped array of shape (len(row_index), len(column_index)). Call `flush` when done.
+    """
+    for suffix, names in [('rows', row_index), ('cols', column_index)]:
+        with open('%s.%s' % (events_path, suffix), 'w', encoding='utf8') as outfile:
+            for name in names:
+                outfile.write('%s\n' % name)
+    return np.lib.format.open_memmap(events_path, mode='w+', dtype=dtype,
+                                     shape=(len(row_index), len(column_index)))
+
+
+def write_vectors_to_npy(matrix, row_index, column_index, events_path, chunk_size=10000):
+    """
+    Writes dense vectors to a .npy file that can be memory-mapped, see `open_npy_vectors`. This is
+    much faster than the other formats and does not need pandas or PyTables, but only makes sense for
+    low-dimensional dense vectors, e.g. the output of SVD.
+    :param matrix: dense or sparse matrix of size (n_entries, n_features)
+    :param row_index: list of entry names
+    :param column_index: list of feature names
+    :param chunk_size: number of rows to write at a time
+    """
+    if (len(row_index), len(column_index)) != matrix.shape:
+        raise ValueError('Matrix shape does not match row_index/column_index size')
+    logging.info('Writing vectors of shape %r to %s', matrix.shape, events_path)
+    out = open_npy_vectors(events_path, row_index, column_index, dtype=matrix.dtype)
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        out[start:start + chunk_size] = chunk.toarray() if issparse(chunk) else chunk
+    out.flush()
+    return events_path
+
+
+def read_vectors_from_npy(events_path, mmap_mode='r'):
+    """
+    Inverse of `write_vectors_to_npy`
+    :return: tuple of (memory-mapped matrix, list of row names, list of column names)
+    """
+    names = []
+    for suffix in ['rows', 'cols']:
+        with open('%s.%s' % (events_path, suffix), encoding='utf8') as infile:
+            names.append([line.rstrip('\n') for line in infile])
+    return np.load(events_path, mmap_mode=mmap_mode), names[0], names[1]
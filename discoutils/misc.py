@@ -89,31 +89,106 @@ def mkdirs_if_not_exists(dir):
         os.makedirs(dir)
 
 
-def _check_file_magic(file, magic_substr):
-    import magic
+# magic numbers of the formats `sniff_format` recognises
+_MAGIC_NUMBERS = [('gzip', b'\x1f\x8b'),
+                  ('zstd', b'\x28\xb5\x2f\xfd'),
+                  ('bz2', b'BZh'),
+                  ('xz', b'\xfd7zXZ\x00'),
+                  ('npy', b'\x93NUMPY'),
+                  ('npz', b'PK\x03\x04'),
+                  ('npz', b'PK\x05\x06'),  # empty archive
+                  ('hdf', b'\x89HDF\r\n\x1a\n')]
+# HDF5 files may start with a user block, in which case the signature is at one of these offsets
+_HDF_OFFSETS = [0, 512, 1024, 2048]
+_HEADER_SIZE = 2048 + 8
+
+
+def _read_header(path_to_file):
+    with open(os.path.realpath(path_to_file), 'rb') as infile:
+        return infile.read(_HEADER_SIZE)
+
+
+def _sniff_header(header):
+    for fmt, magic in _MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return fmt
+    for offset in _HDF_OFFSETS[1:]:
+        if header.startswith(_MAGIC_NUMBERS[-1][1], offset):
+            return 'hdf'
+    if b'\x00' in header:
+        return None
+    try:
+        header.decode('utf8')
+    except UnicodeDecodeError as e:
+        # the header may end in the middle of a multi-byte character
+        if len(header) < _HEADER_SIZE or e.start < len(header) - 3:
+            return None
+    return 'text'
+
+
+def sniff_format(path_to_file):
+    """
+    Works out the format of a file by reading its first few bytes once. Does not need libmagic. Follows symlinks.
+    :param path_to_file: may be a symlink
+    :return: 'gzip', 'zstd', 'bz2', 'xz', 'npy', 'npz' (any zip archive), 'hdf' (HDF5), 'text' (UTF-8, including
+     ASCII and empty files) or None if the file is binary, but not in any of these formats
+    """
+    return _sniff_header(_read_header(path_to_file))
+
 
+def _check_file_magic(file, magic_substr):
+    """
+    Fallback for files `sniff_format` does not recognise. Requires libmagic and python-magic, returns False if
+    they are not installed
+    """
+    try:
+        import magic
+    except ImportError:
+        return False
     return magic_substr in magic.from_file(os.path.realpath(file))
 
 
 def is_gzipped(path_to_file):
     """
-    Checks if a file is gzipped by looking at its magic number (requires libmagic). Follows symlinks.
-    Requires libmagic and python-magic
+    Checks if a file is gzipped by looking at its magic number. Follows symlinks.
     :param path_to_file: may be a symlink
     """
+    return sniff_format(path_to_file) == 'gzip'
+
+
+def is_hdf(path_to_file, fmt=None):
+    """
+    Checks if a file is a HDF store. Older HDF versions are only recognised if libmagic is available
+    :param fmt: the output of `sniff_format` for this file, if already known
+    """
+    fmt = fmt or sniff_format(path_to_file)
+    return fmt == 'hdf' or (fmt is None and _check_file_magic(path_to_file, b'Hierarchical Data Format'))
+
+
+def is_sparse_hdf(path_to_file, fmt=None):
+    """
+    Checks if a file is a HDF file written by `io_utils.write_sparse_vectors_to_hdf`. Requires PyTables
+    :param fmt: the output of `sniff_format` for this file, if already known
+    """
+    import tables
 
-    return _check_file_magic(path_to_file, b'gzip compressed data')
+    if not is_hdf(path_to_file, fmt):
+        return False
+    with tables.open_file(path_to_file, 'r') as h5:
+        return '/sparse' in h5
 
 
-def is_hdf(path_to_file):
+def is_npy(path_to_file):
     """
-    Checks if a file is a HDF store
+    Checks if a file is a numpy array stored in .npy format
     """
-    return _check_file_magic(path_to_file, b'Hierarchical Data Format')
+    return sniff_format(path_to_file) == 'npy'
 
 
 def is_plaintext(path_to_file):
     """
-    Checks if a file is ASCII plain text
+    Checks if a file is ASCII plain text. Only the first few bytes of the file are looked at. Unlike
+    `sniff_format`, this returns False for empty files and for text with non-ASCII characters
     """
-    return _check_file_magic(path_to_file, b'ASCII text')
\ No newline at end of file
+    header = _read_header(path_to_file)
+    return bool(header) and header.isascii() and _sniff_header(header) == 'text'
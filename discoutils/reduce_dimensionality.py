@@ -1,4 +1,6 @@
 from collections import Counter
+import copy
+import os
 import sys
 
 sys.path.append('.')
@@ -6,72 +8,81 @@ sys.path.append('..')
 sys.path.append('../..')
 
 import logging
-import scipy, time
+import time
 import numpy as np
-from operator import itemgetter
+from scipy.sparse import csr_matrix, issparse
 from sklearn.decomposition import TruncatedSVD
+from sklearn.utils import murmurhash3_32
+from sklearn.utils.extmath import safe_sparse_dot
 from discoutils.tokens import DocumentFeature
-from discoutils.thesaurus_loader import Vectors
-from discoutils.io_utils import write_vectors_to_hdf, write_vectors_to_disk
+from discoutils.thesaurus_loader import Vectors, DenseVectors
+from discoutils.io_utils import write_vectors_to_hdf, write_vectors_to_disk, write_vectors_to_npy, \
+    read_csr_arrays, open_npy_vectors
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+# name of each reducer in the names of output files and features
+REDUCERS = {'svd': 'SVD', 'random_projection': 'RP', 'gaussian_projection': 'GRP', 'hashing': 'HASH'}
+
 
 def filter_out_infrequent_entries(desired_counts_per_feature_type, vectors):
-    logging.info('Converting thesaurus to sparse matrix')
-    mat, cols, rows = vectors.to_sparse_matrix()
+    """
+    Keeps only the most frequent entries of each type. Frequency is measured as the sum of feature counts. This is
+    Byblo's definition of frequency (which is in fact a marginal), but it is strongly correlated with what one
+    normally thinks of as entry frequency. Columns left empty after removing rows are also removed.
+
+    :param desired_counts_per_feature_type: see `do_svd`
+    :type vectors: Vectors
+    :return: tuple of (matrix, type of each row, list of row names, list of column names)
+    """
+    if not isinstance(vectors, Vectors):
+        # a Thesaurus of feature vectors
+        vectors = Vectors(vectors._obj)
+    mat = csr_matrix(vectors.matrix)
+    rows, cols = np.array(vectors.row_names, dtype=object), np.array(vectors.columns, dtype=object)
     logging.info('Got a data matrix of shape %r', mat.shape)
-    # convert to document feature for access to PoS tag
-    document_features = [DocumentFeature.from_string(r) for r in rows]
     # don't want to do dimensionality reduction on composed vectors
-    feature_types = [sorted_idx_and_pos_matching.type for sorted_idx_and_pos_matching in document_features]
-    assert all(x == '1-GRAM' or x == 'AN' or x == 'NN' for x in feature_types), Counter(feature_types)
-    # get the PoS tags of each row in the matrix
-    pos_tags = np.array([df.tokens[0].pos if df.type == '1-GRAM' else df.type for df in document_features])
-    # find the rows of the matrix that correspond to the most frequent nouns, verbs, ...,
-    # as measured by sum of feature counts. This is Byblo's definition of frequency (which is in fact a marginal),
-    # but it is strongly correlated with one normally thinks of as entry frequency
-    desired_rows = []
+    feature_types = vectors.row_document_types()
+    supported_types = np.isin(feature_types, ['1-GRAM', 'AN', 'NN'])
+    assert supported_types.all(), Counter(feature_types[~supported_types])
+    # the PoS tag of each unigram row and the feature type of each phrase row (AN, NN, ...)
+    pos_tags = vectors.row_feature_types()
+
     if desired_counts_per_feature_type is not None:
+        row_sums = vectors.row_sums()
+        desired_rows = []
         for desired_pos, desired_count in desired_counts_per_feature_type:
-            row_of_current_pos = pos_tags == desired_pos  # what rows are the right PoS tags at, boolean mask array
-            # indices of the array sorted by row sum, and where the pos == desired_pos
-            if desired_count > 0:
-                sorted_idx_by_sum = np.ravel(mat.sum(1)).argsort()
-                row_of_current_pos = row_of_current_pos[sorted_idx_by_sum]
-                sorted_idx_and_pos_matching = sorted_idx_by_sum[row_of_current_pos]
-                # slice off the top desired_count and store them
-                desired_rows.extend(list(sorted_idx_and_pos_matching[-desired_count:]))
-            else:
+            rows_of_current_pos = np.flatnonzero(pos_tags == desired_pos)
+            if 0 < desired_count < len(rows_of_current_pos):
+                # indices of the desired_count most frequent rows of this type, in no particular order
+                top = np.argpartition(row_sums[rows_of_current_pos], -desired_count)[-desired_count:]
+                rows_of_current_pos = rows_of_current_pos[top]
+            elif desired_count <= 0:
                 # do not include
-                pass
+                rows_of_current_pos = rows_of_current_pos[:0]
+            # least frequent first, as this function has always done
+            desired_rows.append(rows_of_current_pos[np.argsort(row_sums[rows_of_current_pos], kind='stable')])
+            logging.info('Frequency filter keeping %d/%d %s entries ', len(desired_rows[-1]),
+                         (pos_tags == desired_pos).sum(), desired_pos)
 
-            logging.info('Frequency filter keeping %d/%d %s entries ', desired_count,
-                         sum(row_of_current_pos), desired_pos)
-    else:
-        logging.info('Not filtering any of the entries')
-        desired_rows = range(len(vectors))
-
-    # remove the vectors for infrequent entries, update list of pos tags too
-    if desired_counts_per_feature_type is not None:
         # if some rows have been removed update respective data structures
+        desired_rows = np.concatenate(desired_rows) if desired_rows else np.array([], dtype=int)
         mat = mat[desired_rows, :]
-        rows = itemgetter(*desired_rows)(document_features)
-        pos_tags = pos_tags[desired_rows]
+        rows, pos_tags = rows[desired_rows], pos_tags[desired_rows]
 
-        # removing rows may empty some columns, remove these as well. This is probably not very like to occur as we have
-        # already filtered out infrequent features, so the column count will stay roughly the same
-        desired_cols = np.ravel(mat.sum(0)) > 0
-        mat = mat[:, desired_cols]
-        col_indices = list(np.where(desired_cols)[0])
-        cols = itemgetter(*col_indices)(cols)
+        # removing rows may empty some columns, remove these as well. This is probably not very like to occur as we
+        # have already filtered out infrequent features, so the column count will stay roughly the same
+        desired_cols = np.flatnonzero(np.bincount(mat.indices[mat.data != 0], minlength=mat.shape[1]))
+        mat, cols = mat[:, desired_cols], cols[desired_cols]
+    else:
+        logging.info('Not filtering any of the entries')
 
     logging.info('Selected only the most frequent entries, matrix size is now %r', mat.shape)
     assert mat.shape == (len(rows), len(cols))
-    return mat, pos_tags, rows, cols
+    return mat, pos_tags, list(rows), list(cols)
 
 
 def _do_svd_single(mat, n_components):
@@ -91,29 +102,198 @@ def _do_svd_single(mat, n_components):
     return method, reduced_mat
 
 
-def _write_to_disk(reduced_mat, prefix, rows, use_hdf=True):
+class LinearProjection(object):
+    """
+    A dimensionality reduction that is just a fixed (and usually sparse) projection matrix, e.g. a random
+    projection or feature hashing. Has the same interface as a fitted `TruncatedSVD`.
+    """
+
+    def __init__(self, components, reducer='hashing'):
+        """
+        :param components: projection matrix of shape (n_components, n_features)
+        :param reducer: how the projection matrix was built, see `REDUCERS`
+        """
+        self.components_ = components
+        self.n_components = components.shape[0]
+        self.reducer = reducer
+
+    def transform(self, X):
+        return safe_sparse_dot(X, self.components_.T, dense_output=True)
+
+
+def _hashing_components(columns, n_components, seed=0):
+    """
+    Signed feature hashing (Weinberger et al, 2009), expressed as a projection matrix. Each feature is
+    hashed to one of the output dimensions, and the sign of the hash decides whether it is added or subtracted
+    there, which keeps inner products unbiased.
+    """
+    hashes = np.array([murmurhash3_32(str(c), seed=seed) for c in columns], dtype=np.int64)
+    signs = np.where(hashes >= 0, 1., -1.)
+    return csr_matrix((signs, (np.abs(hashes) % n_components, np.arange(len(columns)))),
+                      shape=(n_components, len(columns)))
+
+
+def _do_projection_single(mat, n_components, reducer, columns):
+    """
+    Reduces dimensionality with one of the reducers that do not need to learn anything from the data. This
+    amounts to a single sparse matrix product, so it runs in time linear in the number of non-zeros of `mat`.
+
+    :param reducer: one of
+        - random_projection: sparse random projection (Achlioptas, 2003), entries of the projection matrix are
+         +-sqrt(3 / n_components) with probability 1/6 each and 0 otherwise
+        - gaussian_projection: dense random projection with entries drawn from N(0, 1 / n_components)
+        - hashing: signed feature hashing of the column names
+    :param columns: names of the columns of `mat`, used by hashing
+    :return: tuple of (fitted reducer, reduced matrix)
+    """
+    from sklearn.random_projection import SparseRandomProjection, GaussianRandomProjection
+
+    start = time.time()
+    if reducer == 'random_projection':
+        method = SparseRandomProjection(n_components, density=1 / 3, dense_output=True, random_state=0).fit(mat)
+    elif reducer == 'gaussian_projection':
+        method = GaussianRandomProjection(n_components, random_state=0).fit(mat)
+    elif reducer == 'hashing':
+        method = LinearProjection(_hashing_components(columns, n_components))
+    else:
+        raise ValueError('Unknown reducer %s. Choose one of %r' % (reducer, sorted(REDUCERS)))
+    reduced_mat = np.asarray(method.transform(mat))
+    logging.info('Reduced using %s from shape %r to shape %r in %f seconds', reducer, mat.shape,
+                 reduced_mat.shape, time.time() - start)
+    return method, reduced_mat
+
+
+def _valid_sizes(reduce_to, n_features):
+    valid_sizes = []
+    for n_components in reduce_to:
+        if n_components > n_features:
+            logging.error('Cannot reduce dimensionality from %d to %d', n_features, n_components)
+        else:
+            valid_sizes.append(n_components)
+    return valid_sizes
+
+
+def _truncate_svd(method, n_components):
+    """
+    Derives a lower-dimensional SVD from one that has already been fitted. The components of a truncated SVD are
+    sorted by singular value, so the best rank-k approximation is made of the first k components of any
+    higher-rank one. The fitted estimator is not modified.
+
+    :param method: a fitted `TruncatedSVD`
+    :param n_components: number of components to keep, must not exceed those of `method`
+    :rtype: TruncatedSVD
+    """
+    if n_components > method.n_components:
+        raise ValueError('Cannot truncate SVD with %d components to %d' % (method.n_components, n_components))
+    truncated = copy.copy(method)
+    truncated.n_components = n_components
+    for attr in ['components_', 'singular_values_', 'explained_variance_', 'explained_variance_ratio_']:
+        if hasattr(method, attr):
+            setattr(truncated, attr, getattr(method, attr)[:n_components])
+    return truncated
+
+
+def _write_to_disk(reduced_mat, prefix, rows, use_hdf=True, feature_prefix='SVD', use_npy=False):
+    """
+    :param reduced_mat: dense matrix of reduced vectors
+    :param use_npy: write a memory-mappable .npy file, see `write_vectors_to_npy`. Overrides `use_hdf`
+    """
     events_file = prefix + '.events.filtered.strings'
-    if use_hdf:
-        write_vectors_to_hdf(reduced_mat, rows,
-                             ['SVD:feat{0:03d}'.format(i) for i in range(reduced_mat.shape[1])],
-                             events_file)
+    columns = ['{0}:feat{1:03d}'.format(feature_prefix, i) for i in range(reduced_mat.shape[1])]
+    if use_npy:
+        write_vectors_to_npy(reduced_mat, rows, columns, events_file)
+    elif use_hdf:
+        write_vectors_to_hdf(reduced_mat, rows, columns, events_file)
+    else:
+        write_vectors_to_disk(reduced_mat, rows, columns, events_file)
+
+
+def save_svd_model(method, columns, path, reducer='svd'):
+    """
+    Stores a fitted SVD (or another linear reducer) as plain numpy arrays. Pickling the sklearn object crashes
+    for large models (see http://bugs.python.org/issue11564) and ties the file to a version of sklearn.
+    :param method: a fitted `TruncatedSVD`, or any object with a `components_` matrix (which may be sparse)
+    :param columns: names of the features the SVD was trained on, in order
+    :param path: output file, will be in numpy's .npz format
+    :param reducer: name of the reducer, see `REDUCERS`
+    """
+    logging.info('Saving model with %d components to %s', method.components_.shape[0], path)
+    arrays = dict(columns=np.array([str(c) for c in columns]), reducer=np.array(reducer))
+    if issparse(method.components_):
+        components = csr_matrix(method.components_)
+        arrays.update(components_data=components.data, components_indices=components.indices,
+                      components_indptr=components.indptr, components_shape=np.array(components.shape))
     else:
-        write_vectors_to_disk(reduced_mat, rows,
-                              ['SVD:feat{0:03d}'.format(i) for i in range(reduced_mat.shape[1])],
-                              events_file)
+        arrays['components'] = method.components_
+    if hasattr(method, 'singular_values_'):
+        arrays['singular_values'] = method.singular_values_
+    with open(path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+
+
+def load_svd_model(path):
+    """
+    Inverse of `save_svd_model`
+    :return: tuple of (TruncatedSVD or LinearProjection, list of column names)
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        columns = archive['columns'].tolist()
+        reducer = str(archive['reducer']) if 'reducer' in archive else 'svd'
+        if 'components' in archive:
+            components = archive['components']
+        else:
+            components = csr_matrix((archive['components_data'], archive['components_indices'],
+                                     archive['components_indptr']), shape=tuple(archive['components_shape']))
+        if reducer != 'svd':
+            return LinearProjection(components, reducer=reducer), columns
+        singular_values = archive['singular_values']
+    method = TruncatedSVD(components.shape[0])
+    method.components_ = components
+    method.singular_values_ = singular_values
+    method.n_features_in_ = components.shape[1]
+    return method, columns
+
+
+def apply_svd(model_path, vectors, output_prefix=None, chunk_size=10000, use_hdf=True, use_npy=False):
+    """
+    Projects vectors into the space learnt by an SVD (or another reducer) saved by `do_svd`. Features that the
+    model has not seen are ignored. The vectors are aligned to the model's features and transformed `chunk_size`
+    rows at a time, so the only large objects in memory are the input and the output.
+
+    :param model_path: path to a model file, e.g. output_prefix-SVD100.model.npz
+    :param vectors: path to a vectors file or a `Vectors` object
+    :param output_prefix: if set, reduced vectors are also written to disk, as in `do_svd`
+    :param chunk_size: number of rows to transform in one go
+    :param use_hdf: see `do_svd`
+    :param use_npy: see `do_svd`
+    :return: the reduced vectors
+    :rtype: discoutils.thesaurus_loader.DenseVectors
+    """
+    method, model_columns = load_svd_model(model_path)
+    if not isinstance(vectors, Vectors):
+        vectors = Vectors.from_tsv(vectors, lowercasing=False)
+
+    # features the model has not seen are dropped
+    reduced_mat = np.zeros((len(vectors.row_names), method.n_components))
+    for start, chunk in vectors.iter_aligned_rows(model_columns, chunk_size):
+        reduced_mat[start:start + chunk.shape[0]] = method.transform(csr_matrix(chunk))
 
-        # disabled because it causes a crash with large objects
-        # see http://bugs.python.org/issue11564
-        # with open(model_file, 'w') as outfile:
-        #    pickle.dump(method, outfile)
+    rows = [str(r) for r in vectors.row_names]
+    feature_prefix = REDUCERS[getattr(method, 'reducer', 'svd')]
+    if output_prefix:
+        _write_to_disk(reduced_mat, output_prefix, rows, use_hdf=use_hdf, feature_prefix=feature_prefix,
+                       use_npy=use_npy)
+    columns = ['{0}:feat{1:03d}'.format(feature_prefix, i) for i in range(reduced_mat.shape[1])]
+    return DenseVectors(None, matrix=reduced_mat, columns=columns, rows=rows)
 
 
 def do_svd(input_path, output_prefix,
            desired_counts_per_feature_type=[('N', 8), ('V', 4), ('J', 4), ('RB', 2), ('AN', 2)],
-           reduce_to=[3, 10, 15], apply_to=None, write=3, use_hdf=True):
+           reduce_to=[3, 10, 15], apply_to=None, write=3, use_hdf=True, reducer='svd', use_npy=False):
     """
 
-    Performs truncated SVD. A copy of the trained sklearn SVD estimator will be also be saved
+    Performs truncated SVD. The trained model for each dimensionality is saved next to the reduced vectors,
+    e.g. as output_prefix-SVD100.model.npz, and can be applied to more vectors later with `apply_svd`
 
     :param input_path: list of files containing vectors in TSV format. All vectors will be reduced together.
     :type input_path: list of file names or a Vectors object
@@ -130,11 +310,19 @@ def do_svd(input_path, output_prefix,
     :param use_hdf: if true, store results as a pandas DF in HDF. This will enforce some constraints like not having
     duplicate entries in the index, which I deliberately break with some of the unit tests. This switch is the easiest
     way to avoid modifying the unit tests
+    :param use_npy: if true, store results as a dense .npy file with the names of rows and columns in two extra text
+     files. This is the fastest option, and the output can be memory-mapped when read back with `Vectors.from_tsv`.
+     Overrides `use_hdf`
     :type write: int
+    :param reducer: 'svd', or one of the faster data-independent reducers described in `_do_projection_single`.
+     The name of the reducer determines the name of the output files, e.g. output_prefix-RP100 for a random
+     projection to 100 dimensions. See `REDUCERS`
     :raise ValueError: If the loaded thesaurus is empty
     """
     if not 1 <= write <= 3:
         raise ValueError('value of parameter write must be 1, 2 or 3')
+    if reducer not in REDUCERS:
+        raise ValueError('Unknown reducer %s. Choose one of %r' % (reducer, sorted(REDUCERS)))
 
     if not isinstance(input_path, Vectors):
         thesaurus = Vectors.from_tsv(input_path, lowercasing=False)
@@ -145,18 +333,17 @@ def do_svd(input_path, output_prefix,
         raise ValueError('Empty thesaurus %r', input_path)
     mat, _, rows, cols = filter_out_infrequent_entries(desired_counts_per_feature_type, thesaurus)
     if apply_to:
-        cols = set(cols)
+        known_cols = set(cols)
         if not isinstance(apply_to, Vectors):
             thes_to_apply_to = Vectors.from_tsv(apply_to, lowercasing=False,
-                                                column_filter=lambda foo: foo in cols)
+                                                column_filter=lambda foo: foo in known_cols)
         else:
             thes_to_apply_to = apply_to
+        # "project" second thesaurus into space of first thesaurus to ensure shapes match
+        thes_to_apply_to = thes_to_apply_to.align_columns(cols)
         # get the names of each thesaurus entry
-        extra_rows = [x for x in thes_to_apply_to.keys()]
-        # vectorize second matrix with the vocabulary (columns) of the first thesaurus to ensure shapes match
-        # "project" second thesaurus into space of first thesaurus
-        thesaurus.v.vocabulary_ = {x: i for i, x in enumerate(list(cols))}
-        extra_matrix = thesaurus.v.transform([dict(fv) for fv in thes_to_apply_to.values()])
+        extra_rows = list(thes_to_apply_to.row_names)
+        extra_matrix = thes_to_apply_to.matrix
         # make sure the shape is right
         assert extra_matrix.shape[1] == mat.shape[1]
 
@@ -167,21 +354,212 @@ def do_svd(input_path, output_prefix,
             rows = [DocumentFeature.from_string(x) for x in extra_rows]
             # no need to do anything if write == 1
 
-    for n_components in reduce_to:
-        method, reduced_mat = _do_svd_single(mat, n_components)
-        if not method:
-            continue
-        if apply_to:
+    valid_sizes = _valid_sizes(reduce_to, mat.shape[1])
+    if not valid_sizes:
+        return
+    if reducer == 'svd':
+        # the smaller reductions are all truncations of the largest one, so only do a single (expensive) SVD
+        largest_method, largest_reduced_mat = _do_svd_single(mat, max(valid_sizes))
+        if apply_to and write > 1:
             logging.info('Applying learned SVD transform to matrix of shape %r', extra_matrix.shape)
+            largest_extra_reduced_mat = largest_method.transform(extra_matrix)
+
+    for n_components in valid_sizes:
+        if reducer == 'svd':
+            method = _truncate_svd(largest_method, n_components)
+            # transformed data is U * Sigma, so truncating the SVD just drops the trailing columns
+            reduced_mat = largest_reduced_mat[:, :n_components]
+            if apply_to and write > 1:
+                extra_reduced_mat = largest_extra_reduced_mat[:, :n_components]
+        else:
+            method, reduced_mat = _do_projection_single(mat, n_components, reducer, cols)
+            if apply_to and write > 1:
+                extra_reduced_mat = np.asarray(method.transform(extra_matrix))
+
+        if apply_to:
             # apply learned transform to new data
             if write == 3:
                 # append to old data
-                reduced_mat = np.vstack((reduced_mat, method.transform(extra_matrix)))
+                reduced_mat = np.vstack((reduced_mat, extra_reduced_mat))
             elif write == 2:
-                reduced_mat = method.transform(extra_matrix)
+                reduced_mat = extra_reduced_mat
+
+        path = '{}-{}{}'.format(output_prefix, REDUCERS[reducer], n_components)
+        _write_to_disk(reduced_mat, path, rows, use_hdf=use_hdf, feature_prefix=REDUCERS[reducer],
+                       use_npy=use_npy)
+        save_svd_model(method, cols, path + '.model.npz', reducer=reducer)
+
+
+def _row_blocks(mat, block_size):
+    for start in range(0, mat.shape[0], block_size):
+        stop = min(start + block_size, mat.shape[0])
+        yield start, stop, mat[start:stop]
+
+
+def _do_svd_out_of_core(mat, n_components, block_size=100000, n_oversamples=10, n_iter=4, random_state=0):
+    """
+    Randomized truncated SVD (Halko et al, 2011) of a matrix that is too large to fit in memory. The matrix is
+    only ever accessed one block of rows at a time, so it can be memory-mapped. Memory usage is dominated by a few
+    dense matrices of shape (n_features, n_components + n_oversamples), and one block of rows.
+
+    The range finder and the power iterations work with the right singular subspace, i.e. they repeatedly
+    compute A^T (A Q) by accumulating the contribution of each block of rows. The SVD of A projected onto that
+    subspace is then recovered from the eigendecomposition of the small matrix (AQ)^T (AQ).
+
+    :param mat: a matrix that supports slicing of rows, e.g. a CSR matrix from `read_csr_arrays`
+    :param n_components: desired dimensionality of output
+    :param block_size: number of rows to read in one go
+    :param n_oversamples: extra random vectors used to sample the range of the matrix
+    :param n_iter: number of power iterations, improves accuracy when singular values decay slowly
+    :return: a fitted `TruncatedSVD` object, whose `transform` can be applied to blocks of rows of `mat`
+    """
+    n_features = mat.shape[1]
+    n_random = min(n_components + n_oversamples, n_features)
+    Q = np.random.RandomState(random_state).normal(size=(n_features, n_random))
+    for i in range(n_iter + 1):
+        Z = np.zeros((n_features, n_random))
+        for _, _, block in _row_blocks(mat, block_size):
+            Z += block.T.dot(block.dot(Q))
+        Q, _ = np.linalg.qr(Z)
+        logging.info('Finished pass %d/%d over matrix of shape %r', i + 1, n_iter + 1, mat.shape)
+
+    gram = np.zeros((n_random, n_random))
+    for _, _, block in _row_blocks(mat, block_size):
+        projected = block.dot(Q)
+        gram += projected.T.dot(projected)
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    top = eigenvalues.argsort()[::-1][:n_components]
+    components = Q.dot(eigenvectors[:, top]).T
+    # make the signs deterministic, as sklearn does
+    signs = np.sign(components[np.arange(n_components), np.abs(components).argmax(axis=1)])
+    components *= signs[:, np.newaxis]
+
+    method = TruncatedSVD(n_components, n_iter=n_iter, n_oversamples=n_oversamples, random_state=random_state)
+    method.components_ = components
+    method.singular_values_ = np.sqrt(np.maximum(eigenvalues[top], 0))
+    method.n_features_in_ = n_features
+    return method
+
+
+def do_svd_out_of_core(input_prefix, rows, output_prefix, reduce_to=[3, 10, 15], block_size=100000,
+                       n_iter=4, random_state=0, use_npy=False):
+    """
+    Performs truncated SVD of a matrix that does not fit in memory. The matrix is memory-mapped and processed in
+    blocks of rows (see `_do_svd_out_of_core`), and the reduced vectors are appended to the output files
+    one block at a time. Unlike `do_svd`, no frequency filtering is done and the SVD cannot be applied to
+    a second matrix.
+
+    :param input_prefix: path to a matrix of counts stored with `discoutils.io_utils.write_csr_arrays`
+    :param rows: list of the names of the rows of the matrix
+    :param output_prefix: Where to output the reduced files. An extension will be added. Output is in HDF format
+     and can be read with `Vectors.from_tsv`
+    :param reduce_to: list of integers, what dimensionalities to reduce to
+    :param block_size: number of rows to read into memory at a time
+    :param n_iter: number of power iterations
+    :param use_npy: write output as memory-mapped .npy files instead of HDF, see `do_svd`
+    """
+    import pandas as pd
+
+    mat = read_csr_arrays(input_prefix)
+    if len(rows) != mat.shape[0]:
+        raise ValueError('Matrix has %d rows, but %d row names were given' % (mat.shape[0], len(rows)))
+    valid_sizes = _valid_sizes(reduce_to, mat.shape[1])
+    if not valid_sizes:
+        return
+
+    logging.info('Reducing dimensionality of matrix of shape %r out of core', mat.shape)
+    start_time = time.time()
+    method = _do_svd_out_of_core(mat, max(valid_sizes), block_size=block_size, n_iter=n_iter,
+                                 random_state=random_state)
+    logging.info('Trained SVD in %d seconds', time.time() - start_time)
+
+    paths = {n: '{}-SVD{}.events.filtered.strings'.format(output_prefix, n) for n in valid_sizes}
+    columns = {n: ['SVD:feat{0:03d}'.format(i) for i in range(n)] for n in valid_sizes}
+    if use_npy:
+        outputs = {n: open_npy_vectors(path, rows, columns[n]) for n, path in paths.items()}
+    else:
+        outputs = {n: pd.HDFStore(path, mode='w', complevel=9, complib='zlib') for n, path in paths.items()}
+        # strings in HDF tables have a fixed width, which is set when the first block is written
+        max_len = max(len(str(r)) for r in rows)
+    try:
+        for start, stop, block in _row_blocks(mat, block_size):
+            reduced_block = method.transform(block)
+            index = [str(r) for r in rows[start:stop]]
+            for n, output in outputs.items():
+                if use_npy:
+                    output[start:stop] = reduced_block[:, :n]
+                else:
+                    df = pd.DataFrame(reduced_block[:, :n], index=index, columns=columns[n])
+                    output.append('matrix', df, min_itemsize={'index': max_len})
+            logging.info('Wrote %d/%d reduced rows', stop, mat.shape[0])
+    finally:
+        for output in outputs.values():
+            if use_npy:
+                output.flush()
+            else:
+                output.close()
+    return method
+
+
+def _run_svd_configuration(shared, row_feature_types, configuration):
+    start = time.time()
+    vectors = Vectors.from_shared_memory(shared)
+    vectors._row_feature_types = row_feature_types
+    attached = time.time()
+    do_svd(vectors, **configuration)
+    timing = dict(output_prefix=configuration['output_prefix'], pid=os.getpid(),
+                  attach_seconds=attached - start, svd_seconds=time.time() - attached)
+    with open(configuration['output_prefix'] + '.timing.tsv', 'w') as outfile:
+        outfile.write('configuration\t%r\n' % (configuration,))
+        for key in ['pid', 'attach_seconds', 'svd_seconds']:
+            outfile.write('%s\t%s\n' % (key, timing[key]))
+    return timing
+
+
+def do_svd_sweep(input_path, configurations, n_jobs=1, report_path=None):
+    """
+    Runs `do_svd` with many different settings over the same input. The input is read only once and its matrix is
+    published in shared memory (see `Vectors.to_shared_memory`), so that the configurations can run in
+    parallel without each worker process reading its own copy.
+
+    Each configuration writes its outputs as usual and a timing report to output_prefix.timing.tsv.
+
+    :param input_path: file containing vectors or a Vectors object
+    :param configurations: list of dicts of keyword arguments for `do_svd`, e.g.
+     [{'output_prefix': 'out1', 'reduce_to': [100]}, {'output_prefix': 'out2', 'apply_to': 'extra.txt'}].
+     Every configuration must have a different `output_prefix`.
+    :param n_jobs: number of configurations to run concurrently, see `joblib.Parallel`
+    :param report_path: if set, a summary of the time taken by each configuration is written there
+    :return: list of timing information for each configuration
+    """
+    from joblib import Parallel, delayed
+
+    prefixes = [c.get('output_prefix') for c in configurations]
+    if None in prefixes or len(set(prefixes)) != len(prefixes):
+        raise ValueError('Each configuration needs a unique output_prefix, got %r' % prefixes)
+
+    start = time.time()
+    if not isinstance(input_path, Vectors):
+        vectors = Vectors.from_tsv(input_path, lowercasing=False)
+    else:
+        vectors = input_path
+    if not vectors:
+        raise ValueError('Empty thesaurus %r', input_path)
+    # parsing row names is slow, do it once here rather than in every job
+    row_feature_types = vectors.row_feature_types()
+    logging.info('Loaded input of shape %r in %d seconds', vectors.matrix.shape, time.time() - start)
+
+    with vectors.to_shared_memory() as shared:
+        timings = Parallel(n_jobs=n_jobs)(delayed(_run_svd_configuration)(shared, row_feature_types, config)
+                                          for config in configurations)
+    logging.info('Ran %d configurations in %d seconds', len(configurations), time.time() - start)
 
-        path = '{}-SVD{}'.format(output_prefix, n_components)
-        _write_to_disk(scipy.sparse.coo_matrix(reduced_mat), path, rows, use_hdf=use_hdf)
+    if report_path:
+        with open(report_path, 'w') as outfile:
+            outfile.write('output_prefix\tpid\tattach_seconds\tsvd_seconds\n')
+            for t in timings:
+                outfile.write('{output_prefix}\t{pid}\t{attach_seconds:.3f}\t{svd_seconds:.3f}\n'.format(**t))
+    return timings
 
 
 if __name__ == '__main__':
@@ -1,33 +1,305 @@
 __author__ = 'mmb28'
 
+import logging
+import shutil
 import numpy as np
 import scipy.sparse as sp
-import logging
+from discoutils.io_utils import read_csr_arrays, open_text
+
+SCHEMES = ('ppmi', 'sppmi', 'cds_ppmi', 'plmi', 'ttest', 'tfidf')
+
+
+def marginals(mat, block_size=None):
+    """
+    Computes everything the weighting schemes in this module need to know about a matrix of counts.
+    :type mat: scipy.sparse.csr_matrix
+    :param block_size: if set, only this many rows of the matrix are looked at in one go. Use this with
+     memory-mapped matrices (see `discoutils.io_utils.read_csr_arrays`) that do not fit in memory.
+    :return: a dict with row and column sums, the grand total, the number of rows each column
+     occurs in (document frequency) and the number of rows
+    """
+    mat = sp.csr_matrix(mat, copy=False)
+    n_rows, n_cols = mat.shape
+    row_sums = np.zeros(n_rows)
+    col_sums, col_df = np.zeros(n_cols), np.zeros(n_cols)
+    for start, stop, row_ids, col_ids, values in _row_blocks(mat, block_size):
+        row_sums[start:stop] = np.bincount(row_ids - start, values, minlength=stop - start)
+        col_sums += np.bincount(col_ids, values, minlength=n_cols)
+        col_df += np.bincount(col_ids[values != 0], minlength=n_cols)
+    return dict(row_sums=row_sums, col_sums=col_sums, total=float(row_sums.sum()), col_df=col_df, n_rows=n_rows)
+
+
+def _row_blocks(mat, block_size=None):
+    """
+    Iterates over a CSR matrix in blocks of rows. Only the current block is read into memory.
+    :return: generator of (first row, last row + 1, row index of each cell, column index of each cell, values)
+    """
+    block_size = int(block_size or max(mat.shape[0], 1))
+    for start in range(0, mat.shape[0], block_size):
+        stop = min(start + block_size, mat.shape[0])
+        indptr = np.asarray(mat.indptr[start:stop + 1])
+        row_ids = np.repeat(np.arange(start, stop), np.diff(indptr))
+        cells = slice(indptr[0], indptr[-1])
+        yield (start, stop, row_ids, np.asarray(mat.indices[cells]),
+               np.asarray(mat.data[cells], dtype=np.float64))
+
+
+def weight_values(values, row_ids, col_ids, margins, scheme='ppmi', shift=1., alpha=0.75):
+    """
+    Reweights a batch of non-zero cells of a count matrix. This is where all the schemes are defined. The work is
+    vectorised over all cells, and the same function is used for in-memory and for streamed matrices.
+
+    :param values: counts of the cells
+    :param row_ids: row index of each cell
+    :param col_ids: column index of each cell
+    :param margins: output of `marginals` for the entire matrix (not just for this batch of cells)
+    :param scheme: one of
+        - ppmi: positive pointwise mutual information
+        - sppmi: shifted PPMI, max(PMI - log(shift), 0), see Levy and Goldberg (2014)
+        - cds_ppmi: PPMI with context distribution smoothing, i.e. the column marginals are raised to the power
+         of alpha, see Levy et al (2015)
+        - plmi: positive local mutual information, count * PPMI
+        - ttest: the t-test weight used in Curran's thesis, (P(r,c) - P(r)P(c)) / sqrt(P(r)P(c)). May be negative.
+        - tfidf: count * log(number of rows / number of rows the column occurs in)
+    :param shift: shift for sppmi
+    :param alpha: smoothing exponent for cds_ppmi
+    :return: new values for the cells
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if scheme == 'tfidf':
+        return values * np.log(margins['n_rows'] / margins['col_df'][col_ids])
+
+    total = margins['total']
+    p_row = margins['row_sums'][row_ids] / total
+    if scheme == 'cds_ppmi':
+        smoothed = margins['col_sums'] ** alpha
+        p_col = smoothed[col_ids] / smoothed.sum()
+    else:
+        p_col = margins['col_sums'][col_ids] / total
+    p_joint = values / total
+
+    if scheme == 'ttest':
+        expected = p_row * p_col
+        return (p_joint - expected) / np.sqrt(expected)
+
+    pmi = np.log(p_joint / (p_row * p_col))
+    if scheme == 'sppmi':
+        pmi -= np.log(shift)
+    elif scheme not in ('ppmi', 'cds_ppmi', 'plmi'):
+        raise ValueError('Unknown weighting scheme %s. Choose one of %r' % (scheme, SCHEMES))
+    ppmi = np.maximum(pmi, 0)
+    return values * ppmi if scheme == 'plmi' else ppmi
+
+
+def reweight(mat, scheme='ppmi', margins=None, **kwargs):
+    """
+    Reweights a count matrix. The shape of the matrix is preserved, but cells whose new weight is zero are
+    removed, which may leave some columns (or rows) empty. See `reweight_vectors` if that is a problem.
+
+    :param mat: a matrix of counts
+    :type mat: scipy.sparse.csr_matrix
+    :param scheme: see `weight_values`
+    :param margins: marginals of `mat`, computed if not provided
+    :param kwargs: passed to `weight_values`
+    :rtype: scipy.sparse.csr_matrix
+    """
+    logging.info('Doing %s on matrix of size %r', scheme, mat.shape)
+    mat = sp.csr_matrix(mat, dtype=np.float64, copy=True)
+    if margins is None:
+        margins = marginals(mat)
+    row_ids = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+    mat.data = weight_values(mat.data, row_ids, mat.indices, margins, scheme=scheme, **kwargs)
+    mat.eliminate_zeros()
+    return mat
+
+
+def ppmi_sparse_matrix(mat: sp.csr_matrix):
+    """
+    Compute the PPMI values for the raw co-occurrence matrix. The shape of the matrix is preserved, so features
+    that occur with all entries and therefore get a weight of 0 are left as empty columns.
+    """
+    return reweight(mat, scheme='ppmi')
+
+
+def reweight_vectors(vectors, scheme='ppmi', **kwargs):
+    """
+    Reweights the counts in a `Vectors` object. Columns left empty by the reweighting (e.g. a feature that occurs
+    with every entry has a PPMI of 0 everywhere) are removed from the matrix and from the list of columns.
+
+    :type vectors: discoutils.thesaurus_loader.Vectors
+    :param scheme: see `weight_values`
+    :param kwargs: passed to `weight_values`
+    :return: a new `Vectors` object
+    :rtype: discoutils.thesaurus_loader.Vectors
+    """
+    from discoutils.thesaurus_loader import Vectors
+
+    mat = reweight(vectors.matrix, scheme=scheme, **kwargs)
+    nonempty = np.flatnonzero(np.bincount(mat.indices, minlength=mat.shape[1]))
+    if len(nonempty) < mat.shape[1]:
+        logging.info('%d columns are empty after %s, removing them', mat.shape[1] - len(nonempty), scheme)
+        mat = mat[:, nonempty]
+    columns = [vectors.columns[i] for i in nonempty]
+    return Vectors(None, matrix=mat, columns=columns, rows=list(vectors.row_names),
+                   allow_lexical_overlap=vectors.allow_lexical_overlap)
+
+
+def reweight_csr_arrays(input_prefix, output_prefix, scheme='ppmi', block_size=100000, **kwargs):
+    """
+    Reweights a count matrix stored with `discoutils.io_utils.write_csr_arrays` without loading it into memory.
+    The first pass over the memory-mapped input computes the marginals, the second reweights it one block
+    of rows at a time and writes the new values straight to a memory-mapped output file. Peak memory is the
+    size of the marginals plus one block.
+
+    The sparsity structure of the input is reused, so cells whose new weight is zero are kept as explicit
+    zeros. Call `eliminate_zeros` after loading the output into memory if that matters.
+
+    :param input_prefix: prefix of the input matrix files
+    :param output_prefix: prefix for the output, in the same format as the input
+    :param scheme: see `weight_values`
+    :param block_size: number of rows to reweight at a time
+    :param kwargs: passed to `weight_values`
+    :return: `output_prefix`, read it with `discoutils.io_utils.read_csr_arrays`
+    """
+    mat = read_csr_arrays(input_prefix)
+    logging.info('Streaming %s over matrix of size %r in blocks of %d rows', scheme, mat.shape, block_size)
+    margins = marginals(mat, block_size=block_size)
+
+    out = np.lib.format.open_memmap('%s.data.npy' % output_prefix, mode='w+', dtype=np.float64,
+                                    shape=mat.data.shape)
+    for start, stop, row_ids, col_ids, values in _row_blocks(mat, block_size):
+        out[mat.indptr[start]:mat.indptr[stop]] = weight_values(values, row_ids, col_ids, margins,
+                                                                scheme=scheme, **kwargs)
+    out.flush()
+    del out
+    for name in ['indices', 'indptr', 'shape']:
+        shutil.copyfile('%s.%s.npy' % (input_prefix, name), '%s.%s.npy' % (output_prefix, name))
+    return output_prefix
+
+
+def _read_event_blocks(events_file, block_size):
+    """
+    Reads a Byblo events file (entry, then feature-count pairs, tab-separated) a few lines at a time
+    :return: generator of lists of at most `block_size` (entry, list of features, list of counts) tuples
+    """
+    block = []
+    with open_text(events_file) as infile:
+        for line in infile:
+            tokens = line.strip().split('\t')
+            if len(tokens) % 2 == 0:
+                logging.warning('Skipping dodgy line in events file: %s\n %s', events_file, line)
+                continue
+            block.append((tokens[0], tokens[1::2], [float(x) for x in tokens[2::2]]))
+            if len(block) >= block_size:
+                yield block
+                block = []
+    if block:
+        yield block
+
+
+def _block_cells(block, entry_index, feature_index):
+    """
+    Turns a block of lines from `_read_event_blocks` into the cells of a count matrix. Entries and features that
+    have not been seen before are added to the end of `entry_index` and `feature_index`
+    :return: tuple of (row index of each cell, column index of each cell, values)
+    """
+    row_ids = np.repeat([entry_index.setdefault(entry, len(entry_index)) for entry, _, _ in block],
+                        [len(features) for _, features, _ in block])
+    col_ids = np.array([feature_index.setdefault(f, len(feature_index))
+                        for _, features, _ in block for f in features], dtype=np.int64)
+    values = np.array([x for _, _, counts in block for x in counts], dtype=np.float64)
+    return row_ids, col_ids, values
+
+
+def events_file_marginals(events_file, block_size=100000):
+    """
+    Computes the marginals of the count matrix stored in a Byblo events file without building the matrix.
+    Entries that occur on several lines are counted as one row, so their counts are summed, and a feature
+    of such an entry only adds one to the document frequency of the feature.
+
+    The file is read once, plus one more time if an entry occurs in more than one block of lines. The second
+    pass only collects the features of those entries to correct the document frequencies.
+
+    :return: tuple of (marginals as returned by `marginals`, dict entry -> row index, dict feature -> column index)
+    """
+    entry_index, feature_index = {}, {}
+    row_sums, col_sums, col_df = np.zeros(0), np.zeros(0), np.zeros(0)
+    last_block, in_many_blocks = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    for block_num, block in enumerate(_read_event_blocks(events_file, block_size)):
+        row_ids, col_ids, values = _block_cells(block, entry_index, feature_index)
+        n_rows, n_cols = len(entry_index), len(feature_index)
+
+        row_sums = _grow(row_sums, n_rows)
+        col_sums, col_df = _grow(col_sums, n_cols), _grow(col_df, n_cols)
+        row_sums += np.bincount(row_ids, values, minlength=n_rows)
+        col_sums += np.bincount(col_ids, values, minlength=n_cols)
+        # each (entry, feature) pair of this block is only counted once
+        pairs = np.unique(row_ids[values != 0] * n_cols + col_ids[values != 0])
+        col_df += np.bincount(pairs % n_cols, minlength=n_cols)
+
+        last_block = np.concatenate([last_block, np.full(n_rows - len(last_block), -1)])
+        in_many_blocks = _grow(in_many_blocks, n_rows)
+        rows = np.unique(row_ids)
+        in_many_blocks[rows[(last_block[rows] >= 0) & (last_block[rows] != block_num)]] = True
+        last_block[rows] = block_num
+
+    if in_many_blocks.any():
+        logging.info('%d entries occur in more than one block, correcting document frequencies',
+                     in_many_blocks.sum())
+        n_cols, counted = len(feature_index), []
+        for block in _read_event_blocks(events_file, block_size):
+            row_ids, col_ids, values = _block_cells(block, entry_index, feature_index)
+            keep = in_many_blocks[row_ids] & (values != 0)
+            counted.append(np.unique(row_ids[keep] * n_cols + col_ids[keep]))
+        counted = np.concatenate(counted)
+        col_df -= np.bincount(counted % n_cols, minlength=n_cols) - \
+                  np.bincount(np.unique(counted) % n_cols, minlength=n_cols)
+
+    margins = dict(row_sums=row_sums, col_sums=col_sums, total=float(row_sums.sum()), col_df=col_df,
+                   n_rows=len(entry_index))
+    return margins, entry_index, feature_index
+
+
+def _grow(arr, size):
+    return np.concatenate([arr, np.zeros(size - len(arr), dtype=arr.dtype)]) if size > len(arr) else arr
+
+
+def reweight_events_file(events_file, output_file, scheme='ppmi', block_size=100000, gzipped=False, **kwargs):
+    """
+    Reweights a Byblo events file that is too big to load as a `Vectors` object. The file is read twice: once
+    to compute the marginals (see `events_file_marginals`), and once more to reweight `block_size` lines at a
+    time. The output is in the same format as the input, and values are formatted like `write_vectors_to_disk`
+    does. Features whose new weight is almost zero are dropped, as are lines left with no features. Peak memory
+    is bounded by the size of the marginals (incl. the entry and feature vocabularies) plus one block.
+
+    Entries that occur on several lines are reweighted using their total counts, but are written out on
+    separate lines as in the input.
+
+    :param events_file: input file, may be compressed (see `io_utils.open_text`)
+    :param output_file: where to write the reweighted events
+    :param scheme: see `weight_values`
+    :param block_size: number of lines to reweight at a time
+    :param gzipped: whether to compress the output
+    :param kwargs: passed to `weight_values`
+    """
+    margins, entry_index, feature_index = events_file_marginals(events_file, block_size=block_size)
+    logging.info('Streaming %s over %d entries and %d features from %s', scheme, len(entry_index),
+                 len(feature_index), events_file)
 
+    with open_text(output_file, 'w', compression='gzip' if gzipped else None) as outfile:
+        for block in _read_event_blocks(events_file, block_size):
+            row_ids, col_ids, values = _block_cells(block, entry_index, feature_index)
+            weights = weight_values(values, row_ids, col_ids, margins, scheme=scheme, **kwargs)
+            # same as in `io_utils._write_events`
+            keep = ((weights <= -0.0001) | (weights >= 0.0001)).tolist()
+            weights = weights.astype(str).tolist()
 
-def ppmi_sparse_matrix(mat:sp.csr_matrix):
-    """
-    Source: https://github.com/Bollegala/svdmi/blob/master/src/svdmi.py
-    Compute the PPMI values for the raw co-occurrence matrix.
-    PPMI values will be written to mat and it will get overwritten.
-    """
-    logging.info('Doing PPMI on matrix of size %r', mat.shape)
-    (nrows, ncols) = mat.shape
-    col_totals = np.zeros(ncols, dtype=np.float)
-    for j in range(0, ncols):
-        col_totals[j] = np.sum(mat[:, j].data)
-    N = np.sum(col_totals)
-    for i in range(0, nrows):
-        row = mat[i, :]
-        rowTotal = np.sum(row.data)
-        for j in row.indices:
-            val = np.log((mat[i, j] * N) / (rowTotal * col_totals[j]))
-            mat[i, j] = max(0, val)
-    res = sp.csr_matrix(mat)  # make a new matrix to remove any zeroes that were just created
-    if res.shape != mat.shape:
-        # this may happen if a feature occurs with all entries, so its PPMI weight will be 0 and
-        # it will effectively be removed from the list of features (vocabulary). This is problematics because the
-        # vocabulary is not updated here.
-        logging.error('Shape after PPMI is %r', res.shape)
-        raise ValueError('PPMI changed shape of matrix!')
-    return res
\ No newline at end of file
+            lines, offset = [], 0
+            for entry, features, _ in block:
+                end = offset + len(features)
+                pairs = ['%s\t%s' % (f, w) for f, w, k in zip(features, weights[offset:end], keep[offset:end]) if k]
+                offset = end
+                if pairs:
+                    lines.append('%s\t%s\n' % (entry, '\t'.join(pairs)))
+            outfile.write(''.join(lines))
+    return output_file
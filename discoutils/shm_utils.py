@@ -0,0 +1,143 @@
+import logging
+import weakref
+import numpy as np
+
+__author__ = 'mmb28'
+
+
+def _tracker_pid():
+    """
+    Process id of the resource tracker of this process, which is shared with the parent process if this
+    process was started by `multiprocessing` or joblib
+    """
+    from multiprocessing import resource_tracker
+
+    return getattr(resource_tracker._resource_tracker, '_pid', None)
+
+
+def _attach_block(name, owner_tracker_pid):
+    """
+    Attaches to an existing shared memory block without taking ownership of it. Python's resource tracker
+    assumes whoever opens a block owns it and unlinks it when that process exits, which would pull the rug from
+    under the real owner (see http://bugs.python.org/issue38119). Before Python 3.13 the block can not be opened
+    without registering it, so the registration is undone afterwards, but only if this process has a tracker of
+    its own. Worker processes usually share the owner's tracker, which keeps a single registration per block,
+    so unregistering there would remove the owner's.
+    :param owner_tracker_pid: `_tracker_pid()` in the process that created the block
+    """
+    from multiprocessing import shared_memory, resource_tracker
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # python 3.13+
+    except TypeError:
+        pass
+    shm = shared_memory.SharedMemory(name=name)
+    pid = _tracker_pid()
+    # processes started with spawn or forkserver are handed the owner's tracker without its process id
+    if pid is not None and pid != owner_tracker_pid:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def pack_strings(strings):
+    """
+    Packs a list of strings into a single UTF-8 byte array and an array of offsets. This is much more compact
+    than a list of python str objects and can be placed in shared memory.
+    :return: tuple of (blob, offsets), string i is blob[offsets[i]:offsets[i + 1]]
+    """
+    encoded = []
+    for s in strings:
+        if not isinstance(s, str):
+            # converting it would silently change its type when unpacked
+            raise ValueError('Can only pack strings, got %r' % (s,))
+        encoded.append(s.encode('utf8'))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def unpack_strings(blob, offsets):
+    """
+    Inverse of `pack_strings`
+    """
+    data = bytes(blob)
+    return [data[offsets[i]:offsets[i + 1]].decode('utf8') for i in range(len(offsets) - 1)]
+
+
+class SharedArrays(object):
+    """
+    A collection of named numpy arrays published in `multiprocessing.shared_memory` blocks. The object that
+    created the blocks owns them and unlinks them when `close` is called, when it is garbage collected or when
+    the interpreter exits, whichever happens first.
+
+    Pickling this object (e.g. to send it to a joblib worker) only transfers the names, shapes and dtypes of
+    the blocks. Use `attach` in the worker to get zero-copy views of the arrays.
+    """
+
+    def __init__(self, arrays, **metadata):
+        """
+        :param arrays: dict of name -> numpy array. Arrays are copied into shared memory
+        :param metadata: any other small picklable values that should travel with the arrays
+        """
+        from multiprocessing import shared_memory
+
+        self.metadata = metadata
+        self.specs = {}
+        self._blocks = []
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            # zero-sized blocks are not allowed
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self.specs[key] = (shm.name, arr.shape, arr.dtype.str)
+            self._blocks.append(shm)
+        self.tracker_pid = _tracker_pid()
+        logging.info('Published %d arrays (%d bytes) to shared memory', len(self.specs),
+                     sum(shm.size for shm in self._blocks))
+        self._finalizer = weakref.finalize(self, _release_blocks, self._blocks)
+
+    @property
+    def is_owner(self):
+        return bool(self._blocks)
+
+    def attach(self):
+        """
+        Maps the shared arrays into this process
+        :return: a tuple of (dict of name -> numpy array, list of `SharedMemory` objects). The latter must be
+         kept alive for as long as the arrays are in use.
+        """
+        arrays, blocks = {}, []
+        for key, (name, shape, dtype) in self.specs.items():
+            shm = _attach_block(name, self.tracker_pid)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            blocks.append(shm)
+        return arrays, blocks
+
+    def close(self):
+        """
+        Releases the shared memory. Only has an effect in the process that created the blocks. Workers
+        that are still attached keep their mapping until they exit.
+        """
+        self._finalizer()
+
+    def __getstate__(self):
+        return {'metadata': self.metadata, 'specs': self.specs, 'tracker_pid': self.tracker_pid}
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._blocks = []
+        self._finalizer = weakref.finalize(self, _release_blocks, self._blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _release_blocks(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+    del blocks[:]
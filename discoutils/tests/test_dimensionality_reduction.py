@@ -2,7 +2,10 @@ import pytest
 import numpy as np
 import scipy.sparse as sp
 
-from discoutils.reduce_dimensionality import _do_svd_single, filter_out_infrequent_entries, do_svd
+from discoutils.io_utils import write_csr_arrays, read_csr_arrays
+from discoutils.reduce_dimensionality import (_do_svd_single, _truncate_svd, filter_out_infrequent_entries, do_svd,
+                                              _do_svd_out_of_core, do_svd_out_of_core, apply_svd, load_svd_model,
+                                              do_svd_sweep, _hashing_components, _do_projection_single)
 from discoutils.thesaurus_loader import Vectors
 from discoutils.tests.test_thesaurus import thesaurus_c # this is used, do not remove
 
@@ -37,6 +40,88 @@ def test_do_svd_single_sparse(sparse_matrix):
     test_do_svd_single_dense(sparse_matrix)
 
 
+def test_truncate_svd():
+    # a matrix of rank 20, where a randomized SVD is exact
+    rng = np.random.RandomState(0)
+    mat = rng.random_sample((DIM, 20)).dot(rng.random_sample((20, DIM)))
+    big, reduced = _do_svd_single(mat, 20)
+    for i in [5, 10, 20]:
+        small = _truncate_svd(big, i)
+        assert small.components_.shape == (i, DIM)
+        np.testing.assert_array_almost_equal(small.transform(mat), reduced[:, :i])
+        _, reduced_directly = _do_svd_single(mat, i)
+        # components are only unique up to sign, and randomized SVD is only accurate up to a tolerance
+        np.testing.assert_allclose(np.abs(reduced_directly), np.abs(reduced[:, :i]), atol=0.05)
+    # original SVD not modified
+    assert big.components_.shape == (20, DIM)
+    with pytest.raises(ValueError):
+        _truncate_svd(big, 21)
+
+
+def test_do_svd_multiple_sizes(tmpdir):
+    tmpfile = str(tmpdir.join('tmp.thesaurus'))
+    do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reduce_to=[1, 2, 3, 1000],
+           desired_counts_per_feature_type=None, use_hdf=False)
+    vectors = {i: Vectors.from_tsv('%s-SVD%d.events.filtered.strings' % (tmpfile, i)) for i in [1, 2, 3]}
+    assert not tmpdir.join('tmp.thesaurus-SVD1000.events.filtered.strings').exists()
+    for i, v in vectors.items():
+        assert v.matrix.shape[1] == i
+    # smaller reductions are a prefix of the larger ones
+    for entry in vectors[3].keys():
+        np.testing.assert_array_almost_equal(vectors[2].get_vector(entry).A,
+                                             vectors[3].get_vector(entry).A[:, :2])
+
+
+@pytest.fixture(scope='module')
+def low_rank_matrix():
+    rng = np.random.RandomState(0)
+    a = rng.random_sample((DIM, 10)).dot(rng.random_sample((10, 2 * DIM)))
+    a[a < 2] = 0
+    return sp.csr_matrix(a)
+
+
+def test_do_svd_out_of_core(low_rank_matrix, tmpdir):
+    write_csr_arrays(low_rank_matrix, str(tmpdir.join('counts')))
+    mat = read_csr_arrays(str(tmpdir.join('counts')))
+    method = _do_svd_out_of_core(mat, 5, block_size=7)
+    expected = np.linalg.svd(low_rank_matrix.A, compute_uv=False)[:5]
+    np.testing.assert_allclose(method.singular_values_, expected, rtol=1e-3)
+    reduced = method.transform(mat)
+    assert reduced.shape == (DIM, 5)
+    _, in_memory = _do_svd_single(low_rank_matrix, 5)
+    # components are only unique up to sign
+    np.testing.assert_allclose(np.abs(reduced), np.abs(in_memory), rtol=1e-2, atol=1e-2)
+
+
+def test_do_svd_out_of_core_writes_npy(low_rank_matrix, tmpdir):
+    write_csr_arrays(low_rank_matrix, str(tmpdir.join('counts')))
+    rows = ['%s/N' % ''.join(chr(ord('a') + int(d)) for d in str(i)) for i in range(DIM)]
+    prefix = str(tmpdir.join('reduced'))
+    method = do_svd_out_of_core(str(tmpdir.join('counts')), rows, prefix, reduce_to=[2, 5], block_size=30,
+                                use_npy=True)
+    for n in [2, 5]:
+        v = Vectors.from_tsv('%s-SVD%d.events.filtered.strings' % (prefix, n))
+        assert list(v.row_names) == rows
+        assert list(v.columns) == ['SVD:feat%03d' % i for i in range(n)]
+        np.testing.assert_array_almost_equal(v.matrix, method.transform(low_rank_matrix)[:, :n])
+
+
+def test_do_svd_out_of_core_writes_hdf(low_rank_matrix, tmpdir):
+    write_csr_arrays(low_rank_matrix, str(tmpdir.join('counts')))
+    rows = ['%s/N' % ''.join(chr(ord('a') + int(d)) for d in str(i)) for i in range(DIM)]
+    prefix = str(tmpdir.join('reduced'))
+    with pytest.raises(ValueError):
+        do_svd_out_of_core(str(tmpdir.join('counts')), rows[1:], prefix)
+    method = do_svd_out_of_core(str(tmpdir.join('counts')), rows, prefix, reduce_to=[2, 5, 1000], block_size=30)
+
+    import pandas as pd
+    for n in [2, 5]:
+        df = pd.read_hdf('%s-SVD%d.events.filtered.strings' % (prefix, n), 'matrix')
+        assert list(df.index) == rows
+        np.testing.assert_array_almost_equal(df.values, method.transform(low_rank_matrix)[:, :n])
+    assert not tmpdir.join('reduced-SVD1000.events.filtered.strings').exists()
+
+
 @pytest.mark.parametrize(
     ('first', 'second', 'exp_row_len'),
     (
@@ -67,6 +152,32 @@ def test_application_after_learning(tmpdir, first, second, exp_row_len):
     assert mat.shape == (exp_row_len, 2)
 
 
+def test_apply_saved_svd(tmpdir):
+    tmpfile = str(tmpdir.join('tmp.thesaurus'))
+    do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reduce_to=[2, 3],
+           desired_counts_per_feature_type=None, use_hdf=False)
+    method, columns = load_svd_model(tmpfile + '-SVD2.model.npz')
+    assert method.components_.shape == (2, len(columns))
+
+    # applying the saved model to the training data reproduces the output of do_svd
+    reduced = Vectors.from_tsv(tmpfile + '-SVD2.events.filtered.strings')
+    applied = apply_svd(tmpfile + '-SVD2.model.npz', 'discoutils/tests/resources/exp0-0c.strings',
+                        output_prefix=str(tmpdir.join('applied')), chunk_size=2, use_hdf=False)
+    assert set(applied.keys()) == set(reduced.keys())
+    for entry in reduced.keys():
+        np.testing.assert_array_almost_equal(applied.matrix[applied.name2row[entry]], reduced.get_vector(entry).A[0])
+    from_disk = Vectors.from_tsv(str(tmpdir.join('applied.events.filtered.strings')))
+    assert set(from_disk.keys()) == set(reduced.keys())
+
+    # unseen features are ignored, order of features does not matter
+    v = Vectors({'x/N': [('not-seen', 100), (columns[1], 2), (columns[0], 1)]})
+    # rows are aligned a chunk at a time, the whole matrix is never copied into the model's feature space
+    v.align_columns = None
+    applied = apply_svd(tmpfile + '-SVD2.model.npz', v)
+    expected = method.components_[:, :2].dot([1, 2])
+    np.testing.assert_array_almost_equal(applied.matrix[applied.name2row['x/N']], expected)
+
+
 def test_application_after_learning_with_selective_write(tmpdir):
     """
     Test if when SVD is trained on matrix A and applied to matrix B, and
@@ -114,3 +225,119 @@ def _read_and_strip_lines(input_file):
     lines = map(str.strip, lines)
     lines = [x for x in lines if x]
     return lines
+
+
+def test_filter_out_infrequent_entries_keeps_most_frequent():
+    # entry frequency is the sum of its feature counts
+    v = Vectors({'a/N': [('f', 1)], 'b/N': [('f', 5)], 'c/N': [('f', 3)],
+                 'd/V': [('f', 2), ('g', 2)], 'e/V': [('g', 1)],
+                 'big/N_cat/N': [('h', 10)]})
+    assert list(v.row_sums()) == [v.get_vector(r).sum() for r in v.row_names]
+
+    mat, pos_tags, rows, cols = filter_out_infrequent_entries([('N', 2), ('V', 5), ('NN', 0)], v)
+    # least frequent first within each type
+    assert rows == ['c/N', 'b/N', 'e/V', 'd/V']
+    assert list(pos_tags) == ['N', 'N', 'V', 'V']
+    # column h belonged to the removed NN entry only
+    assert sorted(cols) == ['f', 'g']
+    assert mat.shape == (4, 2)
+    assert mat[rows.index('d/V'), cols.index('g')] == 2
+
+    mat, pos_tags, rows, cols = filter_out_infrequent_entries(None, v)
+    assert mat.shape == (6, 3)
+    assert set(rows) == set(v.keys())
+
+
+@pytest.mark.parametrize(('entry', 'doc_type'), [('eat/V_cat/N', 'VO'), ('cat/N_eat/V_fish/N', 'SVO'),
+                                                  ('cat/N_eat/V', '2-GRAM'), ('big/J_black/J_cat/N', '3-GRAM')])
+def test_filter_out_infrequent_entries_rejects_composed_entries(entry, doc_type):
+    # only unigrams, AN and NN entries are supported
+    v = Vectors({'a/N': [('f', 1)], 'big/J_cat/N': [('f', 2)], entry: [('g', 3)]})
+    assert dict(zip(v.row_names, v.row_document_types())) == {'a/N': '1-GRAM', 'big/J_cat/N': 'AN', entry: doc_type}
+    with pytest.raises(AssertionError):
+        filter_out_infrequent_entries(None, v)
+
+
+def test_do_svd_sweep(tmpdir):
+    prefix = str(tmpdir.join('out'))
+    configurations = [dict(output_prefix=prefix + 'A', reduce_to=[2], use_hdf=False),
+                      dict(output_prefix=prefix + 'B', reduce_to=[1, 3], use_hdf=False,
+                           desired_counts_per_feature_type=[('N', 2), ('V', 2), ('J', 2), ('AN', 2)],
+                           apply_to='discoutils/tests/resources/exp0-0b.strings')]
+    with pytest.raises(ValueError):
+        do_svd_sweep('discoutils/tests/resources/exp0-0c.strings', configurations + configurations[:1])
+
+    timings = do_svd_sweep('discoutils/tests/resources/exp0-0c.strings', configurations, n_jobs=2,
+                           report_path=str(tmpdir.join('report.tsv')))
+    assert [t['output_prefix'] for t in timings] == [prefix + 'A', prefix + 'B']
+    assert len(tmpdir.join('report.tsv').readlines()) == 3
+
+    # same output as running each configuration on its own
+    for config, suffix in zip(configurations, ['A-SVD2', 'B-SVD3']):
+        assert tmpdir.join('out%s.events.filtered.strings' % suffix).exists()
+        assert tmpdir.join('out%s.timing.tsv' % config['output_prefix'][-1]).exists()
+        config['output_prefix'] = str(tmpdir.join('sequential'))
+        do_svd('discoutils/tests/resources/exp0-0c.strings', **config)
+        n = suffix.split('SVD')[1]
+        expected = Vectors.from_tsv(str(tmpdir.join('sequential-SVD%s.events.filtered.strings' % n)))
+        actual = Vectors.from_tsv(str(tmpdir.join('out%s.events.filtered.strings' % suffix)))
+        assert set(actual.keys()) == set(expected.keys())
+        for entry in expected.keys():
+            np.testing.assert_array_almost_equal(np.abs(actual.get_vector(entry).A),
+                                                 np.abs(expected.get_vector(entry).A))
+
+
+def test_hashing_components():
+    columns = ['f%s' % c for c in 'abcdefghijklmnopqrstuvwxyz']
+    components = _hashing_components(columns, 5)
+    assert components.shape == (5, len(columns))
+    # every feature goes to exactly one output dimension, with weight +-1
+    assert (np.diff(components.tocsc().indptr) == 1).all()
+    assert set(np.abs(components.data)) == {1}
+    # the hashing depends on the names of the features, not on their order
+    reordered = _hashing_components(columns[::-1], 5)
+    np.testing.assert_array_equal(reordered.A[:, ::-1], components.A)
+
+
+@pytest.mark.parametrize('reducer', ['random_projection', 'gaussian_projection', 'hashing'])
+def test_projection_reducers(sparse_matrix, reducer):
+    method, reduced = _do_projection_single(sparse_matrix, 20, reducer, list(range(DIM)))
+    assert reduced.shape == (DIM, 20)
+    expected = sparse_matrix.dot(method.components_.T)
+    np.testing.assert_array_almost_equal(reduced, expected.A if sp.issparse(expected) else expected)
+
+
+@pytest.mark.parametrize(('reducer', 'name'), [('random_projection', 'RP'), ('hashing', 'HASH')])
+def test_do_svd_with_other_reducers(tmpdir, reducer, name):
+    tmpfile = str(tmpdir.join('tmp.thesaurus'))
+    do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reduce_to=[2, 3], reducer=reducer,
+           desired_counts_per_feature_type=None, use_hdf=False)
+    reduced = Vectors.from_tsv('%s-%s3.events.filtered.strings' % (tmpfile, name))
+    assert all(c.startswith(name + ':') for c in reduced.columns)
+
+    applied = apply_svd('%s-%s3.model.npz' % (tmpfile, name), 'discoutils/tests/resources/exp0-0c.strings')
+    assert list(applied.columns) == ['%s:feat%03d' % (name, i) for i in range(3)]
+    for entry in reduced.keys():
+        # the output files do not contain features with a value of 0
+        expected = dict(zip(applied.columns, applied.matrix[applied.name2row[entry]]))
+        assert dict(reduced[entry]) == pytest.approx({k: v for k, v in expected.items() if abs(v) > 1e-4})
+
+    with pytest.raises(ValueError):
+        do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reducer='magic')
+
+
+def test_do_svd_writes_npy(tmpdir):
+    tmpfile = str(tmpdir.join('tmp.thesaurus'))
+    do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reduce_to=[2],
+           desired_counts_per_feature_type=None, use_npy=True)
+    dense = Vectors.from_tsv(tmpfile + '-SVD2.events.filtered.strings')
+    assert isinstance(dense.matrix, np.memmap)
+
+    # the dense output is memory-mapped, do not overwrite it
+    tmpfile = str(tmpdir.join('tmp.sparse.thesaurus'))
+    do_svd('discoutils/tests/resources/exp0-0c.strings', tmpfile, reduce_to=[2],
+           desired_counts_per_feature_type=None, use_hdf=False)
+    sparse = Vectors.from_tsv(tmpfile + '-SVD2.events.filtered.strings')
+    assert set(dense.keys()) == set(sparse.keys())
+    for entry in sparse.keys():
+        np.testing.assert_array_almost_equal(dense.get_vector(entry).A, sparse.get_vector(entry).A)
@@ -1,10 +1,14 @@
 import os
 import pytest
+import numpy as np
 import scipy.sparse as sp
 
 from discoutils.tokens import DocumentFeature
 from discoutils.tests.test_dimensionality_reduction import _read_and_strip_lines
-from discoutils.io_utils import write_vectors_to_disk
+from discoutils.io_utils import write_vectors_to_disk, write_vectors_to_npy, read_vectors_from_npy, \
+    write_sparse_vectors_to_hdf, read_sparse_vectors_from_hdf, write_vectors_to_hdf, read_vectors_from_hdf, \
+    reformat_entries, clean, open_text
+from discoutils.misc import is_sparse_hdf, sniff_format
 from discoutils.tests.test_thesaurus import thesaurus_c # this is used, do not remove
 
 
@@ -71,4 +75,152 @@ def test_write_vectors_to_disk(resources, tmpdir):
             features = [x.split('\t')[0] for x in _read_and_strip_lines(features_file)]
             assert features == expected_features
         else:
-            assert not os.path.exists(features_file)
\ No newline at end of file
+            assert not os.path.exists(features_file)
+
+
+@pytest.mark.parametrize('fmt', ['coo', 'shuffled_coo', 'csr', 'dense', 'gzip'])
+def test_write_vectors_to_disk_matrix_formats(tmpdir, fmt):
+    import gzip
+
+    matrix = np.array([[1, 0, 2.5], [0, 0, 0], [0.00001, 0, 0], [3, -4, 0]])
+    rows = [DocumentFeature.from_string(x) for x in ['a/N', 'b/N', 'c/V', 'd/J']]
+    cols = ['f1', 'f2', 'f3']
+    events_file = str(tmpdir.join('events.txt'))
+    entries_file = str(tmpdir.join('entries.txt'))
+    features_file = str(tmpdir.join('features.txt'))
+
+    if fmt == 'dense':
+        m = matrix
+    elif fmt == 'csr':
+        m = sp.csr_matrix(matrix)
+    else:
+        m = sp.coo_matrix(matrix)
+        if fmt == 'shuffled_coo':
+            order = np.random.RandomState(0).permutation(m.nnz)
+            m = sp.coo_matrix((m.data[order], (m.row[order], m.col[order])), shape=m.shape)
+    write_vectors_to_disk(m, rows, cols, events_file, features_path=features_file, entries_path=entries_file,
+                          gzipped=fmt == 'gzip', chunk_size=3)
+
+    with (gzip.open(events_file, 'rt') if fmt == 'gzip' else open(events_file)) as infile:
+        # rows that are empty or only contain near-zero values are not written
+        assert infile.read() == 'a/N\tf1\t1.0\tf3\t2.5\nd/J\tf1\t3.0\tf2\t-4.0\n'
+    entries = dict(x.split('\t') for x in _read_and_strip_lines(entries_file))
+    assert entries == {'a/N': '3.500000', 'd/J': '-1.000000'}
+    # near-zero values are not written, but still count towards the feature totals
+    features = dict(x.split('\t') for x in _read_and_strip_lines(features_file))
+    assert features == {'f1': '4.000010', 'f2': '-4.000000', 'f3': '2.500000'}
+
+
+@pytest.mark.parametrize('gzipped', [True, False])
+def test_write_vectors_to_disk_in_shards(tmpdir, gzipped):
+    import gzip
+
+    matrix = sp.random(50, 10, density=0.3, format='csr', random_state=0)
+    names = ['%s/N' % x for x in 'abcdefghijklmnopqrstuvwxy'] * 2  # every entry occurs twice
+    rows = [DocumentFeature.from_string(x) for x in names]
+    cols = ['f%d' % i for i in range(10)]
+
+    outputs = []
+    for n_jobs in [1, 3]:
+        paths = [str(tmpdir.join('%s%d.txt' % (kind, n_jobs))) for kind in ['events', 'features', 'entries']]
+        write_vectors_to_disk(matrix, rows, cols, *paths, gzipped=gzipped, chunk_size=7, n_jobs=n_jobs)
+        with (gzip.open(paths[0], 'rt') if gzipped else open(paths[0])) as infile:
+            outputs.append([infile.read()] + [open(p).read() for p in paths[1:]])
+    assert outputs[0] == outputs[1]
+    assert not tmpdir.listdir(lambda x: '.part' in x.basename)
+
+
+@pytest.mark.parametrize('sparse', [True, False])
+def test_write_vectors_to_npy(tmpdir, sparse):
+    matrix = np.arange(15, dtype=float).reshape((5, 3))
+    rows, cols = ['a/N', 'b/N', 'c/V', 'd/J', 'e/N'], ['f1', 'f2', 'f3']
+    path = str(tmpdir.join('vectors'))
+    write_vectors_to_npy(sp.csr_matrix(matrix) if sparse else matrix, rows, cols, path, chunk_size=2)
+    assert os.path.exists(path + '.rows')
+    assert os.path.exists(path + '.cols')
+
+    mat, rows1, cols1 = read_vectors_from_npy(path)
+    assert isinstance(mat, np.memmap)
+    np.testing.assert_array_equal(mat, matrix)
+    assert rows1 == rows
+    assert cols1 == cols
+
+    with pytest.raises(ValueError):
+        write_vectors_to_npy(matrix, rows[1:], cols, path)
+
+
+def test_write_sparse_vectors_to_hdf(tmpdir):
+    from discoutils.thesaurus_loader import Vectors
+
+    # too wide for write_vectors_to_hdf
+    matrix = sp.random(30, 5000, density=0.01, format='csr', random_state=0)
+    rows = ['%s/N' % x for x in 'abcdefghijklmnopqrstuvwxyz'] + ['caf\xe9/N', 'x/J', 'y/J', 'z/J']
+    cols = ['f%d' % i for i in range(5000)]
+    path = str(tmpdir.join('vectors.h5'))
+    write_sparse_vectors_to_hdf(matrix, rows, cols, path, chunk_size=7)
+    assert is_sparse_hdf(path)
+
+    mat, rows1, cols1 = read_sparse_vectors_from_hdf(path)
+    assert (mat != matrix).nnz == 0
+    assert (rows1, cols1) == (rows, cols)
+
+    wanted = {'b/N', 'q/N', 'r/N', 'caf\xe9/N', 'z/J'}
+    mat, rows1, cols1 = read_sparse_vectors_from_hdf(path, row_filter=lambda x: x in wanted, chunk_size=7)
+    assert rows1 == [r for r in rows if r in wanted]
+    assert (mat != matrix[[rows.index(r) for r in rows1]]).nnz == 0
+
+    mat, rows1, _ = read_sparse_vectors_from_hdf(path, row_filter=lambda x: False)
+    assert mat.shape == (0, 5000) and rows1 == []
+
+    # wide dense_hd5 output falls back to the sparse format
+    v = Vectors(None, matrix=matrix, rows=rows, columns=cols)
+    v.to_tsv(path, dense_hd5=True)
+    v1 = Vectors.from_tsv(path, row_filter=lambda x, y: x.endswith('/J'))
+    assert list(v1.row_names) == ['x/J', 'y/J', 'z/J']
+    assert (v1.matrix != matrix[-3:]).nnz == 0
+
+
+def test_read_vectors_from_hdf(tmpdir):
+    matrix = np.arange(60, dtype=float).reshape((20, 3))
+    rows = ['%s/N' % x for x in 'abcdefghijklmnopqrst']
+    cols = ['f1', 'f2', 'f3']
+    path = str(tmpdir.join('vectors.h5'))
+    write_vectors_to_hdf(matrix, rows, cols, path)
+
+    mat, rows1, cols1 = read_vectors_from_hdf(path)
+    np.testing.assert_array_equal(mat, matrix)
+    assert (rows1, cols1) == (rows, cols)
+
+    # some chunks are read in full, some partially and some not at all
+    wanted = set(rows[:4]) | {'f/N', 'g/N', 's/N'}
+    mat, rows1, cols1 = read_vectors_from_hdf(path, row_filter=lambda x: x in wanted, chunk_size=4)
+    assert rows1 == [r for r in rows if r in wanted]
+    np.testing.assert_array_equal(mat, matrix[[rows.index(r) for r in rows1]])
+
+
+def test_clean():
+    assert clean('absurdity/N:amod-DEP:total/J') == 'total/J_absurdity/N'
+    assert clean('academy/N:nn-HEAD:award/N') == 'academy/N_award/N'
+    assert clean('big/J:amod-HEAD:cat/N') == 'big/J_cat/N'
+    assert clean('a:b/N:nn-DEP:c/N') == 'c/N_a:b/N'
+    for entry in ['cat/N', 'a/N:foo-HEAD:b/N', 'a/N::b/N']:
+        with pytest.raises(ValueError):
+            clean(entry)
+
+
+@pytest.mark.parametrize(('compression', 'n_jobs'), [(None, 1), ('gzip', 1), (None, 2), ('gzip', 2), ('bz2', 1),
+                                                     ('xz', 2)])
+def test_reformat_entries(tmpdir, compression, n_jobs):
+    lines = ['absurdity/N:amod-DEP:total/J\tf1\t1\tf2\t2\n',
+             'academy/N:nn-HEAD:award/N\n',  # no features
+             'academy/N:nn-HEAD:award/N\tf1\t3\n'] * 20
+    filename = str(tmpdir.join('vectors'))
+    with open_text(filename, 'w', compression) as outfile:
+        outfile.write(''.join(lines))
+
+    # small chunks, so that the file is split between several workers
+    outname = reformat_entries(filename, '-cleaned', clean, n_jobs=n_jobs, chunk_size=100)
+    assert outname == filename + '-cleaned'
+    with open_text(outname) as infile:
+        assert infile.read() == 'total/J_absurdity/N\tf1\t1\tf2\t2\nacademy/N_award/N\tf1\t3\n' * 20
+    assert sniff_format(outname) == (compression or 'text')
@@ -1,4 +1,6 @@
-from discoutils.misc import is_gzipped, is_hdf
+import numpy as np
+import pytest
+from discoutils.misc import is_gzipped, is_hdf, is_npy, is_plaintext, sniff_format
 
 
 def test_is_gzipped():
@@ -19,3 +21,62 @@ def test_is_hdf(tmpdir):
         store['matrix'] = df
 
     assert is_hdf(tmpfile.strpath)
+
+
+def test_is_npy(tmpdir):
+    assert not is_npy('discoutils/tests/resources/exp0-0a.strings')
+    assert not is_npy('discoutils/tests/resources/exp0-0a.strings.gzip')
+    assert not is_npy('discoutils/tests/resources/exp0-0a.strings.h5')
+
+    tmpfile = tmpdir.join('tmp')
+    with open(tmpfile.strpath, 'wb') as outfile:
+        np.save(outfile, np.arange(3))
+    assert is_npy(tmpfile.strpath)
+
+
+def _write_compressed(module, path, text):
+    with module.open(path, 'wt') as outfile:
+        outfile.write(text)
+
+
+@pytest.mark.parametrize('fmt', ['text', 'utf8', 'empty', 'gzip', 'bz2', 'xz', 'zstd', 'npy', 'npz', 'hdf',
+                                 'binary'])
+def test_sniff_format(tmpdir, fmt):
+    import bz2
+    import gzip
+    import lzma
+
+    path = tmpdir.join('tmp').strpath
+    if fmt == 'text':
+        tmpdir.join('tmp').write('cat/N\tdog/N\t0.5\n' * 1000)
+    elif fmt == 'utf8':
+        # the header ends in the middle of a character
+        tmpdir.join('tmp').write_text('a' + '\xe9' * 2000, encoding='utf8')
+    elif fmt == 'empty':
+        tmpdir.join('tmp').write('')
+    elif fmt in {'gzip', 'bz2', 'xz'}:
+        _write_compressed(dict(gzip=gzip, bz2=bz2, xz=lzma)[fmt], path, 'cat/N\tdog/N\t0.5\n')
+    elif fmt == 'zstd':
+        # the frame header of an empty zstd file, zstandard may not be installed
+        tmpdir.join('tmp').write_binary(b'\x28\xb5\x2f\xfd\x24\x00\x01\x00\x00\x99\xe9\xd8\x51')
+    elif fmt == 'npy':
+        np.save(open(path, 'wb'), np.arange(3))
+    elif fmt == 'npz':
+        np.savez(open(path, 'wb'), a=np.arange(3))
+    elif fmt == 'hdf':
+        import tables
+
+        with tables.open_file(path, 'w') as h5:
+            h5.create_array('/', 'a', np.arange(3))
+    else:
+        tmpdir.join('tmp').write_binary(b'\x01\x02\x00\xff' * 10)
+
+    expected = {'utf8': 'text', 'empty': 'text', 'binary': None}.get(fmt, fmt)
+    assert sniff_format(path) == expected
+    assert is_gzipped(path) == (fmt == 'gzip')
+    assert is_npy(path) == (fmt == 'npy')
+    # only ASCII text, as with libmagic
+    assert is_plaintext(path) == (fmt == 'text')
+    if fmt != 'binary':
+        # avoid calling libmagic
+        assert is_hdf(path) == (fmt == 'hdf')
@@ -0,0 +1,147 @@
+import pytest
+import numpy as np
+import scipy.sparse as sp
+from numpy.testing import assert_array_almost_equal
+
+from discoutils.io_utils import write_csr_arrays, read_csr_arrays
+from discoutils.reweighting import (ppmi_sparse_matrix, reweight, reweight_vectors, reweight_csr_arrays,
+                                    reweight_events_file, marginals, SCHEMES)
+from discoutils.thesaurus_loader import Vectors
+
+__author__ = 'mmb28'
+
+
+@pytest.fixture
+def counts():
+    a = np.random.RandomState(0).randint(0, 5, size=(20, 10)).astype(float)
+    a[a < 2] = 0
+    return a
+
+
+def _dense_reference(a, scheme, shift=1., alpha=0.75):
+    N, rows, cols = a.sum(), a.sum(axis=1), a.sum(axis=0)
+    result = np.zeros_like(a)
+    for i, j in zip(*np.nonzero(a)):
+        p_row, p_col, p_joint = rows[i] / N, cols[j] / N, a[i, j] / N
+        if scheme == 'cds_ppmi':
+            p_col = cols[j] ** alpha / (cols ** alpha).sum()
+        pmi = np.log(p_joint / (p_row * p_col))
+        if scheme in ('ppmi', 'cds_ppmi'):
+            result[i, j] = max(pmi, 0)
+        elif scheme == 'sppmi':
+            result[i, j] = max(pmi - np.log(shift), 0)
+        elif scheme == 'plmi':
+            result[i, j] = a[i, j] * max(pmi, 0)
+        elif scheme == 'ttest':
+            result[i, j] = (p_joint - p_row * p_col) / np.sqrt(p_row * p_col)
+        elif scheme == 'tfidf':
+            result[i, j] = a[i, j] * np.log(a.shape[0] / (a[:, j] > 0).sum())
+    return result
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_reweight(counts, scheme):
+    kwargs = {'shift': 5.} if scheme == 'sppmi' else {}
+    mat = reweight(sp.csr_matrix(counts), scheme=scheme, **kwargs)
+    assert mat.shape == counts.shape
+    assert_array_almost_equal(mat.A, _dense_reference(counts, scheme, **kwargs))
+
+
+def test_ppmi_sparse_matrix(counts):
+    original = sp.csr_matrix(counts)
+    mat = ppmi_sparse_matrix(original)
+    assert_array_almost_equal(mat.A, _dense_reference(counts, 'ppmi'))
+    # input is not modified
+    assert_array_almost_equal(original.A, counts)
+
+
+def test_unknown_scheme(counts):
+    with pytest.raises(ValueError):
+        reweight(sp.csr_matrix(counts), scheme='magic')
+
+
+def test_reweight_vectors_removes_empty_columns():
+    # the last feature occurs with both entries in proportion to their frequency, so its PMI is 0
+    v = Vectors({'a/N': [('f1', 1), ('f3', 1)], 'b/N': [('f2', 1), ('f3', 1)]})
+    assert v.columns == ['f1', 'f2', 'f3']
+    assert ppmi_sparse_matrix(v.matrix).shape == (2, 3)
+
+    v1 = reweight_vectors(v)
+    assert v1.columns == ['f1', 'f2']
+    assert v1.matrix.shape == (2, 2)
+    assert set(v1.keys()) == {'a/N', 'b/N'}
+    assert v1['a/N'] == [('f1', np.log(2))]
+    assert_array_almost_equal(v1.get_vector('b/N').A, [[0, np.log(2)]])
+
+
+def test_marginals_in_blocks(counts):
+    mat = sp.csr_matrix(counts)
+    expected = marginals(mat)
+    for block_size in [1, 3, 100]:
+        m = marginals(mat, block_size=block_size)
+        for key in ['row_sums', 'col_sums', 'col_df']:
+            assert_array_almost_equal(m[key], expected[key])
+        assert m['total'] == expected['total']
+        assert m['n_rows'] == expected['n_rows']
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_reweight_csr_arrays(counts, scheme, tmpdir):
+    write_csr_arrays(sp.csr_matrix(counts), str(tmpdir.join('counts')))
+    out = reweight_csr_arrays(str(tmpdir.join('counts')), str(tmpdir.join('weighted')), scheme=scheme, block_size=3)
+    mat = read_csr_arrays(out)
+    assert mat.shape == counts.shape
+    assert_array_almost_equal(mat.A, _dense_reference(counts, scheme))
+
+
+@pytest.mark.parametrize('gzipped', [True, False])
+@pytest.mark.parametrize('scheme', ['ppmi', 'tfidf'])
+def test_reweight_events_file(scheme, gzipped, tmpdir):
+    infile = 'discoutils/tests/resources/exp0-0a.strings'
+    outfile = str(tmpdir.join('weighted'))
+    reweight_events_file(infile, outfile, scheme=scheme, block_size=2, gzipped=gzipped)
+
+    expected = reweight_vectors(Vectors.from_tsv(infile), scheme=scheme)
+    streamed = Vectors.from_tsv(outfile)
+    assert set(streamed.keys()) == set(expected.keys())
+    for entry in expected.keys():
+        assert dict(streamed[entry]) == pytest.approx(dict(expected[entry]))
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 100])
+def test_reweight_events_file_with_duplicate_entries(block_size, tmpdir):
+    infile = str(tmpdir.join('events.txt'))
+    with open(infile, 'w') as outfile:
+        outfile.write('a/N\tf1\t1\tf2\t2\n'
+                      'b/N\tf1\t3\n'
+                      'a/N\tf1\t4\tf3\t1\n'
+                      'c/N\tf2\t1\tf3\t2\n'
+                      'a/N\tf2\t1\n')
+    outfile = str(tmpdir.join('weighted'))
+    reweight_events_file(infile, outfile, scheme='tfidf', block_size=block_size)
+
+    # a/N only counts once towards the document frequency of f1 and f2
+    expected = reweight_vectors(Vectors.from_tsv(infile), scheme='tfidf')
+    streamed = Vectors.from_tsv(outfile)
+    assert set(streamed.keys()) == set(expected.keys())
+    for entry in expected.keys():
+        assert dict(streamed[entry]) == pytest.approx(dict(expected[entry]))
+
+
+def test_reweight_events_file_formatting(tmpdir):
+    infile = 'discoutils/tests/resources/exp0-0a.strings'
+    streamed = reweight_events_file(infile, str(tmpdir.join('streamed')), scheme='ppmi')
+    in_memory = reweight_vectors(Vectors.from_tsv(infile), scheme='ppmi').to_tsv(str(tmpdir.join('in_memory')))
+
+    def _read(path):
+        with open(path) as infile:
+            return {tokens[0]: dict(zip(tokens[1::2], tokens[2::2]))
+                    for tokens in (line.strip().split('\t') for line in infile)}
+
+    streamed, in_memory = _read(streamed), _read(in_memory)
+    # the same features are written, the values may differ in the last digit
+    assert {entry: set(features) for entry, features in streamed.items()} == \
+           {entry: set(features) for entry, features in in_memory.items()}
+    for entry, features in streamed.items():
+        assert {f: float(x) for f, x in features.items()} == \
+               pytest.approx({f: float(x) for f, x in in_memory[entry].items()})
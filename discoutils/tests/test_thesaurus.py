@@ -1,5 +1,6 @@
 # coding=utf-8
 from glob import glob
+import pickle
 import shelve
 from unittest import TestCase
 import os
@@ -10,7 +11,7 @@ import pytest
 import numpy as np
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from operator import itemgetter
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from discoutils.thesaurus_loader import Thesaurus, Vectors
 from discoutils.collections_utils import walk_nonoverlapping_pairs, walk_overlapping_pairs
 
@@ -25,9 +26,9 @@ def thesaurus_c():
                               ngram_separator='_')
 
 
-@pytest.fixture(params=['txt', 'gz', 'hdf'])
+@pytest.fixture(params=['txt', 'gz', 'hdf', 'npy', 'sparse_hdf'])
 def vectors_c(request, tmpdir):
-    kind = request.param  # txt, gz or hdf
+    kind = request.param  # txt, gz, hdf, npy or sparse_hdf
     v = Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings', sim_threshold=0, ngram_separator='_')
     assert DocumentFeature.from_string('oversized/J') not in v
     assert len(v) == 5
@@ -44,12 +45,16 @@ def _generate_hdf_gzip_repr(kind, tmpdir, v):
             v.to_tsv(outfile, gzipped=True)
         if kind == 'hdf':
             v.to_tsv(outfile, dense_hd5=True)
+        if kind == 'npy':
+            v.to_tsv(outfile, dense_npy=True)
+        if kind == 'sparse_hdf':
+            v.to_tsv(outfile, sparse_hd5=True)
         return Vectors.from_tsv(outfile)
 
 
-@pytest.fixture(params=['txt', 'gz', 'hdf'])
+@pytest.fixture(params=['txt', 'gz', 'hdf', 'npy', 'sparse_hdf'])
 def overlapping_vectors(request, tmpdir, _overlapping_vectors):
-    kind = request.param  # txt, gz or hdf
+    kind = request.param  # txt, gz, hdf, npy or sparse_hdf
     return _generate_hdf_gzip_repr(kind, tmpdir, _overlapping_vectors)
 
 
@@ -143,6 +148,114 @@ def test_nearest_neighbours_too_few_neighbours(vectors_c):
     assert len(neigh) == 2
 
 
+@pytest.mark.parametrize('strategy', ['linear', 'skipping'])
+def test_nearest_neighbours_restricted_to_type(vectors_c, strategy):
+    assert set(vectors_c.row_feature_types()) == {'N', 'V', 'J', 'AN'}
+    vectors_c.init_sims(n_neighbors=2, strategy=strategy)
+    with pytest.raises(ValueError):
+        vectors_c.get_nearest_neighbours('b/V', restrict_to='N')
+
+    vectors_c.init_sims(n_neighbors=2, strategy=strategy, partition=True)
+    # the two nearest neighbours overall are an AN and a N, but we can still get two Ns
+    assert [x[0] for x in vectors_c.get_nearest_neighbours_linear('b/V')] == ['a/J_b/N', 'a/N']
+    neigh = vectors_c.get_nearest_neighbours('b/V', restrict_to='N')
+    assert [x[0] for x in neigh] == ['a/N', 'g/N']
+    assert abs(neigh[0][1] - 0.387298) < 1e-5
+    assert [x[0] for x in vectors_c.get_nearest_neighbours('b/V', restrict_to='AN')] == ['a/J_b/N']
+    # an entry is not its own neighbour, even within its partition
+    assert vectors_c.get_nearest_neighbours('b/V', restrict_to='V') == []
+    assert vectors_c.get_nearest_neighbours('b/V', restrict_to='SVO') == []
+
+
+def test_feature_index(vectors_c):
+    assert set(vectors_c.entries_with_feature('x/X')) == {'g/N'}
+    assert set(vectors_c.entries_with_feature('a/N')) == {'a/J_b/N', 'b/V', 'd/J', 'g/N'}
+    assert vectors_c.entries_with_feature('not-a-feature') == []
+    assert set(vectors_c.candidate_neighbours('g/N')) == set(vectors_c.keys())
+    assert set(vectors_c.candidate_neighbours('a/N')) == set(vectors_c.keys())
+    assert vectors_c.candidate_neighbours('not-an-entry') == []
+
+    # the index does not refer to deleted rows
+    del vectors_c['a/J_b/N']
+    assert set(vectors_c.entries_with_feature('a/N')) == {'b/V', 'd/J', 'g/N'}
+    assert set(vectors_c.candidate_neighbours('g/N')) == set(vectors_c.keys())
+    assert set(vectors_c.candidate_neighbours('a/N')) == set(vectors_c.keys())
+
+
+def test_align_columns(vectors_c):
+    target = ['not-a-feature', 'x/X', 'a/N', 'b/V']
+    aligned = vectors_c.align_columns(target)
+    assert type(aligned) == type(vectors_c)
+    assert list(aligned.columns) == target
+    assert list(aligned.row_names) == list(vectors_c.row_names)
+    assert aligned.matrix.shape == (len(vectors_c), 4)
+    for entry in vectors_c.keys():
+        old = dict(zip(vectors_c.columns, _dense_row(vectors_c, entry)))
+        new = _dense_row(aligned, entry)
+        assert new[0] == 0
+        assert_array_almost_equal(new[1:], [old[f] for f in target[1:]])
+    assert aligned.align_columns(vectors_c.columns).matrix.shape == vectors_c.matrix.shape
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 100])
+def test_iter_aligned_rows(vectors_c, chunk_size):
+    target = ['not-a-feature', 'x/X', 'a/N', 'b/V']
+    aligned = vectors_c.align_columns(target).matrix
+    aligned = aligned.A if issparse(aligned) else aligned
+    chunks = list(vectors_c.iter_aligned_rows(target, chunk_size))
+    assert [start for start, _ in chunks] == list(range(0, len(vectors_c), chunk_size))
+    for start, chunk in chunks:
+        assert chunk.shape == (min(chunk_size, len(vectors_c) - start), len(target))
+        assert issparse(chunk) == issparse(vectors_c.matrix)
+        assert_array_almost_equal(chunk.A if issparse(chunk) else chunk, aligned[start:start + chunk_size])
+
+
+@pytest.mark.parametrize('how', ['sum', 'prefer-first', 'concat'])
+def test_merge_vectors(vectors_c, how):
+    other = Vectors({'a/N': [('a/N', 1.), ('new/N', 2.)], 'new/V': [('new/N', 3.)]})
+    if how == 'concat':
+        with pytest.raises(ValueError):
+            Vectors.merge([vectors_c, other], how=how)
+        other = Vectors({'new/V': [('new/N', 3.)]})
+
+    merged = Vectors.merge([vectors_c, other], how=how)
+    assert list(merged.columns) == list(vectors_c.columns) + ['new/N']
+    assert list(merged.row_names) == list(vectors_c.row_names) + ['new/V']
+    for entry in vectors_c.keys():
+        old = dict(zip(vectors_c.columns, _dense_row(vectors_c, entry)))
+        old['new/N'] = 0
+        if entry == 'a/N' and how == 'sum':
+            old['a/N'] += 1
+            old['new/N'] += 2
+        assert_array_almost_equal(_dense_row(merged, entry), [old[f] for f in merged.columns])
+    assert_array_almost_equal(_dense_row(merged, 'new/V'), [0] * len(vectors_c.columns) + [3])
+
+    with pytest.raises(ValueError):
+        Vectors.merge([vectors_c, other], how='union')
+
+
+def _dense_row(v, entry):
+    row = v.matrix[v.name2row[entry]]
+    return row.A.ravel() if issparse(row) else np.ravel(row)
+
+
+def test_inverted_index_neighbours(vectors_c):
+    with pytest.raises(ValueError):
+        vectors_c.init_sims(knn='inverted')
+    for entries in [None, ['b/V', 'g/N', 'a/N']]:
+        vectors_c.init_sims(entries, nn_metric='cosine', knn='brute')
+        expected = {e: vectors_c.get_nearest_neighbours(e) for e in vectors_c.keys()}
+        vectors_c.init_sims(entries, nn_metric='cosine', knn='inverted')
+        for entry in vectors_c.keys():
+            neigh = vectors_c.get_nearest_neighbours(entry)
+            assert [x[0] for x in neigh] == [x[0] for x in expected[entry]]
+            assert_array_almost_equal([x[1] for x in neigh], [x[1] for x in expected[entry]])
+
+    negative = Vectors(None, matrix=-vectors_c.matrix, rows=vectors_c.row_names, columns=vectors_c.columns)
+    with pytest.raises(ValueError):
+        negative.init_sims(nn_metric='cosine', knn='inverted')
+
+
 def test_get_nearest_neigh_compare_to_byblo(vectors_c):
     thes = 'discoutils/tests/resources/thesaurus_exp0-0c/test.sims.neighbours.strings'
     if not os.path.exists(thes):
@@ -182,6 +295,46 @@ def test_nearest_neighbours_skipping(vectors_c):
     assert neigh == ['a/J_b/N', 'd/J', 'a/N', 'g/N']
 
 
+def test_nearest_neighbours_skipping_after_init_sims(vectors_c):
+    vectors_c.init_sims(strategy='skipping')
+    assert len(vectors_c.get_nearest_neighbours('b/V')) == 4
+    # results computed with the previous index must not be reused
+    vectors_c.init_sims(['b/V', 'g/N', 'a/N'], strategy='skipping')
+    neigh = vectors_c.get_nearest_neighbours('b/V')
+    assert [x[0] for x in neigh] == ['a/N', 'g/N']
+    for entry, dist in neigh:
+        assert abs(dist - np.linalg.norm(vectors_c.get_vector(entry).A - vectors_c.get_vector('b/V').A)) < 1e-5
+
+
+@pytest.mark.parametrize('strategy', ['linear', 'skipping'])
+def test_nearest_neighbours_batch(vectors_c, strategy):
+    vectors_c.init_sims(n_neighbors=3, strategy=strategy)
+    expected = {entry: vectors_c.get_nearest_neighbours(entry) for entry in vectors_c.keys()}
+
+    queries = []
+    batch_nearest_neighbours = vectors_c._batch_nearest_neighbours
+    vectors_c._batch_nearest_neighbours = lambda entries, **kw: queries.append(entries) or \
+                                                                batch_nearest_neighbours(entries, **kw)
+    result = vectors_c.get_nearest_neighbours_batch(list(vectors_c.keys()) + ['not-an-entry/N'])
+    # one query for all entries, or one per hop for all walks
+    assert len(queries) <= (1 if strategy == 'linear' else 3)
+    assert result.pop('not-an-entry/N') == []
+    assert set(result) == set(expected)
+    for entry, neighbours in expected.items():
+        assert [x[0] for x in result[entry]] == [x[0] for x in neighbours]
+        assert_array_almost_equal([x[1] for x in result[entry]], [x[1] for x in neighbours])
+
+
+@pytest.mark.parametrize('strategy', ['linear', 'skipping'])
+def test_nearest_neighbours_after_deleting_an_entry(vectors_c, strategy):
+    vectors_c.init_sims(strategy=strategy)
+    assert 'a/J_b/N' in [x[0] for x in vectors_c.get_nearest_neighbours('b/V')]
+    del vectors_c['a/J_b/N']
+    neigh = vectors_c.get_nearest_neighbours('b/V')
+    assert len(neigh) == 3
+    assert 'a/J_b/N' not in [x[0] for x in neigh]
+
+
 def test_similarity_calculation_match(vectors_c):
     """
     Test that the similarity scores returned by get_nearest_neighbours_linear,
@@ -315,6 +468,17 @@ def test_thesaurus_to_tsv(thesaurus_c, tmpdir):
     assert t1._obj == thesaurus_c._obj
 
 
+@pytest.mark.parametrize('gzipped', [True, False])
+def test_thesaurus_to_tsv_in_shards(thesaurus_c, tmpdir, gzipped):
+    single = str(tmpdir.join('single.txt'))
+    sharded = str(tmpdir.join('sharded.txt'))
+    thesaurus_c.to_tsv(single, gzipped=gzipped)
+    thesaurus_c.to_tsv(sharded, gzipped=gzipped, n_jobs=2)
+    assert Thesaurus.from_tsv(sharded)._obj == thesaurus_c._obj
+    if not gzipped:
+        assert open(single).read() == open(sharded).read()
+
+
 def test_vectors_to_tsv(vectors_c, tmpdir):
     """
 
@@ -497,6 +661,82 @@ def test_loading_from_gz():
         assert v == t2[k]
 
 
+@pytest.mark.parametrize('kind', ['txt', 'gz', 'hdf', 'npy', 'sparse_hdf'])
+def test_loading_row_subset(tmpdir, kind):
+    v = Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings', sim_threshold=0)
+    v1 = _generate_hdf_gzip_repr(kind, tmpdir, v)
+    path = str(tmpdir.join('events.txt')) if kind != 'txt' else 'discoutils/tests/resources/exp0-0c.strings'
+
+    subset = Vectors.from_tsv(path, row_subset=['g/N', 'a/N', 'b/V', 'not/N'],
+                              row_filter=lambda x, y: x != 'b/V')
+    assert sorted(subset.keys()) == ['a/N', 'g/N']
+    for entry in subset.keys():
+        assert_array_almost_equal(subset.get_vector(entry).A, v1.get_vector(entry).A)
+
+
+def test_merging_duplicate_entries(tmpdir):
+    path = str(tmpdir.join('events.txt'))
+    with open(path, 'w') as outfile:
+        outfile.write('a/N\tf2\t1\tf1\t2\n')
+        outfile.write('b/N\tf1\t1\n')
+        for _ in range(100):
+            outfile.write('a/N\tf3\t1\tf2\t0.5\n')
+
+    with pytest.raises(ValueError):
+        Thesaurus.from_tsv(path)
+    th = Thesaurus.from_tsv(path, merge_duplicates=True)
+    # features are in the order they are first seen
+    assert th['a/N'] == [('f2', 51.), ('f1', 2.), ('f3', 100.)]
+    assert th['b/N'] == [('f1', 1.)]
+
+    v = Vectors.from_tsv(path)
+    assert dict(v['a/N']) == {'f1': 2., 'f2': 51., 'f3': 100.}
+
+
+@pytest.mark.parametrize('kind', ['hdf', 'npy'])
+def test_loading_dense_vectors_with_noise(tmpdir, kind):
+    v = Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings', sim_threshold=0)
+    path = str(tmpdir.join('events.txt'))
+    v.to_tsv(path, **{'dense_hd5' if kind == 'hdf' else 'dense_npy': True})
+    exact = Vectors.from_tsv(path)
+    noisy = Vectors.from_tsv(path, noise=0.01)
+    difference = np.abs(noisy.matrix - exact.matrix)
+    assert 0 < difference.max() <= 0.01
+    # the file is not modified
+    assert_array_equal(Vectors.from_tsv(path).matrix, exact.matrix)
+
+
+@pytest.mark.parametrize('kind', ['txt', 'gz', 'hdf', 'npy', 'sparse_hdf'])
+def test_loading_vectors_sniffs_format_once(kind, tmpdir, monkeypatch):
+    import discoutils.misc
+
+    path = 'discoutils/tests/resources/exp0-0c.strings'
+    if kind != 'txt':
+        path = Vectors.from_tsv(path).to_tsv(str(tmpdir.join('events.txt')), gzipped=kind == 'gz',
+                                              dense_hd5=kind == 'hdf', dense_npy=kind == 'npy',
+                                              sparse_hd5=kind == 'sparse_hdf')
+    headers_read = []
+    read_header = discoutils.misc._read_header
+    monkeypatch.setattr(discoutils.misc, '_read_header', lambda p: headers_read.append(p) or read_header(p))
+    assert len(Vectors.from_tsv(path)) == 5
+    assert headers_read == [path]
+
+
+def test_loading_compressed_and_unsupported_formats(tmpdir):
+    import bz2
+
+    path = str(tmpdir.join('events.bz2'))
+    with open('discoutils/tests/resources/exp0-0c.strings') as infile, bz2.open(path, 'wt') as outfile:
+        outfile.write(infile.read())
+    v = Vectors.from_tsv(path, sim_threshold=0)
+    assert v._obj == Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings', sim_threshold=0)._obj
+
+    path = str(tmpdir.join('events.npz'))
+    np.savez(path, a=np.arange(3))
+    with pytest.raises(ValueError):
+        Vectors.from_tsv(path)
+
+
 def test_loading_from_h5():
     t1 = Vectors.from_tsv('discoutils/tests/resources/exp0-0a.strings')
     t2 = Vectors.from_tsv('discoutils/tests/resources/exp0-0a.strings.h5')
@@ -613,3 +853,172 @@ class TestLoad_thesauri(TestCase):
 
         output1 = [x for x in walk_nonoverlapping_pairs(inp, 1, max_pairs=-2)]
         self.assertListEqual([], output1)
+
+
+def _shared_neighbours(shared, entry):
+    v = Vectors.from_shared_memory(shared)
+    v.init_sims(n_neighbors=2)
+    return v.get_nearest_neighbours(entry)
+
+
+def test_shared_memory_roundtrip(vectors_c):
+    from joblib import Parallel, delayed
+
+    vectors_c.init_sims(n_neighbors=2)
+    with vectors_c.to_shared_memory() as shared:
+        v = Vectors.from_shared_memory(shared)
+        assert list(v.keys()) == list(vectors_c.keys())
+        assert list(v.columns) == list(vectors_c.columns)
+        for entry in vectors_c.keys():
+            assert entry in v
+            assert_array_equal(v.get_vector(entry).A, vectors_c.get_vector(entry).A)
+            # DenseVectors also return features with a value of 0
+            assert set((f, x) for f, x in v[entry] if x != 0) == set((f, x) for f, x in vectors_c[entry] if x != 0)
+
+        neigh = Parallel(n_jobs=2)(delayed(_shared_neighbours)(shared, e) for e in vectors_c.keys())
+        assert neigh == [vectors_c.get_nearest_neighbours(e) for e in vectors_c.keys()]
+    assert not shared.is_owner  # released
+
+
+_SHARED_MEMORY_SCRIPT = """
+import multiprocessing
+from joblib import Parallel, delayed
+from discoutils.thesaurus_loader import Vectors
+from discoutils.tests.test_thesaurus import _shared_neighbours
+
+v = Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings')
+with v.to_shared_memory() as shared:
+    Parallel(n_jobs=2)(delayed(_shared_neighbours)(shared, e) for e in v.keys())
+    for method in ['fork', 'spawn']:
+        with multiprocessing.get_context(method).Pool(2) as pool:
+            pool.starmap(_shared_neighbours, [(shared, e) for e in v.keys()])
+"""
+
+
+def test_shared_memory_resource_tracker():
+    # the resource tracker is a separate process, so its errors can only be seen on the real stderr
+    import subprocess
+    import sys
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-c', _SHARED_MEMORY_SCRIPT], stderr=subprocess.PIPE, env=env,
+                            universal_newlines=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert 'resource_tracker' not in result.stderr
+    assert 'KeyError' not in result.stderr
+
+
+def test_shared_memory_attach_from_unrelated_process():
+    # a process that was not started by multiprocessing has a resource tracker of its own, which must not unlink
+    # the blocks when the process exits
+    import subprocess
+    import sys
+
+    v = Vectors.from_tsv('discoutils/tests/resources/exp0-0c.strings')
+    script = 'import pickle, sys\n' \
+             'from discoutils.tests.test_thesaurus import _shared_neighbours\n' \
+             'print(len(_shared_neighbours(pickle.loads(sys.stdin.buffer.read()), "b/V")))'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get('PYTHONPATH', '')]))
+    with v.to_shared_memory() as shared:
+        result = subprocess.run([sys.executable, '-c', script], input=pickle.dumps(shared), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == b'2'
+        assert b'resource_tracker' not in result.stderr
+        # the blocks are still there
+        assert len(_shared_neighbours(shared, 'b/V')) == 2
+
+
+
+@pytest.mark.parametrize('protocol', [2, pickle.HIGHEST_PROTOCOL])
+def test_pickle_vectors(vectors_c, protocol):
+    vectors_c.init_sims(['b/V', 'g/N', 'a/N'], n_neighbors=1)
+    buffers = []
+    s = pickle.dumps(vectors_c, protocol=protocol,
+                     buffer_callback=buffers.append if protocol >= 5 else None)
+    v = pickle.loads(s, buffers=buffers)
+    assert type(v) == type(vectors_c)
+    assert list(v.keys()) == list(vectors_c.keys())
+    for entry in vectors_c.keys():
+        assert_array_equal(v.get_vector(entry).A, vectors_c.get_vector(entry).A)
+    # index is rebuilt on first use with the same settings
+    assert not hasattr(v, 'nn')
+    assert v.get_nearest_neighbours('b/V') == vectors_c.get_nearest_neighbours('b/V')
+    assert v.nn._fit_X.shape == (3, 5)
+
+
+def test_pickled_vectors_can_be_modified():
+    v = Vectors({'a/N': [('y', 1.), ('x', 2.)], 'b/N': [('x', 3.)], 'c/N': [('y', 4.)]}, immutable=False)
+    p = pickle.loads(pickle.dumps(v))
+    # features come back in the order of the columns, not in the order they were added in
+    assert p['a/N'] == [('x', 2.), ('y', 1.)]
+
+    del p['a/N']
+    assert 'a/N' not in p
+    assert list(p.keys()) == ['b/N', 'c/N']
+    assert p.matrix.shape == (2, 2)
+    assert p['c/N'] == [('y', 4.)]
+    assert_array_equal(p.get_vector('b/N').A, [[3, 0]])
+    with pytest.raises(KeyError):
+        del p['a/N']
+
+    p['d/N'] = [('x', 5.)]
+    assert p['d/N'] == [('x', 5.)]
+    assert p['b/N'] == [('x', 3.)]
+
+    immutable = pickle.loads(pickle.dumps(Vectors(v._obj)))
+    with pytest.raises(ValueError):
+        immutable['d/N'] = [('x', 5.)]
+
+
+@pytest.mark.parametrize('protocol', [2, pickle.HIGHEST_PROTOCOL])
+def test_pickle_vectors_after_setitem(protocol):
+    v = Vectors({'a/N': [('x', 1.)], 'b/N': [('y', 2.)]}, immutable=False)
+    v['c/N'] = {'x': 3., 'z': 4.}
+    v['a/N'] = [('y', 5.)]
+    p = pickle.loads(pickle.dumps(v, protocol=protocol))
+    assert set(p.keys()) == {'a/N', 'b/N', 'c/N'}
+    assert p['c/N'] == {'x': 3., 'z': 4.}
+    assert p['a/N'] == [('y', 5.)]
+
+    # same for vectors that were backed by a matrix before the assignment
+    v = pickle.loads(pickle.dumps(Vectors({'a/N': [('x', 1.)]}, immutable=False)))
+    v['b/N'] = [('x', 2.)]
+    p = pickle.loads(pickle.dumps(v, protocol=protocol))
+    assert dict(p.items()) == {'a/N': [('x', 1.)], 'b/N': [('x', 2.)]}
+
+
+def test_deleting_from_matrix_backed_vectors(vectors_c):
+    aligned = vectors_c.align_columns(list(vectors_c.columns))
+    merged = Vectors.merge([vectors_c, vectors_c])
+    for v in [aligned, merged]:
+        expected = {e: set(v[e]) for e in v.keys() if e != 'a/N'}
+        del v['a/N']
+        assert 'a/N' not in v
+        assert len(v) == len(vectors_c) - 1
+        assert {e: set(v[e]) for e in v.keys()} == expected
+
+
+def test_non_string_labels_are_preserved():
+    # e.g. the columns of vectors built with `from_wort_model` after dimensionality reduction
+    matrix = np.array([[1., 0.], [0., 2.]])
+    v = Vectors(None, matrix=csr_matrix(matrix), rows=['a/N', 'b/N'], columns=[0, 1])
+    p = pickle.loads(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))
+    assert p.columns == [0, 1]
+    assert all(type(x) is int for x in p.columns)
+    assert p['b/N'] == [(1, 2.)]
+    with v.to_shared_memory() as shared:
+        assert Vectors.from_shared_memory(shared).columns == [0, 1]
+
+    # labels of mixed types can not be put in shared memory, but can still be pickled
+    mixed = Vectors(None, matrix=csr_matrix(matrix), rows=['a/N', 'b/N'], columns=[0, 'x'])
+    with pytest.raises(ValueError):
+        mixed.to_shared_memory()
+    assert pickle.loads(pickle.dumps(mixed)).columns == [0, 'x']
+
+
+def test_pickle_thesaurus(thesaurus_c):
+    t = pickle.loads(pickle.dumps(thesaurus_c, protocol=pickle.HIGHEST_PROTOCOL))
+    assert type(t) == Thesaurus
+    assert t._obj == thesaurus_c._obj
+    assert list(t.keys()) == list(thesaurus_c.keys())
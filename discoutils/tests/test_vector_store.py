@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pytest
+from discoutils.thesaurus_loader import Vectors
+from discoutils.vector_store import VectorStore
+
+__author__ = 'mmb28'
+
+
+def _as_dict(vectors):
+    return {entry: dict(features) for entry, features in vectors.items()}
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = VectorStore(str(tmpdir.join('store')))
+    store.append({'a/N': [('f1', 1), ('f2', 2)], 'b/V': [('f1', 3)]})
+    # new and existing entries and features
+    store.append(Vectors({'a/N': [('f3', 4), ('f1', 1)], 'c/J': [('f2', 5)]}))
+    return store
+
+
+def test_append_and_snapshot(store):
+    expected = {'a/N': {'f1': 2, 'f2': 2, 'f3': 4}, 'b/V': {'f1': 3}, 'c/J': {'f2': 5}}
+    assert store.shape == (3, 3)
+    assert len(store.segments) == 2
+    assert _as_dict(store.snapshot()) == expected
+
+    assert store.merge() is not None
+    assert store.segments == []
+    assert _as_dict(store.snapshot()) == expected
+    assert store.merge() is None  # nothing to merge
+
+    # counts appended after a merge are added to the base matrix
+    store.append({'d/N': [('f4', 1)], 'b/V': [('f1', 1)]})
+    expected.update({'d/N': {'f4': 1}, 'b/V': {'f1': 4}})
+    assert _as_dict(store.snapshot()) == expected
+    assert _as_dict(VectorStore(store.path).snapshot()) == expected
+
+
+def test_snapshot_is_not_affected_by_later_changes(store):
+    snapshot = store.snapshot()
+    before = _as_dict(snapshot)
+    store.append({'a/N': [('f1', 10)], 'e/N': [('f5', 1)]})
+    store.merge()
+    assert _as_dict(snapshot) == before
+    assert not [x for x in os.listdir(store.path) if x.startswith('segment')]
+
+
+def test_background_merge(tmpdir):
+    store = VectorStore(str(tmpdir.join('store')), merge_every=3)
+    for i in range(20):
+        store.append({'a/N': [('f%s' % 'abcd'[i % 4], 1)], 'b/V': [('fa', i)]})
+    store.wait()
+    store.merge()
+    assert store.segments == []
+    assert _as_dict(store.snapshot()) == {'a/N': {'fa': 5, 'fb': 5, 'fc': 5, 'fd': 5}, 'b/V': {'fa': 190}}
+
+
+def test_names_not_in_manifest_are_discarded(store):
+    # as if the process died after updating the vocabulary, but before writing the manifest
+    with open(os.path.join(store.path, 'rows.txt'), 'a') as outfile:
+        outfile.write('x/N\n')
+    reopened = VectorStore(store.path)
+    assert reopened.shape == (3, 3)
+    reopened.append({'y/N': [('f1', 1)]})
+    snapshot = reopened.snapshot()
+    assert 'x/N' not in snapshot
+    np.testing.assert_array_equal(snapshot.get_vector('y/N').A.ravel(), [1, 0, 0])
@@ -1,19 +1,21 @@
 # coding=utf-8
-from collections import Counter
+from collections.abc import Mapping
 import contextlib
 import gzip
 import logging
-import os
 import shelve
 import numpy as np
 import six
 from scipy.spatial.distance import cosine
 from scipy.spatial.distance import euclidean
-from scipy.sparse import csr_matrix, issparse, coo_matrix
+from scipy.sparse import csr_matrix, csc_matrix, issparse
 from discoutils.tokens import DocumentFeature
 from discoutils.collections_utils import walk_nonoverlapping_pairs
-from discoutils.io_utils import write_vectors_to_disk, write_vectors_to_hdf
-from discoutils.misc import is_gzipped, is_hdf
+from discoutils.io_utils import write_vectors_to_disk, write_vectors_to_hdf, write_vectors_to_npy, \
+    read_vectors_from_npy, concatenate_files, write_sparse_vectors_to_hdf, read_sparse_vectors_from_hdf, \
+    read_vectors_from_hdf, open_text
+from discoutils.misc import sniff_format, is_hdf, is_sparse_hdf, Bunch
+from discoutils.shm_utils import SharedArrays, pack_strings, unpack_strings
 from sklearn.neighbors import NearestNeighbors
 
 from functools import lru_cache
@@ -61,7 +63,7 @@ class Thesaurus(object):
                  lowercasing=False, ngram_separator='_', pos_separator='/', allow_lexical_overlap=True,
                  row_filter=lambda x, y: True, column_filter=lambda x: True, max_len=50,
                  max_neighbours=1e8, merge_duplicates=False, immutable=True,
-                 enforce_word_entry_pos_format=True, **kwargs):
+                 enforce_word_entry_pos_format=True, file_format=None, **kwargs):
         """
         Create a Thesaurus by parsing a Byblo-compatible TSV files (events or sims).
         If duplicate values are encoutered during parsing, only the latest will be kept.
@@ -92,6 +94,8 @@ class Thesaurus(object):
         The former is appropriate for `Thesaurus`, and the latter for `Vectors`
         :param enforce_word_entry_pos_format: if true, entries that are not in a `word/POS` format are skipped. This
         must be true for `allow_lexical_overlap` to work.
+        :param file_format: the format of `tsv_file` as returned by `misc.sniff_format`, if already known. Detected
+        from the first few bytes of the file otherwise
         """
 
         if not tsv_file:
@@ -108,21 +112,12 @@ class Thesaurus(object):
             raise ValueError('allow_lexical_overlap requires entries to be converted to a DocumentFeature. '
                              'Please enable enforce_word_entry_pos_format')
         FILTERED = '___FILTERED___'.lower()
+        duplicates = dict()  # entry -> features of all but the first occurrence of the entry
 
-        gzipped = is_gzipped(tsv_file)
-        if gzipped:
-            logging.info('Attempting to read a gzipped file')
-            fhandle = gzip.open(tsv_file)
-        else:
-            fhandle = open(tsv_file)
-
-        with fhandle as infile:
-            for line in infile.readlines():
-                if gzipped:
-                    # this is a byte steam, needs to be decoded
-                    tokens = line.decode('UTF8').strip().split('\t')
-                else:
-                    tokens = line.strip().split('\t')
+        # gzip, bz2, xz and zstd files are decompressed on the fly
+        with open_text(tsv_file, fmt=file_format) as infile:
+            for line in infile:
+                tokens = line.strip().split('\t')
 
                 if len(tokens) % 2 == 0:
                     # must have an odd number of things, one for the entry
@@ -162,15 +157,16 @@ class Thesaurus(object):
                         if key in to_return:  # this is a duplicate entry, merge it or raise an error
                             if merge_duplicates:
                                 logging.debug('Multiple entries for "%s" found. Merging.', tokens[0])
-                                c = Counter(dict(to_return[key]))
-                                c.update(dict(to_insert))
-                                to_return[key] = [(k, v) for k, v in c.items()]
+                                duplicates.setdefault(key, []).append(to_insert)
                             else:
                                 raise ValueError('Multiple entries for "%s" found.' % tokens[0])
                         else:
                             to_return[key] = to_insert
                     else:
                         logging.warning('Nothing survived filtering for %r', key)
+        if duplicates:
+            logging.info('Merging %d entries that occur more than once', len(duplicates))
+            to_return.update(_sum_duplicate_entries(to_return, duplicates))
         return Thesaurus(to_return, immutable=immutable)
 
     def to_shelf(self, filename):
@@ -183,23 +179,28 @@ class Thesaurus(object):
             d[str(entry)] = features
         d.close()
 
-    def to_tsv(self, filename, gzipped=False):
+    def to_tsv(self, filename, gzipped=False, n_jobs=1):
         """
         Writes this thesaurus to a Byblo-compatible sims file like the one it was most likely read from.  Neighbours
         are written in the order that they appear in.
         :param filename: file to write to
+        :param n_jobs: if more than 1, the entries are split into this many contiguous shards, which are written
+         in parallel and then concatenated. The output is the same as with a single process.
         :return: the file name
         """
         logging.warning('row_transform and entry_filter options are ignored in order to use preserve_order')
-        if gzipped:
-            f = gzip.open(filename, 'w')
-        else:
-            f = open(filename, 'w')
-        with contextlib.closing(f) as outfile:
-            for entry, vector in self._obj.items():
-                features_str = '\t'.join(['%s\t%f' % foo for foo in vector])
-                outfile.write('%s\t%s\n' % (entry, features_str))
-        return filename
+        if n_jobs == 1:
+            _write_sims(list(self._obj.items()), filename, gzipped)
+            return filename
+
+        from joblib import Parallel, delayed, cpu_count
+        n_shards = cpu_count() if n_jobs < 0 else n_jobs
+        items = list(self._obj.items())
+        bounds = np.linspace(0, len(items), n_shards + 1).astype(int).tolist()
+        paths = ['%s.part%d' % (filename, i) for i in range(n_shards)]
+        Parallel(n_jobs=n_jobs)(delayed(_write_sims)(items[a:b], path, gzipped)
+                                for a, b, path in zip(bounds, bounds[1:], paths))
+        return concatenate_files(paths, filename)
 
     def to_sparse_matrix(self, row_transform=None, dtype=np.float):
         """
@@ -256,11 +257,41 @@ class Thesaurus(object):
         """
         self.__dict__.update(d)
 
+    def __reduce_ex__(self, protocol):
+        """
+        Pickles the neighbour lists as a handful of flat numpy arrays (entries and neighbours are stored as
+        packed strings, similarities as a float array) rather than as a dict of lists of tuples. The payload is
+        much smaller because each neighbour name is only stored once. With pickle protocol 5 the arrays can be
+        transferred out-of-band, see https://www.python.org/dev/peps/pep-0574/
+        """
+        if type(self._obj) is not dict:
+            # e.g. a shelf, nothing clever to do here
+            return super().__reduce_ex__(protocol)
+        vocab = {}
+        lengths = np.fromiter((len(neigh) for neigh in self._obj.values()), dtype=np.int64, count=len(self._obj))
+        total = lengths.sum()
+        ids = np.fromiter((vocab.setdefault(n, len(vocab)) for neigh in self._obj.values() for n, _ in neigh),
+                          dtype=np.int32 if total < 2 ** 31 else np.int64, count=total)
+        sims = np.fromiter((sim for neigh in self._obj.values() for _, sim in neigh), dtype=np.float64, count=total)
+        state = dict(immutable=self.immutable, lengths=lengths, ids=ids, sims=sims)
+        try:
+            state['entries'], state['entry_offsets'] = pack_strings(self._obj.keys())
+            state['vocab'], state['vocab_offsets'] = pack_strings(vocab.keys())
+        except ValueError:
+            # entries or neighbours that are not strings
+            return super().__reduce_ex__(protocol)
+        return _unpickle_thesaurus, (type(self), state)
+
     def __setitem__(self, key, value):
         if self.immutable:
             raise ValueError('This object is immutable')
         if isinstance(key, DocumentFeature):
             key = str(key)
+        if isinstance(self._obj, _MatrixRows):
+            # a read-only view of the matrix, switch to a dict of (feature, value) lists so the value can be stored.
+            # As for any other dict-based object, the matrix is not updated
+            logging.info('Converting matrix-backed vectors to a dict to store %s', key)
+            self._obj = {entry: self._obj[entry] for entry in self._obj}
         self._obj[key] = value
 
     def __delitem__(self, key):
@@ -272,13 +303,28 @@ class Thesaurus(object):
         :rtype:
         """
         if isinstance(key, DocumentFeature):
-            item = str(key)
+            key = str(key)
 
-        del self._obj[key]
+        obj = self.__dict__.get('_obj')
+        if obj is not None and not isinstance(obj, _MatrixRows):
+            del obj[key]
+        elif key not in self:
+            raise KeyError(key)
+        # a _MatrixRows view is updated by removing the row from the matrix
         if hasattr(self, 'matrix'):
+            row = self.name2row[key]
             mask = np.ones(self.matrix.shape[0], dtype=bool)
-            mask[self.name2row[key]] = False
+            mask[row] = False
             self.matrix = self.matrix[mask, :]
+            if isinstance(self.row_names, np.ndarray):
+                self.row_names = np.delete(self.row_names, row)
+            else:
+                self.row_names = [entry for i, entry in enumerate(self.row_names) if i != row]
+            self.name2row = {entry: i for i, entry in enumerate(self.row_names)}
+            self._row_sums, self._row_feature_types, self._row_document_types = None, None, None
+            self._feature_index, self._column2id = None, None
+            if hasattr(self, '_df'):
+                self._df = None
 
     def __getitem__(self, item):
         if isinstance(item, DocumentFeature):
@@ -296,6 +342,83 @@ class Thesaurus(object):
         return len(self._obj)
 
 
+class _MatrixRows(Mapping):
+    """
+    A read-only dict-like view of the rows of a `Vectors` matrix, which can be used as the `_obj` of a `Vectors`
+    instead of a dict of lists of (feature, value) tuples. Values are built on demand from the matrix, in the
+    order of the columns, and only non-zero features are returned.
+    """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def __getitem__(self, key):
+        v = self.vectors
+        row = v.name2row[key]
+        if issparse(v.matrix):
+            start, end = v.matrix.indptr[row], v.matrix.indptr[row + 1]
+            indices, values = v.matrix.indices[start:end], v.matrix.data[start:end]
+        else:
+            indices = np.flatnonzero(v.matrix[row])
+            values = v.matrix[row][indices]
+        return [(v.columns[j], val) for j, val in zip(indices, values)]
+
+    def __contains__(self, key):
+        return key in self.vectors.name2row
+
+    def __iter__(self):
+        return iter(self.vectors.row_names)
+
+    def __len__(self):
+        return len(self.vectors.row_names)
+
+
+class _InvertedIndexNeighbors(object):
+    """
+    A drop-in replacement for `sklearn.neighbors.NearestNeighbors` with cosine distance for sparse, non-negative
+    data (e.g. co-occurrence counts). The fitted vectors are stored as a posting list per feature. A query vector is
+    only compared to the rows it shares at least one non-zero feature with, much like Byblo's all-pairs stage.
+    All other rows are at a cosine distance of 1 from the query and are only returned if there are not enough
+    candidates.
+    """
+
+    def __init__(self, n_neighbors=5):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, X):
+        from sklearn.preprocessing import normalize
+
+        X = csr_matrix(X)
+        if X.nnz and X.data.min() < 0:
+            # rows with no shared features may have a negative cosine, but would never be considered
+            raise ValueError('Inverted index nearest neighbours only work with non-negative vectors')
+        # row i of the transposed matrix is the posting list of feature i
+        self.postings_ = csr_matrix(normalize(X, norm='l2').T)
+        self.n_samples_fit_ = X.shape[0]
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        from sklearn.preprocessing import normalize
+
+        n_neighbors = n_neighbors or self.n_neighbors
+        sims = normalize(csr_matrix(X), norm='l2').dot(self.postings_).tocsr()
+        distances = np.ones((X.shape[0], n_neighbors))
+        indices = np.zeros((X.shape[0], n_neighbors), dtype=int)
+        for i in range(X.shape[0]):
+            start, end = sims.indptr[i], sims.indptr[i + 1]
+            candidates, candidate_sims = sims.indices[start:end], sims.data[start:end]
+            if len(candidates) > n_neighbors:
+                top = np.argpartition(-candidate_sims, n_neighbors - 1)[:n_neighbors]
+                candidates, candidate_sims = candidates[top], candidate_sims[top]
+            order = np.lexsort((candidates, -candidate_sims))  # ties broken by row index
+            k = len(order)
+            indices[i, :k], distances[i, :k] = candidates[order], 1. - candidate_sims[order]
+            if k < n_neighbors:
+                # not enough candidates, pad with unrelated rows
+                indices[i, k:] = np.setdiff1d(np.arange(self.n_samples_fit_), candidates)[:n_neighbors - k]
+        return distances, indices
+
+
 class Vectors(Thesaurus):
     def __init__(self, d, immutable=True, allow_lexical_overlap=True,
                  matrix=None, columns=None, rows=None, noise=None,
@@ -327,7 +450,8 @@ class Vectors(Thesaurus):
          - changed default value of sim_threshold to a very low value, for the same reason.
          - changed default value of merge_duplicates
 
-        :param d: a dictionary that serves as a basis
+        :param d: a dictionary that serves as a basis. If None, `matrix`, `rows` and `columns` must be provided and
+         entries are read from the matrix as needed.
         :param allow_lexical_overlap: if false, `get_nearest_neighbours` removes neighbours that have a unigram that is
          also the query entry. For example, `big_cat` won't be a neighbour of either `cat` or `big_dog`.
          NOTE: THE BEHAVIOUR OF THIS PARAMETER IS SLIGHTLY DIFFERENT FROM THE EQUIVALENT IN THESAURUS. This class
@@ -339,7 +463,7 @@ class Vectors(Thesaurus):
         (-noise, noise). Because noise is only added to non-zero entries, this may only make sense
         for dense, low-dimensional vectors.
         """
-        self._obj = d  # the underlying data dict. Do NOT RENAME!
+        self._obj = _MatrixRows(self) if d is None else d  # the underlying data dict. Do NOT RENAME!
         self.immutable = immutable
         self.allow_lexical_overlap = allow_lexical_overlap
 
@@ -363,38 +487,63 @@ class Vectors(Thesaurus):
                  column_filter=lambda x: True,
                  max_len=50, max_neighbours=1e8,
                  merge_duplicates=True,
-                 immutable=True, **kwargs):
+                 immutable=True, row_subset=None, **kwargs):
         """
         Changes the default value of the sim_threshold parameter of super. Features can have any value, including
         negative (especially when working with neural embeddings).
+        :param row_subset: collection of entries (strings) to load, e.g. a vocabulary. Other entries are skipped
+         without being parsed, and if the vectors are stored in a binary format they are not read from disk at all.
+         `row_filter` is applied to the entries in this subset. Defaults to all entries
         :rtype: Vectors
         """
         # For vectors disallowing lexical overlap does not make sense at construction time, but should be
         # implemented in get_nearest_neighbours. A Thesaurus can afford to do the filtering when reading the
         # ready-made thesaurus from disk.
         allow_lexical_overlap = kwargs.pop('allow_lexical_overlap', True)
-        if is_hdf(tsv_file):
-            import pandas as pd
-
-            df = pd.read_hdf(tsv_file, 'matrix')
-            logging.info('Found a DF of shape %r in HDF file %s', df.shape, tsv_file)
-            # pytables doesn't like unicode values and replaces them with an empty string.
-            # pandas doesn't like duplicate values in index
-            # remove these, we don't want to work with them anyway
-            df = df[df.index != '']
-            row_filter_mask = [row_filter(f, DocumentFeature.from_string(f)) for f in df.index]
-            df = df[row_filter_mask]
-            logging.info('Dropped non-ascii rows and applied row filter. Shape is now %r', df.shape)
-            return DenseVectors(df, immutable=immutable,
-                                allow_lexical_overlap=allow_lexical_overlap,
-                                **kwargs)
-
+        if row_subset is not None:
+            row_subset = set(row_subset)
+            entry_filter = lambda f: f in row_subset and row_filter(f, DocumentFeature.from_string(f))
+        else:
+            entry_filter = lambda f: row_filter(f, DocumentFeature.from_string(f))
+
+        # the first few bytes of the file are only read once, the format is passed on to the reader
+        fmt = sniff_format(tsv_file)
+        if fmt is None and is_hdf(tsv_file):
+            fmt = 'hdf'  # a binary file the sniffer does not know, but libmagic recognises as HDF
+        if fmt in {None, 'npz'}:
+            raise ValueError('Can not read vectors from %s, unsupported format' % tsv_file)
+        if fmt == 'npy':
+            matrix, rows, columns = read_vectors_from_npy(tsv_file)
+            logging.info('Found a memory-mapped matrix of shape %r in %s', matrix.shape, tsv_file)
+            row_filter_mask = np.array([entry_filter(f) for f in rows], dtype=bool)
+            if not row_filter_mask.all():
+                # this reads the selected rows into memory
+                matrix, rows = matrix[row_filter_mask], [r for r, keep in zip(rows, row_filter_mask) if keep]
+                logging.info('Applied row filter. Shape is now %r', matrix.shape)
+            return DenseVectors(None, matrix=matrix, columns=columns, rows=rows, immutable=immutable,
+                                allow_lexical_overlap=allow_lexical_overlap, **kwargs)
+        if fmt == 'hdf' and is_sparse_hdf(tsv_file, fmt):
+            matrix, rows, columns = read_sparse_vectors_from_hdf(tsv_file, row_filter=entry_filter)
+            logging.info('Found a sparse matrix of shape %r in HDF file %s', matrix.shape, tsv_file)
+            if not rows:
+                raise ValueError('No entries left over after filtering')
+            return Vectors(None, matrix=matrix, columns=columns, rows=rows, immutable=immutable,
+                           allow_lexical_overlap=allow_lexical_overlap, **kwargs)
+        if fmt == 'hdf':
+            # pytables doesn't like unicode values and replaces them with an empty string. These rows are dropped
+            matrix, rows, columns = read_vectors_from_hdf(tsv_file, row_filter=entry_filter)
+            logging.info('Found a dense matrix of shape %r in HDF file %s', matrix.shape, tsv_file)
+            return DenseVectors(None, matrix=matrix, columns=columns, rows=rows, immutable=immutable,
+                                allow_lexical_overlap=allow_lexical_overlap, **kwargs)
+
+        if row_subset is not None:
+            row_filter = lambda x, y, row_filter=row_filter: x in row_subset and row_filter(x, y)
         th = Thesaurus.from_tsv(tsv_file, sim_threshold=sim_threshold,
                                 ngram_separator=ngram_separator,
                                 allow_lexical_overlap=True,
                                 row_filter=row_filter, column_filter=column_filter,
                                 max_len=max_len, max_neighbours=max_neighbours,
-                                merge_duplicates=merge_duplicates,
+                                merge_duplicates=merge_duplicates, file_format=fmt,
                                 **kwargs)
 
         # get underlying dict from thesaurus
@@ -456,7 +605,8 @@ class Vectors(Thesaurus):
 
     def to_tsv(self, events_path, entries_path='', features_path='',
                entry_filter=lambda x: True, row_transform=lambda x: x,
-               gzipped=False, enforce_word_entry_pos_format=True, dense_hd5=False):
+               gzipped=False, enforce_word_entry_pos_format=True, dense_hd5=False, dense_npy=False, n_jobs=1,
+               sparse_hd5=False):
         """
         Writes this thesaurus to Byblo-compatible file like the one it was most likely read from. In the
         process converts all entries to a DocumentFeature, so all entries must be parsable into one. May reorder the
@@ -471,10 +621,20 @@ class Vectors(Thesaurus):
          DocumentFeature, e.g. if the data isn't PoS tagged.
          :param dense_hd5: if true, convert to a pandas `DataFrame` and write to a compressed HDF file. This is a 30%
           faster and produces 30% smaller files than using `gzipped`. This is only suitable for matrices with a small
-          number of columns- this method enforces a hard limit of 1000.
+          number of columns- this method enforces a hard limit of 1000, above which `sparse_hd5` is used instead.
           Requires PyTables and HDF5.
+        :param dense_npy: if true, write a dense matrix in numpy's .npy format, with the names of the rows and
+         columns in `events_path.rows` and `events_path.cols`. Faster than `dense_hd5`, and the file can be
+         memory-mapped when read back. Also only suitable for matrices with a small number of columns.
+        :param n_jobs: number of processes to use when writing a text file, see `write_vectors_to_disk`
+        :param sparse_hd5: if true, write the matrix in CSR form to a compressed HDF file. The matrix is never
+         converted to a dense one, so there is no limit on the number of columns. Requires PyTables and HDF5.
         :return: the file name
         """
+        if dense_npy:
+            write_vectors_to_npy(self.matrix, self.row_names, self.columns, events_path)
+            return events_path
+
         if enforce_word_entry_pos_format:
             rows = {i: DocumentFeature.from_string(row_transform(feat)) for (feat, i) in self.name2row.items()}
         else:
@@ -482,10 +642,12 @@ class Vectors(Thesaurus):
 
         if dense_hd5 and len(self.columns) <= 1000:
             write_vectors_to_hdf(self.matrix, self.row_names, self.columns, events_path)
+        elif dense_hd5 or sparse_hd5:
+            write_sparse_vectors_to_hdf(self.matrix, self.row_names, self.columns, events_path)
         else:
-            write_vectors_to_disk(coo_matrix(self.matrix), rows, self.columns, events_path,
+            write_vectors_to_disk(self.matrix, rows, self.columns, events_path,
                                   features_path=features_path, entries_path=entries_path,
-                                  entry_filter=entry_filter, gzipped=gzipped)
+                                  entry_filter=entry_filter, gzipped=gzipped, n_jobs=n_jobs)
         return events_path
 
     def to_plain_txt(self, events_path, entries_path='', features_path=''):
@@ -526,6 +688,78 @@ class Vectors(Thesaurus):
             for feature in sorted(set(self.columns)):
                 outfile.write('{}\n'.format(feature))
 
+    def to_shared_memory(self):
+        """
+        Publishes the matrix of this object and a compact (packed) copy of its row and column labels to
+        `multiprocessing.shared_memory`. Pass the returned object to worker processes (e.g. as an argument of a
+        joblib job) and call `Vectors.from_shared_memory` there to get a zero-copy `Vectors`.
+
+        Row and column labels must be either all strings or all numbers, otherwise a ValueError is raised.
+
+        The shared memory is released when the returned object is closed or garbage collected, so keep a reference
+        to it in the parent process until all workers are done. It can be used as a context manager:
+
+            with v.to_shared_memory() as shared:
+                Parallel(n_jobs=4)(delayed(work)(shared, chunk) for chunk in chunks)
+
+        :rtype: discoutils.shm_utils.SharedArrays
+        """
+        return SharedArrays(_vectors_to_arrays(self), shape=self.matrix.shape,
+                            dense_vectors=isinstance(self, DenseVectors),
+                            allow_lexical_overlap=self.allow_lexical_overlap)
+
+    @classmethod
+    def from_shared_memory(cls, shared, **kwargs):
+        """
+        Attaches to a `Vectors` object published with `to_shared_memory`, possibly in another process. The matrix
+        is not copied, only the row/column labels are unpacked. The returned object is read-only.
+        :param shared: the return value of `to_shared_memory`
+        :param kwargs: passed on to the constructor
+        :rtype: Vectors
+        """
+        arrays, blocks = shared.attach()
+        meta = shared.metadata
+        kwargs.setdefault('allow_lexical_overlap', meta['allow_lexical_overlap'])
+        v = _vectors_from_arrays(DenseVectors if meta['dense_vectors'] else Vectors, arrays, meta['shape'], **kwargs)
+        v._shared_memory = blocks  # the arrays are only valid while these are alive
+        return v
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        # the matrix is not updated, so it no longer describes all entries
+        self._matrix_is_stale = True
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        # the entry may be a neighbour of other entries. The index is rebuilt with the same settings when needed
+        for attr in ['nn', '_indices', 'search_pool', 'selected_row2name', 'n_neighbours']:
+            self.__dict__.pop(attr, None)
+        self._clear_neighbour_caches()
+
+    def __reduce_ex__(self, protocol):
+        """
+        Pickles only the matrix arrays and the packed row/column labels. The underlying dict of (feature, value)
+        tuples, fitted nearest neighbour models and other derived structures are not serialised. After
+        unpickling `_obj` is a view over the matrix, so the features of an entry are returned in the order of
+        the columns rather than in the order they were read in. The nearest neighbour index is rebuilt with the
+        parameters of the last call to `init_sims` the first time it is needed.
+        With pickle protocol 5 all arrays can be transferred out-of-band.
+
+        Entries added or replaced with `__setitem__` are only stored in `_obj`. If there are any, or if the row or
+        column labels can not be stored as arrays (see `_vectors_to_arrays`), the object is pickled as is, like any
+        other python object.
+        """
+        if getattr(self, '_matrix_is_stale', False):
+            return object.__reduce_ex__(self, protocol)
+        try:
+            arrays = _vectors_to_arrays(self)
+        except ValueError:
+            return object.__reduce_ex__(self, protocol)
+        state = dict(immutable=self.immutable, allow_lexical_overlap=self.allow_lexical_overlap,
+                     sims_params=getattr(self, '_sims_params', None), shape=self.matrix.shape)
+        state.update(arrays)
+        return _unpickle_vectors, (type(self), state)
+
     def get_vector(self, entry):
         """
         Returns a vector for the given entry. This differs from `self.__getitem__` in that it returns a sparse matrix
@@ -544,7 +778,193 @@ class Vectors(Thesaurus):
             return None  # no vector for this
         return self.matrix[row, :]
 
-    def init_sims(self, vocab=None, n_neighbors=10, strategy='linear', knn='brute', nn_metric='l2'):
+    def _get_feature_index(self):
+        if getattr(self, '_feature_index', None) is None:
+            logging.info('Building feature index of %d features', len(self.columns))
+            self._feature_index = csc_matrix(self.matrix)
+            self._feature_index.eliminate_zeros()
+            self._column2id = {feature: i for i, feature in enumerate(self.columns)}
+        return self._feature_index
+
+    def entries_with_feature(self, feature):
+        """
+        Returns all entries whose vector has a non-zero value for the given feature. A column-oriented copy of the
+        matrix is built on the first call.
+        :type feature: str
+        :rtype: list of str
+        """
+        index = self._get_feature_index()
+        col = self._column2id.get(feature)
+        if col is None:
+            return []
+        return [self.row_names[i] for i in index.indices[index.indptr[col]:index.indptr[col + 1]]]
+
+    def candidate_neighbours(self, entry):
+        """
+        Returns all entries that share at least one non-zero feature with the given entry, including the entry
+        itself. With non-negative features, all other entries are at a cosine distance of 1.
+        :rtype: list of str
+        """
+        if entry not in self.name2row:
+            return []
+        index = self._get_feature_index()
+        v = csr_matrix(self.matrix[self.name2row[entry], :])
+        rows = np.unique(index[:, v.indices[v.data != 0]].indices)
+        return [self.row_names[i] for i in rows]
+
+    def align_columns(self, target_columns):
+        """
+        Expresses these vectors in a different feature space, e.g. that of another `Vectors` object or of a trained
+        dimensionality reduction model. Column i of the new matrix corresponds to `target_columns[i]`. Features that
+        are not in `target_columns` are dropped, and target features that these vectors do not have are all zeros.
+        Column indices are remapped through an integer lookup array, no per-row dicts are built.
+        :param target_columns: list of feature names
+        :return: a new object with the same rows as this one
+        :rtype: Vectors
+        """
+        target_columns = list(target_columns)
+        matrix = self._remap_columns(self.matrix, self._column_lookup(target_columns), len(target_columns))
+        return Vectors(None, matrix=matrix, columns=target_columns, rows=list(self.row_names),
+                       allow_lexical_overlap=self.allow_lexical_overlap)
+
+    def iter_aligned_rows(self, target_columns, chunk_size=10000):
+        """
+        Like `align_columns`, but the rows are aligned `chunk_size` at a time, so the aligned copy of the whole
+        matrix is never held in memory.
+        :param target_columns: list of feature names
+        :param chunk_size: number of rows in each chunk
+        :return: generator of (start, matrix) pairs, where matrix holds rows start to start + chunk_size of this
+         object expressed in the target feature space
+        """
+        target_columns = list(target_columns)
+        lookup = self._column_lookup(target_columns)
+        mat = csr_matrix(self.matrix) if issparse(self.matrix) else np.asarray(self.matrix)
+        for start in range(0, mat.shape[0], chunk_size):
+            yield start, self._remap_columns(mat[start:start + chunk_size], lookup, len(target_columns))
+
+    def _column_lookup(self, target_columns):
+        """
+        :return: array holding the position of each of this object's columns in `target_columns`, -1 if missing
+        """
+        target_index = {feature: i for i, feature in enumerate(target_columns)}
+        lookup = np.array([target_index.get(feature, -1) for feature in self.columns], dtype=np.int64)
+        logging.info('Aligning columns, %d/%d features are in target feature space of size %d',
+                     (lookup >= 0).sum(), len(lookup), len(target_columns))
+        return lookup
+
+    @staticmethod
+    def _remap_columns(matrix, lookup, n_columns):
+        """
+        Moves column i of `matrix` to column `lookup[i]`, dropping it if that is negative
+        """
+        shape = (matrix.shape[0], n_columns)
+        if issparse(matrix):
+            mat = csr_matrix(matrix)
+            new_indices = lookup[mat.indices]
+            keep = new_indices >= 0
+            # number of cells kept before the start of each row
+            indptr = np.concatenate([[0], np.cumsum(keep)])[mat.indptr]
+            matrix = csr_matrix((mat.data[keep], new_indices[keep], indptr), shape=shape)
+            matrix.sort_indices()
+        else:
+            known = lookup >= 0
+            aligned = np.zeros(shape, dtype=matrix.dtype)
+            aligned[:, lookup[known]] = np.asarray(matrix)[:, known]
+            matrix = aligned
+        return matrix
+
+    @classmethod
+    def merge(cls, vectors, how='sum', **kwargs):
+        """
+        Combines several sets of vectors, e.g. from different corpora, into one. The feature space of the result is
+        the union of the input feature spaces, in the order features are first seen. Each input is mapped to it
+        with `align_columns` and the matrices are combined with sparse matrix operations.
+
+        :param vectors: list of `Vectors` objects
+        :param how: what to do with entries that occur in more than one input:
+         - 'sum': add up their vectors
+         - 'prefer-first': keep the vector from the first input that contains the entry
+         - 'concat': raise a ValueError, entries are expected to be disjoint
+        :param kwargs: passed to the constructor of the result
+        :return: vectors whose rows are all entries of the inputs, in the order they are first seen. The matrix is
+         sparse, even if the inputs are `DenseVectors`
+        :rtype: Vectors
+        """
+        from scipy.sparse import vstack
+
+        if how not in {'sum', 'prefer-first', 'concat'}:
+            raise ValueError('Unknown merge method %s' % how)
+        if not vectors:
+            raise ValueError('Nothing to merge')
+        columns = list(dict.fromkeys(f for v in vectors for f in v.columns))
+        row_ids, rows, matrices = {}, [], []
+        for v in vectors:
+            mat = csr_matrix(v.align_columns(columns).matrix)
+            ids = np.array([row_ids.setdefault(entry, len(row_ids)) for entry in v.row_names], dtype=np.int64)
+            new = ids >= len(rows)
+            if how == 'concat' and not new.all():
+                duplicates = [entry for entry, is_new in zip(v.row_names, new) if not is_new]
+                raise ValueError('%d entries occur in more than one input, e.g. %s' % (len(duplicates),
+                                                                                   duplicates[:5]))
+            rows.extend(entry for entry, is_new in zip(v.row_names, new) if is_new)
+            if how == 'prefer-first' and not new.all():
+                mat, ids = mat[new], ids[new]
+            if how == 'sum':
+                mat = mat.tocoo()
+                mat.row = ids[mat.row]
+            matrices.append(mat)
+
+        if how == 'sum':
+            # duplicate (row, column) pairs are added up when converting to CSR
+            matrix = csr_matrix((np.concatenate([m.data for m in matrices]),
+                                 (np.concatenate([m.row for m in matrices]),
+                                  np.concatenate([m.col for m in matrices]))), shape=(len(rows), len(columns)))
+        else:
+            matrix = vstack(matrices, format='csr')
+        logging.info('Merged %d sets of vectors (%s) into a matrix of shape %r', len(vectors), how, matrix.shape)
+        return Vectors(None, matrix=matrix, columns=columns, rows=rows, **kwargs)
+
+    def row_sums(self):
+        """
+        The sum of feature values of each entry, in the order of the rows of the matrix. This is Byblo's
+        definition of entry frequency. Computed once and cached.
+        :rtype: np.ndarray
+        """
+        if getattr(self, '_row_sums', None) is None:
+            self._row_sums = np.ravel(self.matrix.sum(axis=1))
+        return self._row_sums
+
+    def row_feature_types(self):
+        """
+        The type of the entry in each row of the matrix: the PoS tag for unigrams (N, V, J, ...) and the type of the
+        DocumentFeature (AN, NN, SVO, ...) otherwise. Computed once and cached.
+        :rtype: np.ndarray of str
+        """
+        if getattr(self, '_row_feature_types', None) is None:
+            self._parse_row_types()
+        return self._row_feature_types
+
+    def row_document_types(self):
+        """
+        The type of the DocumentFeature in each row of the matrix (1-GRAM, AN, NN, SVO, EMPTY, ...), i.e. unigrams
+        are not split up by PoS tag as in `row_feature_types`. Computed once and cached.
+        :rtype: np.ndarray of str
+        """
+        if getattr(self, '_row_document_types', None) is None:
+            self._parse_row_types()
+        return self._row_document_types
+
+    def _parse_row_types(self):
+        document_types, feature_types = [], []
+        for row in self.row_names:
+            df = DocumentFeature.from_string(row)
+            document_types.append(df.type)
+            feature_types.append(df.tokens[0].pos if df.type == '1-GRAM' and df.tokens[0].pos else df.type)
+        self._row_document_types = np.array(document_types, dtype=str)
+        self._row_feature_types = np.array(feature_types, dtype=str)
+
+    def init_sims(self, vocab=None, n_neighbors=10, strategy='linear', knn='brute', nn_metric='l2',
+                  partition=False):
         """
         Prepares a mini thesaurus by placing all entries in `vocab` in a data structure. After that it is possible to
         get the nearest neighbours of an entry that this object has a vector for amongst all entries in `vocab`.
@@ -558,29 +978,61 @@ class Vectors(Thesaurus):
         further. Also, one less neighbour will be returned for an entry `E` if
         `len(vocab)==N and E in vocab and n_neighbours == N`
         :param strategy: how to find nearest neighbours. Linear is the standard implementation, anything
+        :param knn: the `algorithm` parameter of `sklearn.neighbors.NearestNeighbors`, or `inverted` to only compare
+         entries that share a feature. The latter requires `nn_metric='cosine'` and non-negative features, and is
+         much faster for high-dimensional sparse vectors.
+        :param partition: if true, also build a separate index for each type of entry (see `row_feature_types`).
+         Neighbours of a single type can then be requested with `get_nearest_neighbours(entry, restrict_to='N')`,
+         which only searches the relevant partition.
         """
+        self._sims_params = dict(vocab=None if vocab is None else list(vocab), n_neighbors=n_neighbors,
+                                 strategy=strategy, knn=knn, nn_metric=nn_metric, partition=partition)
+        if knn == 'inverted' and nn_metric != 'cosine':
+            raise ValueError('The inverted index only supports cosine distance')
         if not vocab:
             vocab = self.keys()
 
-        # the pool out of which nearest neighbours will be sampled
-        self.search_pool = set(foo for foo in vocab if foo in self.name2row)
         selected_rows = [self.name2row[foo] for foo in vocab if foo in self.name2row]
-
         if not selected_rows:
             raise ValueError('None of the vocabulary items in the labelled set have associated vectors')
-        row2name = {v: k for k, v in self.name2row.items()}
-        self.selected_row2name = {new: row2name[old] for new, old in enumerate(selected_rows)}
         if n_neighbors > len(selected_rows):
             logging.warning('You requested %d neighbours to be returned, but there are only %d. Truncating.',
                             n_neighbors, len(selected_rows))
-            n_neighbors = len(selected_rows)
-        self.n_neighbours = n_neighbors
 
+        row2name = {v: k for k, v in self.name2row.items()}
+        self._indices = {None: self._fit_index(selected_rows, row2name, n_neighbors, knn, nn_metric)}
+        if partition:
+            types = self.row_feature_types()[selected_rows]
+            for t in sorted(set(types)):
+                rows = [row for row, row_type in zip(selected_rows, types) if row_type == t]
+                self._indices[t] = self._fit_index(rows, row2name, n_neighbors, knn, nn_metric)
+            logging.info('Partitioned neighbour index: %r', {k: len(v.search_pool) for k, v in self._indices.items()})
+
+        # the pool out of which nearest neighbours will be sampled
+        default = self._indices[None]
+        self.nn, self.search_pool = default.nn, default.search_pool
+        self.selected_row2name, self.n_neighbours = default.selected_row2name, default.n_neighbours
+
+        if strategy != 'linear':
+            self.get_nearest_neighbours = self.get_nearest_neighbours_skipping
+        self._clear_neighbour_caches()
+
+    def _clear_neighbour_caches(self):
+        # the skipping strategy builds on top of the linear one, results of both may be stale
+        self.get_nearest_neighbours_linear.cache_clear()
+        self.get_nearest_neighbours_skipping.cache_clear()
+
+    def _fit_index(self, selected_rows, row2name, n_neighbors, knn, nn_metric):
         # todo BallTree/KDTree do not support cosine out of the box. algorithm='brute' is slower overall
         # for larger datasets. Tt's faster to build, O(1), and slower to query. If using euclidean as an
         # alternative, change 1-dist to dist in get_nearest_neighbour. Also, reduce the default value of
         # k from 200 to get another boost in performance
         X = self.matrix[selected_rows, :]
+        n_neighbors = min(n_neighbors, len(selected_rows))
+        if knn == 'inverted':
+            return Bunch(nn=_InvertedIndexNeighbors(n_neighbors=n_neighbors).fit(X), n_neighbours=n_neighbors,
+                         search_pool=set(row2name[row] for row in selected_rows), dense_queries=False,
+                         selected_row2name={new: row2name[old] for new, old in enumerate(selected_rows)})
 
         # thomas 29.12.2015: see slack msg by miro, with cosine dists, this doesn't work
         if nn_metric == 'l2' and X.shape[1] < 1000:
@@ -589,70 +1041,158 @@ class Vectors(Thesaurus):
             if issparse(X):
                 X = X.A
             knn = 'kd_tree'
-        self.nn = NearestNeighbors(algorithm=knn,
-                                   metric=nn_metric,
-                                   n_neighbors=n_neighbors).fit(X)
-        if strategy != 'linear':
-            self.get_nearest_neighbours = self.get_nearest_neighbours_skipping
-        self.get_nearest_neighbours.cache_clear()
+        nn = NearestNeighbors(algorithm=knn, metric=nn_metric, n_neighbors=n_neighbors).fit(X)
+        return Bunch(nn=nn, n_neighbours=n_neighbors, dense_queries=True,
+                     search_pool=set(row2name[row] for row in selected_rows),
+                     selected_row2name={new: row2name[old] for new, old in enumerate(selected_rows)})
+
+    def _lazy_init_sims(self):
+        if hasattr(self, '_sims_params'):
+            # unpickled, rebuild the index the way it was
+            self.init_sims(**self._sims_params)
+        else:
+            logging.warning('init_sims has not been called. Calling with default settings.')
+            self.init_sims()
+
+    def _get_index(self, restrict_to):
+        if restrict_to is not None and len(self._indices) == 1:
+            raise ValueError('Neighbours of type %s requested, but init_sims was called without partition=True'
+                             % restrict_to)
+        return self._indices.get(restrict_to)
+
+    def _batch_nearest_neighbours(self, entries, restrict_to=None):
+        """
+        Finds the nearest neighbours of several entries with a single query to the index. The neighbour list
+        of each entry is exactly what `get_nearest_neighbours_linear` would return for it.
+        :type entries: list of str
+        :param restrict_to: only search the partition of entries of this type, see `init_sims`
+        :return: dict of entry -> list of (neighbour, distance) tuples
+        """
+        index = self._get_index(restrict_to)
+        result = {entry: [] for entry in entries if entry not in self or index is None}
+        entries = [entry for entry in entries if entry not in result]
+        if not entries:
+            return result
+
+        # if `entry` is contained in the list of neighbours, it will be popped and one less neighbour will be returned
+        # so we need to ask for one extra neighbour, but without exceeding the number of available neighbours
+        n_neigh = [min(index.n_neighbours + (entry in index.search_pool), len(index.search_pool))
+                   for entry in entries]
+        X = self.matrix[[self.name2row[entry] for entry in entries], :]
+        if issparse(X) and index.dense_queries:
+            X = X.A
+        distances, indices = index.nn.kneighbors(X, n_neighbors=max(n_neigh))
+        for entry, n, dist_row, idx_row in zip(entries, n_neigh, distances, indices):
+            neigh = [(index.selected_row2name[idx_row[i]], dist_row[i]) for i in range(n)]
+            if not self.allow_lexical_overlap:
+                neigh = self.remove_overlapping_neighbours(entry, neigh)
+            if neigh:
+                # remove self as neigh, avoid popping an empty list
+                # if there are identical vectors, self might not be the first neighbour- scan a bit further
+                for i in range(min(3, len(neigh))):
+                    if neigh[i][0] == entry:
+                        neigh.pop(i)
+                        break
+            result[entry] = neigh[:index.n_neighbours]
+        return result
 
     @lru_cache(maxsize=2 ** 16)
-    def get_nearest_neighbours_linear(self, entry):
+    def get_nearest_neighbours_linear(self, entry, restrict_to=None):
         """
         Get the nearest neighbours of `entry` amongst all entries that `init_sims` was called with. Resutls are
         sorted in order of increasing distance. The top neighbour will never be the entry itself (to match
         Byblo's behaviour)
         If there aren't any neighbours (either because we don't have a vector for the entry or because all
         neghbours overlap) an empty list is returned
+        :param restrict_to: only return neighbours of this type (e.g. N or AN), see `init_sims`
         """
         if not hasattr(self, 'nn'):
-            logging.warning('init_sims has not been called. Calling with default settings.')
-            self.init_sims()
-        if entry not in self:
-            return []
+            self._lazy_init_sims()
+            if self._sims_params['strategy'] != 'linear':
+                return self.get_nearest_neighbours(entry, restrict_to=restrict_to)
+        return self._batch_nearest_neighbours([entry], restrict_to=restrict_to)[entry]
 
-        # if `entry` is contained in the list of neighbours, it will be popped and one less neighbour will be returned
-        # so we need to ask for one extra neighbour, but without exceeding the number of available neighbours
-        n_neigh = min(self.n_neighbours + (entry in self.search_pool), len(self.search_pool))
-        v = self.get_vector(entry)
-        distances, indices = self.nn.kneighbors(v.A if issparse(v) else v,
-                                                n_neighbors=n_neigh)
-        neigh = [(self.selected_row2name[indices[0][i]], distances[0][i]) for i in range(indices.shape[1])]
-        if not self.allow_lexical_overlap:
-            neigh = self.remove_overlapping_neighbours(entry, neigh)
-        if neigh:
-            # remove self as neigh, avoid popping an empty list
-            # if there are identical vectors, self might not be the first neighbour- scan a bit further
-            for i in range(min(3, len(neigh))):
-                if neigh[i][0] == entry:
-                    neigh.pop(i)
-                    break
-        return neigh[:self.n_neighbours]
+    def _walk_nearest_neighbours(self, entries, restrict_to=None):
+        """
+        Walks from several entries at once, see `get_nearest_neighbours_skipping`. The walks advance in lockstep:
+        at every hop, the neighbour lists of all entries that the walks have just moved to are fetched with a
+        single query to the index, so a batch of walks takes at most `n_neighbours` queries. Neighbour lists are
+        shared between the walks of a batch and discarded afterwards. The distances of all neighbours to the
+        entries they were found for are computed in one go at the end.
+        :type entries: list of str
+        :param restrict_to: only walk through entries of this type, see `init_sims`
+        :return: dict of entry -> list of (neighbour, distance) tuples
+        """
+        from sklearn.metrics.pairwise import paired_euclidean_distances
+
+        index = self._get_index(restrict_to)
+        entries = list(dict.fromkeys(entries))
+        if index is None:
+            return {entry: [] for entry in entries}
+        walks = {entry: [entry] for entry in entries}
+        known, active = {}, entries
+        for i in range(index.n_neighbours):
+            missing = list(dict.fromkeys(walks[entry][-1] for entry in active if walks[entry][-1] not in known))
+            if missing:
+                known.update(self._batch_nearest_neighbours(missing, restrict_to=restrict_to))
+            moved = []
+            for entry in active:
+                walk = walks[entry]
+                # do not jump back to where we came from
+                neigh = [foo for foo in known[walk[-1]] if foo[0] not in walk]
+                if not self.allow_lexical_overlap:
+                    # this is needed if we want all neighbours returned to
+                    # not overlap with the original entry
+                    # without it something like this can happen:
+                    # black cat-> big dog-> black panther-> big cat
+                    # item I in this list does not overlap with item I-1, but may overlap with item 0
+                    # whether I want this is a different question
+                    neigh = self.remove_overlapping_neighbours(entry, neigh)
+                if neigh:
+                    walk.append(neigh[0][0])
+                    moved.append(entry)
+            active = moved  # the others are out of options
+            if not active:
+                break
+
+        pairs = [(entry, neighbour) for entry in entries for neighbour in walks[entry][1:]]
+        if not pairs:
+            return {entry: [] for entry in entries}
+        distances = paired_euclidean_distances(self.matrix[[self.name2row[entry] for entry, _ in pairs], :],
+                                               self.matrix[[self.name2row[neigh] for _, neigh in pairs], :])
+        result = {entry: [] for entry in entries}
+        for (entry, neighbour), dist in zip(pairs, distances.tolist()):
+            result[entry].append((neighbour, dist))
+        return result
 
     @lru_cache(maxsize=2 ** 16)
-    def get_nearest_neighbours_skipping(self, entry):
-        # accumulate neighbours by repeatedly calling get_nn_linear
-        original_entry = entry
-        result = []
-        selected_neighbours = set([entry])
-        for i in range(self.n_neighbours):
-            neigh = self.get_nearest_neighbours_linear(entry)
-            # do not jump back to where we came from
-            neigh = [foo for foo in neigh if foo[0] not in selected_neighbours]
-            if not self.allow_lexical_overlap:
-                # this is needed if we want all neighbours returned to
-                # not overlap with the original entry
-                # without it something like this can happen:
-                # black cat-> big dog-> black panther-> big cat
-                # item I in this list does not overlap with item I-1, but may overlap with item 0
-                # whether I want this is a different question
-                neigh = self.remove_overlapping_neighbours(original_entry, neigh)
-            if not neigh:
-                break  # we are out of options
-            entry = neigh[0][0]
-            selected_neighbours.add(entry)
-            result.append((entry, self.euclidean_distance(original_entry, entry)))
-        return result
+    def get_nearest_neighbours_skipping(self, entry, restrict_to=None):
+        """
+        Accumulates neighbours by walking from an entry to its nearest neighbour, then to that neighbour's nearest
+        neighbour that has not been visited yet, etc. Distances are measured between each neighbour and the
+        original entry. Use `get_nearest_neighbours_batch` to walk from many entries with fewer queries to the
+        index.
+        :param restrict_to: only walk through entries of this type (e.g. N or AN), see `init_sims`
+        """
+        if not hasattr(self, 'nn'):
+            self._lazy_init_sims()
+        return self._walk_nearest_neighbours([entry], restrict_to=restrict_to)[entry]
+
+    def get_nearest_neighbours_batch(self, entries, restrict_to=None):
+        """
+        Gets the nearest neighbours of several entries with the strategy `init_sims` was called with. The result
+        is the same as calling `get_nearest_neighbours` for each entry, but the index is queried once for all
+        entries (linear strategy) or once per hop for all walks (skipping strategy).
+        :type entries: list of str
+        :param restrict_to: only return neighbours of this type (e.g. N or AN), see `init_sims`
+        :return: dict of entry -> list of (neighbour, distance) tuples
+        """
+        if not hasattr(self, 'nn'):
+            self._lazy_init_sims()
+        entries = [str(entry) if isinstance(entry, DocumentFeature) else entry for entry in entries]
+        if self._sims_params['strategy'] == 'linear':
+            return self._batch_nearest_neighbours(entries, restrict_to=restrict_to)
+        return self._walk_nearest_neighbours(entries, restrict_to=restrict_to)
 
     get_nearest_neighbours = get_nearest_neighbours_linear
 
@@ -681,20 +1221,37 @@ class Vectors(Thesaurus):
 
 class DenseVectors(Vectors):
     """
-    A dense version of Vectors that stores data in a pandas DataFrame. This uses less
-    memory for dense vectors and is much faster to read/write to disk.
+    A dense version of Vectors that stores data in a numpy array (possibly memory-mapped) or a pandas DataFrame.
+    This uses less memory for dense vectors and is much faster to read/write to disk.
     """
 
-    def __init__(self, df, noise=False, **kwargs):
-        self.df = df
+    def __init__(self, df, noise=False, matrix=None, columns=None, rows=None, **kwargs):
+        """
+        :param df: a DataFrame with one row per entry. If None, `matrix`, `rows` and `columns` must be provided
+        :param matrix: dense numpy array
+        """
         self.__dict__.update(**kwargs)
-
-        self.matrix, self.columns, self.row_names = self.df.values, self.df.columns, self.df.index.values
+        self._df = df
+        if df is not None:
+            matrix, columns, rows = df.values, df.columns, df.index.values
+        self.matrix, self.columns, self.row_names = matrix, list(columns), np.array(rows, dtype=object)
         if noise:
             logging.info('Adding uniform noise [-{0}, +{0}] to non-zero vector dimensions'.format(noise))
-            self.matrix += np.random.uniform(-noise, noise, self.matrix.shape)
+            # not in place, the matrix may be a read-only memory map (see `read_vectors_from_npy`)
+            self.matrix = self.matrix + np.random.uniform(-noise, noise, self.matrix.shape)
         self.name2row = {feature: i for (i, feature) in enumerate(self.row_names)}
 
+    @property
+    def df(self):
+        """
+        The vectors as a pandas DataFrame, built on first access
+        """
+        if self._df is None:
+            import pandas as pd
+
+            self._df = pd.DataFrame(self.matrix, index=self.row_names, columns=self.columns, copy=False)
+        return self._df
+
     def __contains__(self, item):
         if isinstance(item, DocumentFeature):
             item = str(item)
@@ -705,29 +1262,148 @@ class DenseVectors(Vectors):
             item = str(item)
         if item not in self.name2row:
             return None
-        return csr_matrix(self.df.ix[item].values)  # for compat with Vectors
+        return csr_matrix(self.matrix[self.name2row[item]])  # for compat with Vectors
 
     def __getitem__(self, item):
         return zip(self.columns, self.get_vector(item).A.ravel())
 
     def keys(self):
-        return self.df.index
+        return self.row_names
 
     def to_sparse_matrix(self):
         return csr_matrix(self.matrix), list(self.columns), list(self.row_names)
 
+    def align_columns(self, target_columns):
+        aligned = super().align_columns(target_columns)
+        return DenseVectors(None, matrix=aligned.matrix, columns=aligned.columns, rows=aligned.row_names,
+                            allow_lexical_overlap=self.allow_lexical_overlap)
+
     def __len__(self):
         return len(self.row_names)
 
-    def to_tsv(self, events_path, **kwargs):
-        return super().to_tsv(events_path, dense_hd5=True)
+    def to_tsv(self, events_path, dense_npy=False, **kwargs):
+        return super().to_tsv(events_path, dense_hd5=not dense_npy, dense_npy=dense_npy)
 
     def to_plain_txt(self, events_path, entries_path='', features_path=''):
         super().to_tsv(events_path, entries_path=entries_path, features_path=features_path,
                        gzipped=False, dense_hd5=False)
 
     def __str__(self):
-        return '[Dense vectors of shape {}]'.format(self.df.shape)
+        return '[Dense vectors of shape {}]'.format(self.matrix.shape)
+
+
+def _sum_duplicate_entries(first, duplicates):
+    """
+    Adds up the features of entries that occur more than once in a file. All occurrences are turned into (entry,
+    feature, value) triples, which are summed in one go by scipy when converting them to a CSR matrix, so the
+    cost is linear in the total number of features read. Features are numbered in the order they are first seen
+    for each entry, so the features of a merged entry are in that order.
+    :param first: dict of entry -> list of (feature, value) pairs of its first occurrence
+    :param duplicates: dict of entry -> list of lists of (feature, value) pairs of its other occurrences
+    :return: dict of entry -> list of (feature, value) pairs
+    """
+    from scipy.sparse import coo_matrix
+
+    entries = list(duplicates)
+    rows, cols, values, features = [], [], [], []
+    for i, entry in enumerate(entries):
+        feature_ids = {}
+        for pairs in [first[entry]] + duplicates[entry]:
+            for feature, value in pairs:
+                rows.append(i)
+                cols.append(feature_ids.setdefault(feature, len(feature_ids)))
+                values.append(value)
+        features.append(list(feature_ids))
+    width = max(len(f) for f in features)
+    matrix = coo_matrix((values, (rows, cols)), shape=(len(entries), width)).tocsr()
+    matrix.sort_indices()
+    indptr, indices, data = matrix.indptr.tolist(), matrix.indices.tolist(), matrix.data.tolist()
+    return {entry: [(features[i][j], value) for j, value in zip(indices[indptr[i]:indptr[i + 1]],
+                                                                data[indptr[i]:indptr[i + 1]])]
+            for i, entry in enumerate(entries)}
+
+
+def _write_sims(items, filename, gzipped):
+    if gzipped:
+        f = gzip.open(filename, 'wt', encoding='utf8')
+    else:
+        f = open(filename, 'w', encoding='utf8')
+    with contextlib.closing(f) as outfile:
+        for entry, vector in items:
+            features_str = '\t'.join(['%s\t%f' % foo for foo in vector])
+            outfile.write('%s\t%s\n' % (entry, features_str))
+
+
+def _unpickle_thesaurus(cls, state):
+    entries = unpack_strings(state['entries'], state['entry_offsets'])
+    vocab = unpack_strings(state['vocab'], state['vocab_offsets'])
+    neighbours = [vocab[i] for i in state['ids']]
+    sims = state['sims'].tolist()
+    ends = np.cumsum(state['lengths']).tolist()
+    d, start = {}, 0
+    for entry, end in zip(entries, ends):
+        d[entry] = list(zip(neighbours[start:end], sims[start:end]))
+        start = end
+    return cls(d, immutable=state['immutable'])
+
+
+def _labels_to_arrays(labels, name, offsets_name):
+    """
+    Stores row or column labels as packed strings, or as a numeric array if they are numbers (e.g. the columns of
+    `from_wort_model`), so that they are restored with the same type. Inverse of `_labels_from_arrays`
+    """
+    labels = list(labels)
+    if all(isinstance(x, str) for x in labels):
+        blob, offsets = pack_strings(labels)
+        return {name: blob, offsets_name: offsets}
+    values = np.array(labels)
+    if values.dtype.kind not in 'biuf':
+        raise ValueError('Labels must be all strings or all numbers, got %r' % labels[:5])
+    return {name: values}
+
+
+def _labels_from_arrays(arrays, name, offsets_name):
+    if offsets_name in arrays:
+        return unpack_strings(arrays[name], arrays[offsets_name])
+    return arrays[name].tolist()
+
+
+def _vectors_to_arrays(v):
+    """
+    Flattens the matrix of a `Vectors` object and its row/column labels into a dict of numpy arrays, for
+    pickling or for publishing to shared memory. Inverse of `_vectors_from_arrays`. Raises a ValueError if the
+    labels are neither all strings nor all numbers
+    """
+    arrays = _labels_to_arrays(v.row_names, 'rows', 'row_offsets')
+    arrays.update(_labels_to_arrays(v.columns, 'columns', 'column_offsets'))
+    if issparse(v.matrix):
+        mat = csr_matrix(v.matrix)
+        arrays['data'], arrays['indices'], arrays['indptr'] = mat.data, mat.indices, mat.indptr
+    else:
+        arrays['data'] = np.asarray(v.matrix)
+    return arrays
+
+
+def _vectors_from_arrays(cls, arrays, shape, **kwargs):
+    """
+    Builds a `cls` object from the output of `_vectors_to_arrays` without copying the matrix
+    :param kwargs: passed to the constructor
+    """
+    rows = _labels_from_arrays(arrays, 'rows', 'row_offsets')
+    columns = _labels_from_arrays(arrays, 'columns', 'column_offsets')
+    if 'indptr' in arrays and not issubclass(cls, DenseVectors):
+        matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+    else:
+        matrix = arrays['data']
+    return cls(None, matrix=matrix, columns=columns, rows=rows, **kwargs)
+
+
+def _unpickle_vectors(cls, state):
+    v = _vectors_from_arrays(cls, state, state['shape'], immutable=state['immutable'],
+                             allow_lexical_overlap=state['allow_lexical_overlap'])
+    if state['sims_params'] is not None:
+        v._sims_params = state['sims_params']
+    return v
 
 
 def as_plain_txt(path):
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from discoutils.io_utils import write_csr_arrays, read_csr_arrays
+from discoutils.misc import mkdirs_if_not_exists
+from discoutils.thesaurus_loader import Vectors
+
+__author__ = 'mmb28'
+
+
+class VectorStore(object):
+    """
+    An append-only store of count vectors, for corpora that grow over time. New counts (for new or existing
+    entries) are appended as small log segments, which are periodically merged into the main matrix. This turns
+    rebuilding all vectors from scratch into an incremental update.
+
+    The store is a directory containing:
+     - `rows.txt` and `cols.txt`: the names of all entries and features, one per line. Names are only ever
+       appended, so the position of an entry in the file is its row number
+     - `base-N.*.npy`: the main matrix, in the format of `io_utils.write_csr_arrays`
+     - `segment-N.npz`: the counts appended since the last merge, as (row, column, count) triples
+     - `MANIFEST`: the current base matrix, the list of segments and the size of the vocabularies
+
+    All of these files are immutable apart from the vocabularies, and the manifest is replaced atomically, so
+    a reader that has loaded a manifest sees a consistent state of the store. A store should only be written to
+    by a single process.
+    """
+
+    def __init__(self, path, merge_every=None):
+        """
+        Opens a store, creating it if `path` does not exist.
+        :param path: directory where the store lives
+        :param merge_every: if set, a background merge is started whenever there are this many segments
+        """
+        self.path = path
+        self.merge_every = merge_every
+        self._lock = threading.RLock()  # guards the manifest and the vocabularies
+        self._merge_lock = threading.Lock()  # only one merge at a time
+        self._merge_thread = None
+
+        mkdirs_if_not_exists(path)
+        manifest_path = os.path.join(path, 'MANIFEST')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as infile:
+                self._manifest = json.load(infile)
+        else:
+            self._manifest = dict(base=None, segments=[], n_rows=0, n_cols=0, next_id=0)
+            self._write_manifest(self._manifest)
+        # names appended by a write that did not make it to the manifest are dropped
+        self._rows = self._read_vocabulary('rows.txt', self._manifest['n_rows'])
+        self._cols = self._read_vocabulary('cols.txt', self._manifest['n_cols'])
+        self._row_index = {name: i for i, name in enumerate(self._rows)}
+        self._col_index = {name: i for i, name in enumerate(self._cols)}
+
+    @property
+    def segments(self):
+        """
+        Names of the segments that have not been merged yet
+        """
+        return list(self._manifest['segments'])
+
+    @property
+    def shape(self):
+        return self._manifest['n_rows'], self._manifest['n_cols']
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_vocabulary(self, filename, size):
+        if not os.path.exists(self._file(filename)):
+            open(self._file(filename), 'w').close()
+        with open(self._file(filename), encoding='utf8') as infile:
+            names = [line.rstrip('\n') for line in infile]
+        if len(names) > size:
+            logging.warning('Discarding %d names not in the manifest from %s', len(names) - size, filename)
+            names = names[:size]
+            with open(self._file(filename), 'w', encoding='utf8') as outfile:
+                outfile.write(''.join('%s\n' % name for name in names))
+        return names
+
+    def _write_manifest(self, manifest):
+        tmp = self._file('MANIFEST.tmp')
+        with open(tmp, 'w') as outfile:
+            json.dump(manifest, outfile)
+        os.replace(tmp, self._file('MANIFEST'))
+        self._manifest = manifest
+
+    def _new_name(self, kind):
+        name = '%s-%06d' % (kind, self._manifest['next_id'])
+        self._manifest = dict(self._manifest, next_id=self._manifest['next_id'] + 1)
+        return name
+
+    def _ids(self, names, vocabulary, index, filename):
+        """
+        Looks up the ids of some names, adding the ones that are not in the vocabulary to its end
+        """
+        new = []
+        for name in names:
+            if name not in index:
+                index[name] = len(vocabulary)
+                vocabulary.append(name)
+                new.append(name)
+        if new:
+            with open(self._file(filename), 'a', encoding='utf8') as outfile:
+                outfile.write(''.join('%s\n' % name for name in new))
+        return np.array([index[name] for name in names], dtype=np.int64)
+
+    def append(self, vectors):
+        """
+        Adds counts to the store. The counts of an entry that is already in the store are added to its existing
+        counts.
+        :param vectors: a `Vectors` object or a dict of entry -> list of (feature, count) pairs
+        :return: name of the new segment, or None if there was nothing to append
+        """
+        if isinstance(vectors, Vectors):
+            coo = coo_matrix(vectors.matrix)
+            rows, cols, counts = coo.row, coo.col, coo.data
+            row_names, col_names = [str(x) for x in vectors.row_names], [str(x) for x in vectors.columns]
+        else:
+            row_names, rows, col_names, cols, counts = list(vectors.keys()), [], [], [], []
+            col_index = {}
+            for i, entry in enumerate(row_names):
+                for feature, count in vectors[entry]:
+                    if feature not in col_index:
+                        col_index[feature] = len(col_names)
+                        col_names.append(feature)
+                    rows.append(i)
+                    cols.append(col_index[feature])
+                    counts.append(count)
+        if not len(counts):
+            return None
+
+        with self._lock:
+            row_ids = self._ids(row_names, self._rows, self._row_index, 'rows.txt')[np.asarray(rows)]
+            col_ids = self._ids(col_names, self._cols, self._col_index, 'cols.txt')[np.asarray(cols)]
+            name = self._new_name('segment')
+            with open(self._file(name + '.tmp'), 'wb') as outfile:
+                np.savez(outfile, row=row_ids, col=col_ids, data=np.asarray(counts, dtype=np.float64))
+            os.replace(self._file(name + '.tmp'), self._file(name + '.npz'))
+            self._write_manifest(dict(self._manifest, segments=self._manifest['segments'] + [name],
+                                      n_rows=len(self._rows), n_cols=len(self._cols)))
+            logging.info('Appended %d counts to %s as %s', len(counts), self.path, name)
+            num_segments = len(self._manifest['segments'])
+
+        if self.merge_every and num_segments >= self.merge_every and not self._merge_lock.locked():
+            self.merge(background=True)
+        return name
+
+    def _read_matrix(self, manifest):
+        shape = manifest['n_rows'], manifest['n_cols']
+        if manifest['base'] is None:
+            matrix = csr_matrix(shape, dtype=np.float64)
+        else:
+            base = read_csr_arrays(self._file(manifest['base']))
+            # rows added since the last merge are empty in the base matrix
+            indptr = np.concatenate([base.indptr, np.repeat(base.indptr[-1], shape[0] - base.shape[0])])
+            matrix = csr_matrix((base.data, base.indices, indptr), shape=shape, copy=False)
+        for segment in manifest['segments']:
+            with np.load(self._file(segment + '.npz')) as arrays:
+                delta = coo_matrix((arrays['data'], (arrays['row'], arrays['col'])), shape=shape)
+            matrix = matrix + delta.tocsr()
+        return matrix
+
+    def snapshot(self, **kwargs):
+        """
+        Returns the current state of the store. The snapshot is not affected by later appends or merges.
+        :param kwargs: passed to the `Vectors` constructor
+        :rtype: Vectors
+        """
+        with self._lock:
+            manifest = self._manifest
+            matrix = self._read_matrix(manifest)
+            rows, cols = self._rows[:manifest['n_rows']], self._cols[:manifest['n_cols']]
+        return Vectors(None, matrix=csr_matrix(matrix), rows=rows, columns=cols, **kwargs)
+
+    def merge(self, background=False):
+        """
+        Merges all segments into the main matrix. Appends and snapshots can continue while a merge is running.
+        :param background: if true, merge in a separate thread and return the thread immediately
+        """
+        if background:
+            self._merge_thread = threading.Thread(target=self.merge, name='merge %s' % self.path)
+            self._merge_thread.start()
+            return self._merge_thread
+
+        with self._merge_lock:
+            with self._lock:
+                manifest = self._manifest
+                if not manifest['segments']:
+                    return None
+                base = self._new_name('base')
+            logging.info('Merging %d segments into %s', len(manifest['segments']), base)
+            write_csr_arrays(self._read_matrix(manifest), self._file(base))
+
+            with self._lock:
+                merged = set(manifest['segments'])
+                self._write_manifest(dict(self._manifest, base=base,
+                                          segments=[s for s in self._manifest['segments'] if s not in merged]))
+            # snapshots that have already been taken keep the old base memory-mapped, which is fine on POSIX
+            old_files = ['%s.npz' % s for s in merged]
+            if manifest['base'] is not None:
+                old_files += ['%s.%s.npy' % (manifest['base'], x) for x in ['data', 'indices', 'indptr', 'shape']]
+            for filename in old_files:
+                os.unlink(self._file(filename))
+            return base
+
+    def wait(self):
+        """
+        Waits for a background merge to finish
+        """
+        if self._merge_thread is not None:
+            self._merge_thread.join()
@@ -28,6 +28,7 @@ setup(
     tests_require=['pytest>=2.4.2'],
     cmdclass={'test': PyTest},
     install_requires=['pytest', 'Cython', 'iterpipes3', 'numpy', 'scipy',
-                      'scikit-learn', 'joblib', 'python-magic', 'pandas'],
+                      'scikit-learn', 'joblib', 'pandas'],
+    extras_require={'magic': ['python-magic'], 'zstd': ['zstandard']},
     ext_modules=cythonize(["discoutils/tokens.pyx"])
 )